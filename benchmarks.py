@@ -0,0 +1,658 @@
+# benchmarks.py
+"""
+Замеры производительности бота на синтетическом каталоге.
+
+Запуск:  python benchmarks.py <сценарий> [параметры]
+Сценарии выводят таблицу в stdout; токен бота не нужен.
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import multiprocessing as mp
+import os
+import random
+import time
+import tracemalloc
+
+import tg_bot
+
+# Слова для синтетических описаний — похожи на строки реальных прайсов
+_BRANDS = ["iPhone", "Samsung", "Xiaomi", "HONOR", "Huawei", "Dyson", "JBL", "Apple", "Realme", "Google Pixel"]
+_MODELS = ["15 Pro", "16 Pro Max", "S24 Ultra", "Redmi Note 13", "Magic 6", "Pura 70", "V15", "Flip 6", "Air 13\"", "8a"]
+_MEMORY = ["8/256Gb", "12/512Gb", "6/128Gb", "16/1Tb", "4/64Gb"]
+_COLORS = ["Black", "White", "Blue", "Titanium", "Pink", "Green", "Silver"]
+_SUFFIX = ["EU", "RU", "2sim", "(обменка)", "CN", ""]
+
+
+def make_layers(n_items: int, seed: int = 42) -> list[dict]:
+    """Синтетические слои auto/moved/manual: ~98% авто-каталог, остальное — ручные слои."""
+    rng = random.Random(seed)
+    layers: list[dict] = [{}, {}, {}]
+    for i in range(n_items):
+        desc = " ".join(filter(None, [
+            rng.choice(_BRANDS), rng.choice(_MODELS), rng.choice(_MEMORY),
+            rng.choice(_COLORS), rng.choice(_SUFFIX), f"#{i}",
+        ]))
+        cat, sub = tg_bot.extract_category(desc)
+        roll = rng.random()
+        if roll < 0.98:
+            item = {"desc": desc, "price": rng.randrange(1000, 250000, 100)}
+            layers[0].setdefault(cat, {}).setdefault(sub, []).append(item)
+        elif roll < 0.99:
+            item = {"desc": desc, "price": str(rng.randrange(1000, 250000, 100)), "origin": "auto",
+                    "orig_cat": cat, "orig_sub": sub}
+            layers[1].setdefault("Телефоны", {}).setdefault("Общее", []).append(item)
+        else:
+            item = {"desc": desc, "price": str(rng.randrange(1000, 250000, 100)),
+                    "price_locked": True, "origin": "manual"}
+            layers[2].setdefault(cat, {}).setdefault(sub, []).append(item)
+    return layers
+
+
+def _measure_layout(variant: str, raw: str, out: "mp.Queue") -> None:
+    # Слои в том виде, в каком они приходят с диска (json.load)
+    gc.collect()
+    tracemalloc.start()
+    layers = json.loads(raw)
+    if variant == "dict+copy":
+        # Сегодняшний путь чтения: слои + объединённая глубокая копия get_full_catalog
+        import types
+        ctx = types.SimpleNamespace(application=types.SimpleNamespace(bot_data={
+            "catalog": layers[0], "moved_overrides": layers[1], "manual_categories": layers[2],
+        }))
+        view = tg_bot.get_full_catalog(ctx)
+    elif variant == "columnar":
+        view = tg_bot.ColumnarCatalog(layers)
+        del layers
+    else:
+        view = [it for layer in layers for subs in layer.values() for items in subs.values() for it in items]
+    gc.collect()
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    out.put((variant, traced, len(view)))
+
+
+def bench_catalog_memory(args) -> None:
+    """
+    Память: слои dict-of-dict-of-list (как после json.load), они же плюс
+    deepcopy из get_full_catalog (пик на каждом запросе) и ColumnarCatalog.
+
+    Каждый вариант меряется в отдельном процессе через tracemalloc: это живые
+    объекты Python, без арен, которые аллокатор держит после освобождения
+    (из-за них «сырой» RSS одного процесса почти не падает после del).
+    """
+    raw = json.dumps(make_layers(args.items))
+    print(f"Товаров: {args.items}")
+    print(f"{'вариант':<10} {'память, МБ':>12}")
+    results = {}
+    for variant in ("dict", "dict+copy", "columnar"):
+        out = mp.Queue()
+        p = mp.Process(target=_measure_layout, args=(variant, raw, out))
+        p.start()
+        name, traced, _ = out.get()
+        p.join()
+        results[name] = traced
+        print(f"{name:<10} {traced / 2**20:>12.1f}")
+    for base in ("dict", "dict+copy"):
+        print(f"Сокращение против {base}: {results[base] / max(results['columnar'], 1):.1f}x")
+
+
+def _user_state(user_id: int, step: int) -> dict:
+    """Типичное user_data: навигация + шаг мастера + флаг поиска."""
+    return {
+        "navigation_stack": [("cat", "Телефоны"), ("sub", "Телефоны", f"Бренд {step % 7}")],
+        "change_step": "awaiting_selection",
+        "change_cat": "Телефоны",
+        "change_sub": "Apple",
+        "change_selection_map": [
+            {"src": "auto", "idx": i, "desc": f"iPhone 16 Pro {i}", "price": "99000"} for i in range(step % 20)
+        ],
+        "awaiting_search": bool(step % 2),
+        "user": user_id,
+    }
+
+
+def bench_persistence(args) -> None:
+    """
+    Пропускная способность сохранения user_data для args.users активных пользователей.
+
+    pickle-file — PicklePersistence(on_flush=False): весь файл на каждый апдейт
+                  (меряется на выборке, результат экстраполируется);
+    per-update  — SQLite, отдельная надёжная транзакция (synchronous=FULL) на апдейт;
+    batched     — SQLitePersistence: буфер + одна транзакция на прогон PTB.
+    Для batched отдельно показано время в цикле событий (без записи в потоке).
+    """
+    import asyncio
+    import pickle
+    import sqlite3
+    import tempfile
+    from telegram.ext import PicklePersistence
+
+    tmp = tempfile.mkdtemp(dir=".")
+    total = args.users * args.rounds
+    print(f"Пользователей: {args.users}, апдейтов: {total}")
+    rows = []
+
+    async def run_pickle() -> float:
+        persistence = PicklePersistence(os.path.join(tmp, "state.pickle"), on_flush=False)
+        for uid in range(args.users):
+            persistence.user_data = persistence.user_data or {}
+            persistence.user_data[uid] = _user_state(uid, 0)
+        sample = min(200, total)
+        started = time.perf_counter()
+        for i in range(sample):
+            await persistence.update_user_data(i % args.users, _user_state(i, 1))
+        return (time.perf_counter() - started) / sample * total
+
+    rows.append(("pickle-file", asyncio.run(run_pickle()), None))
+
+    db = sqlite3.connect(os.path.join(tmp, "naive.sqlite3"), isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=FULL")
+    db.execute("CREATE TABLE user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+    started = time.perf_counter()
+    for step in range(args.rounds):
+        for uid in range(args.users):
+            db.execute("INSERT OR REPLACE INTO user_data VALUES (?, ?)",
+                       (uid, pickle.dumps(_user_state(uid, step))))
+    rows.append(("per-update", time.perf_counter() - started, None))
+    db.close()
+
+    async def run_batched() -> tuple[float, float]:
+        persistence = tg_bot.SQLitePersistence(os.path.join(tmp, "batched.sqlite3"), flush_interval=1)
+        in_loop = 0.0
+        started = time.perf_counter()
+        for step in range(args.rounds):
+            # Один прогон Application.update_persistence: все изменённые пользователи разом
+            t0 = time.perf_counter()
+            await asyncio.gather(*(
+                persistence.update_user_data(uid, _user_state(uid, step)) for uid in range(args.users)
+            ))
+            in_loop += time.perf_counter() - t0
+            await persistence.flush()
+        return time.perf_counter() - started, in_loop
+
+    batched, in_loop = asyncio.run(run_batched())
+    rows.append(("batched", batched, in_loop))
+
+    print(f"{'вариант':<12} {'время, с':>9} {'апдейтов/с':>12} {'в цикле, с':>11}")
+    for name, seconds, loop_seconds in rows:
+        loop_col = f"{loop_seconds:>11.2f}" if loop_seconds is not None else f"{seconds:>11.2f}"
+        print(f"{name:<12} {seconds:>9.2f} {total / seconds:>12,.0f} {loop_col}")
+    import shutil
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _write_price_xlsx(path: str, n_rows: int, seed: int = 7) -> None:
+    """Прайс как от поставщика: description/price, часть цен пустые."""
+    import openpyxl
+
+    rng = random.Random(seed)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Список товаров")
+    ws.append(["xmlid", "description", "price"])
+    for i in range(n_rows):
+        desc = " ".join(filter(None, [
+            rng.choice(_BRANDS), rng.choice(_MODELS), rng.choice(_MEMORY),
+            rng.choice(_COLORS), rng.choice(_SUFFIX), f"#{i}",
+        ]))
+        price = rng.randrange(1000, 250000, 100) if rng.random() > 0.01 else None
+        ws.append([f"x{i}", desc, price])
+    wb.save(path)
+
+
+def _xlsx_to_csv(src: str, dst: str) -> None:
+    """Тот же прайс в CSV (как выгрузка из ERP: «;», cp1251)."""
+    import csv
+    import openpyxl
+
+    wb = openpyxl.load_workbook(src, read_only=True)
+    with open(dst, "w", encoding="cp1251", newline="") as fh:
+        writer = csv.writer(fh, delimiter=";")
+        for row in wb.worksheets[0].iter_rows(values_only=True):
+            writer.writerow(["" if v is None else v for v in row])
+    wb.close()
+
+
+def _ingest_dataframe(path: str) -> tuple[dict, dict]:
+    """Прежний разбор handle_document: pd.read_excel + два прохода iterrows."""
+    df = tg_bot.pd.read_excel(path)
+    catalog: dict = {}
+    for _, row in df.iterrows():
+        desc = str(row.get("description") or row.get("desription") or "")
+        price = row.get("price") or row.get("Цена") or row.get("Price") or ""
+        cat, sub = tg_bot.extract_category(desc)
+        catalog.setdefault(cat, {}).setdefault(sub, []).append({"desc": desc, "price": price})
+    price_by_desc: dict = {}
+    for _, row in df.iterrows():
+        d = str(row.get("description") or row.get("desription") or "")
+        p = row.get("price") or row.get("Цена") or row.get("Price") or ""
+        price_by_desc[tg_bot._norm_desc(d)] = p
+    return catalog, price_by_desc
+
+
+def _measure_ingest(variant: str, path: str, out: "mp.Queue") -> None:
+    def run():
+        if variant == "dataframe":
+            return _ingest_dataframe(path)
+        if variant == "csv":
+            return tg_bot._build_catalog_from_rows(tg_bot._iter_csv_rows(path[:-5] + ".csv"))
+        return tg_bot._build_catalog_from_rows(tg_bot._iter_excel_rows(path))
+
+    # Время — без tracemalloc (он замедляет аллокации в разы), память — вторым прогоном
+    started = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    result = run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # NaN != NaN, поэтому сравниваем через repr
+    out.put((variant, elapsed, peak, repr(result)))
+
+
+def bench_ingest_xlsx(args) -> None:
+    """
+    Разбор загруженного прайса: DataFrame, потоковое чтение openpyxl и тот же
+    прайс в CSV через модуль csv.
+
+    Каждый вариант — в отдельном процессе: прогон на время, затем прогон
+    под tracemalloc на пиковую память; результаты обоих путей сравниваются на полное совпадение.
+    """
+    import tempfile
+
+    fd, path = tempfile.mkstemp(suffix=".xlsx", dir=".")
+    os.close(fd)
+    try:
+        _write_price_xlsx(path, args.rows)
+        _xlsx_to_csv(path, path[:-5] + ".csv")
+        print(f"Строк: {args.rows}, файл: {os.path.getsize(path) / 2**20:.1f} МБ")
+        print(f"{'вариант':<10} {'время, с':>9} {'пик, МБ':>9}")
+        results = {}
+        for variant in ("dataframe", "streaming", "csv"):
+            out = mp.Queue()
+            p = mp.Process(target=_measure_ingest, args=(variant, path, out))
+            p.start()
+            name, elapsed, peak, dump = out.get()
+            p.join()
+            results[name] = dump
+            print(f"{name:<10} {elapsed:>9.2f} {peak / 2**20:>9.1f}")
+        same = results["dataframe"] == results["streaming"] == results["csv"]
+        print(f"Результаты совпадают: {'да' if same else 'НЕТ'}")
+    finally:
+        os.remove(path)
+        if os.path.exists(path[:-5] + ".csv"):
+            os.remove(path[:-5] + ".csv")
+
+
+def _export_dataframe(store, path: str) -> int:
+    """Прежняя выгрузка: список строк → DataFrame → pd.ExcelWriter."""
+    import pandas as pd
+
+    rows = [{"xmlid": f"{c}/{s}", "description": it.desc, "price": it.price} for c, s, it in store.iter_rows()]
+    df = pd.DataFrame(rows, columns=["xmlid", "description", "price"])
+    df["price"] = df["price"].apply(tg_bot._export_price)
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        df.to_excel(writer, index=False, sheet_name="catalog")
+    return len(df)
+
+
+def _measure_export(variant: str, raw: str, path: str, out: "mp.Queue") -> None:
+    store = tg_bot.ColumnarCatalog(json.loads(raw), 1)
+
+    def run():
+        if variant == "dataframe":
+            return _export_dataframe(store, path)
+        return tg_bot.EXPORT_FORMATS[variant][1](tg_bot._export_store_rows(store), path)
+
+    started = time.perf_counter()
+    count = run()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    out.put((variant, count, elapsed, peak, os.path.getsize(path)))
+    os.remove(path)
+
+
+def bench_export(args) -> None:
+    """
+    Выгрузка всего каталога: прежний путь через DataFrame против потоковой
+    записи xlsx (xlsxwriter constant_memory / openpyxl write_only), CSV и JSON.
+    Пик памяти — сверх уже построенного колоночного снимка.
+    """
+    raw = json.dumps(make_layers(args.items))
+    print(f"Товаров: {args.items}")
+    print(f"{'вариант':<10} {'строк':>7} {'время, с':>9} {'пик, МБ':>9} {'файл, МБ':>9}")
+    for variant in ("dataframe", "xlsx", "csv", "json"):
+        out = mp.Queue()
+        suffix = "xlsx" if variant == "dataframe" else variant
+        p = mp.Process(target=_measure_export, args=(variant, raw, f"bench_export.{suffix}", out))
+        p.start()
+        name, count, elapsed, peak, size = out.get()
+        p.join()
+        print(f"{name:<10} {count:>7} {elapsed:>9.2f} {peak / 2**20:>9.1f} {size / 2**20:>9.1f}")
+
+
+def bench_history(args) -> None:
+    """
+    История версий: размер дельты против полной копии слоёв, время записи версии
+    и отката на --versions назад. Каждая версия меняет цену у --changed доли товаров.
+    История держится в памяти, файл пишется в фоне — «запись» и «откат» здесь то,
+    что происходит под блокировкой писателя; чтение файла — только при старте.
+    """
+    import tempfile
+
+    rng = random.Random(3)
+    bot_data = dict(zip(("catalog", "moved_overrides", "manual_categories"), make_layers(args.items)))
+    ctx = type("Ctx", (), {})()
+    ctx.application = type("App", (), {"bot_data": bot_data})()
+    fd, tg_bot.CATALOG_HISTORY_FILE = tempfile.mkstemp(suffix=".json.gz", dir=".")
+    os.close(fd)
+    os.remove(tg_bot.CATALOG_HISTORY_FILE)
+
+    async def run() -> tuple[list[float], list[float], float, float]:
+        record_times, save_times = [], []
+        for _ in range(args.versions + 1):
+            bot_data["catalog_version"] = bot_data.get("catalog_version", 0) + 1
+            started = time.perf_counter()
+            await tg_bot._record_history(ctx, "bench")
+            record_times.append(time.perf_counter() - started)
+            # Между загрузками прайса фоновая запись успевает закончиться
+            started = time.perf_counter()
+            await tg_bot._flush_history(bot_data)
+            save_times.append(time.perf_counter() - started)
+            for layer in (bot_data["catalog"], bot_data["moved_overrides"], bot_data["manual_categories"]):
+                for subs in layer.values():
+                    for items in subs.values():
+                        for item in items:
+                            if rng.random() < args.changed:
+                                item["price"] = rng.randrange(1000, 250000, 100)
+        # Пропуск: каталог не менялся с записи head
+        started = time.perf_counter()
+        await tg_bot._record_history(ctx, "bench")
+        skip = time.perf_counter() - started
+        history = (await tg_bot._get_history(bot_data))["history"]
+        started = time.perf_counter()
+        tg_bot._copy_state(tg_bot._history_restore(history, history["back"][-1]["id"]))
+        restore = time.perf_counter() - started
+        return record_times, save_times, skip, restore
+
+    try:
+        record_times, save_times, skip, restore = asyncio.run(run())
+        history = bot_data["catalog_history"]["history"]
+        started = time.perf_counter()
+        tg_bot._load_history()
+        load = time.perf_counter() - started
+        full = len(json.dumps(history["head"]["state"], ensure_ascii=False).encode())
+        deltas = [len(json.dumps(e["delta"], ensure_ascii=False).encode()) for e in history["back"]]
+        print(f"Товаров: {args.items}, версий: {args.versions}, меняется цен: {args.changed:.0%}")
+        print(f"полная копия слоёв:    {full / 2**20:8.2f} МБ")
+        print(f"дельта версии (сред.): {sum(deltas) / len(deltas) / 2**20:8.2f} МБ")
+        print(f"файл истории (gzip):   {os.path.getsize(tg_bot.CATALOG_HISTORY_FILE) / 2**20:8.2f} МБ")
+        print(f"запись версии (сред.): {sum(record_times[1:]) / args.versions:8.2f} с")
+        print(f"запись без изменений:  {skip:8.4f} с")
+        print(f"файл в фоне (сред.):   {sum(save_times[1:]) / args.versions:8.2f} с")
+        print(f"откат на {args.versions} версий:    {restore:8.2f} с")
+        print(f"чтение файла (старт):  {load:8.2f} с")
+    finally:
+        if os.path.exists(tg_bot.CATALOG_HISTORY_FILE):
+            os.remove(tg_bot.CATALOG_HISTORY_FILE)
+
+
+@contextlib.asynccontextmanager
+async def _unlocked_writer(context):
+    """catalog_writer без блокировки — чтобы стресс-тест показывал, что он ловит гонки."""
+    yield
+
+
+async def _stress_catalog(items: int, admins: int, ops: int, customers: int, locked: bool) -> dict:
+    """
+    Админы делают «прочитать → await → записать» (как мастера с записью файла
+    внутри писателя), покупатели в это время читают снимки без блокировок.
+    Инвариант: каждая версия добавляет ровно один товар, поэтому в любом снимке
+    len == исходный размер + номер версии.
+    """
+    import types
+
+    layers = make_layers(items)
+    bot_data = {"catalog": layers[0], "moved_overrides": layers[1], "manual_categories": layers[2]}
+    ctx = types.SimpleNamespace(application=types.SimpleNamespace(bot_data=bot_data))
+    writer = tg_bot.catalog_writer if locked else _unlocked_writer
+    base = len(tg_bot._get_catalog_store(ctx))
+    stats = {"reads": 0, "searches": 0, "violations": 0}
+    done = asyncio.Event()
+
+    async def admin(n: int) -> None:
+        for i in range(ops):
+            async with writer(ctx):
+                items_ = list(bot_data["manual_categories"].get("Стресс", {}).get("Тест", []))
+                await asyncio.sleep(0)
+                items_.append({"desc": f"admin {n} op {i}", "price": "1"})
+                bot_data["manual_categories"] = {**bot_data["manual_categories"], "Стресс": {"Тест": items_}}
+                tg_bot._bump_catalog_version(ctx)
+            await asyncio.sleep(0)
+
+    async def customer(n: int) -> None:
+        while not done.is_set():
+            store = tg_bot._get_catalog_store(ctx)
+            if len(store) != base + store.version:
+                stats["violations"] += 1
+            markup = tg_bot._categories_markup(store)
+            cat = markup.inline_keyboard[n % len(markup.inline_keyboard)][0].callback_data.split("|", 1)[1]
+            tg_bot._subcategories_markup(store, cat, "back|root")
+            stats["reads"] += 1
+            if stats["reads"] % 50 == 0:
+                tg_bot._search_catalog(ctx, "iphone 15")
+                stats["searches"] += 1
+            await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    readers = [asyncio.create_task(customer(n)) for n in range(customers)]
+    await asyncio.gather(*(admin(n) for n in range(admins)))
+    done.set()
+    await asyncio.gather(*readers)
+    stats["elapsed"] = time.perf_counter() - started
+    stats["added"] = len(bot_data["manual_categories"]["Стресс"]["Тест"])
+    return stats
+
+
+async def _stress_updates(users: int, per_user: int, latency: float, max_concurrent: int) -> tuple[float, bool]:
+    """Апдейты через PerUserUpdateProcessor: время и сохранился ли порядок внутри пользователя."""
+    import types
+
+    processor = tg_bot.PerUserUpdateProcessor(max_concurrent)
+    seen: dict[int, list[int]] = {u: [] for u in range(users)}
+
+    async def handler(user_id: int, seq: int) -> None:
+        seen[user_id].append(seq)
+        await asyncio.sleep(latency)  # ответ в Telegram
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        processor.process_update(types.SimpleNamespace(effective_user=types.SimpleNamespace(id=u)), handler(u, s))
+        for s in range(per_user) for u in range(users)
+    ))
+    ordered = all(seq == list(range(per_user)) for seq in seen.values())
+    return time.perf_counter() - started, ordered
+
+
+async def _stress_fairness(limit: int, slow: int, slow_latency: float) -> float:
+    """Один пользователь шлёт slow медленных апдейтов; сколько ждёт быстрый апдейт другого пользователя."""
+    import types
+
+    processor = tg_bot.PerUserUpdateProcessor(limit)
+
+    async def handler(delay: float) -> None:
+        await asyncio.sleep(delay)
+
+    def update(user_id: int):
+        return types.SimpleNamespace(effective_user=types.SimpleNamespace(id=user_id))
+
+    busy = [asyncio.create_task(processor.process_update(update(1), handler(slow_latency))) for _ in range(slow)]
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await processor.process_update(update(2), handler(0))
+    waited = time.perf_counter() - started
+    await asyncio.gather(*busy)
+    return waited
+
+
+def bench_concurrency(args) -> None:
+    """
+    Стресс-тест параллельной обработки: админы меняют каталог, покупатели читают
+    снимки и ищут; затем апдейты через PerUserUpdateProcessor по одному и параллельно.
+    """
+    print(f"Каталог: {args.items}, админов: {args.admins} × {args.ops} изменений, покупателей: {args.customers}")
+    print(f"{'писатель':<16} {'добавлено':>10} {'нарушений':>10} {'чтений':>8} {'поисков':>8} {'время, с':>9}")
+    for locked in (True, False):
+        stats = asyncio.run(_stress_catalog(args.items, args.admins, args.ops, args.customers, locked))
+        name = "catalog_writer" if locked else "без блокировки"
+        print(f"{name:<16} {stats['added']:>4}/{args.admins * args.ops:<5} {stats['violations']:>10} "
+              f"{stats['reads']:>8} {stats['searches']:>8} {stats['elapsed']:>9.2f}")
+
+    print(f"\nАпдейты: {args.users} пользователей × {args.per_user}, ответ {args.latency * 1000:.0f} мс")
+    for limit in (1, tg_bot.MAX_CONCURRENT_UPDATES):
+        elapsed, ordered = asyncio.run(_stress_updates(args.users, args.per_user, args.latency, limit))
+        print(f"одновременно {limit:>3}: {elapsed:6.2f} с, порядок внутри пользователя {'сохранён' if ordered else 'НАРУШЕН'}")
+
+    limit = 4
+    waited = asyncio.run(_stress_fairness(limit, limit, 0.5))
+    print(f"\n{limit} медленных апдейта одного пользователя при {limit} слотах: "
+          f"апдейт другого пользователя ждал {waited:.2f} с")
+
+
+def bench_search_cache(args) -> None:
+    """
+    Поиск с отрисовкой ответа: без кэша против SearchResultCache. Запросы — из
+    словаря брендов и моделей с частотами по закону Ципфа (немногие запросы
+    повторяются постоянно); каждые --mutate-every запросов каталог меняется.
+    """
+    import types
+
+    rng = random.Random(11)
+    vocabulary = [b.lower() for b in _BRANDS] + [f"{b} {m}".lower() for b in _BRANDS for m in _MODELS]
+    rng.shuffle(vocabulary)
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    queries = rng.choices(vocabulary, weights, k=args.queries)
+
+    def run(cached: bool) -> tuple[float, "tg_bot.SearchResultCache"]:
+        bot_data = dict(zip(("catalog", "moved_overrides", "manual_categories"), make_layers(args.items)))
+        ctx = types.SimpleNamespace(application=types.SimpleNamespace(bot_data=bot_data))
+        elapsed = 0.0
+        for i, raw in enumerate(queries):
+            if i and i % args.mutate_every == 0:
+                tg_bot._bump_catalog_version(ctx)
+            tg_bot._get_search_index(ctx)  # перестройка индекса после правки — общая для обоих вариантов
+            started = time.perf_counter()
+            if cached:
+                tg_bot._search_messages(ctx, raw)
+            else:
+                tg_bot._render_search_results(*tg_bot._run_search(ctx, raw))
+            elapsed += time.perf_counter() - started
+        return elapsed, tg_bot._get_search_cache(ctx)
+
+    plain, _ = run(False)
+    cached, cache = run(True)
+    print(f"Товаров: {args.items}, запросов: {args.queries} (разных в словаре: {len(vocabulary)}), "
+          f"правка каталога каждые {args.mutate_every}")
+    print(f"без кэша: {plain:7.2f} с ({plain / args.queries * 1000:.2f} мс на запрос)")
+    print(f"с кэшем:  {cached:7.2f} с ({cached / args.queries * 1000:.2f} мс на запрос)")
+    print(cache.format_stats())
+
+
+def bench_search_rank(args) -> None:
+    """
+    Многословные запросы: прежний поиск подстрокой по всем описаниям против
+    пересечения списков вхождений с BM25F (описание + название категории) и top-k через кучу.
+    """
+    import types
+
+    rng = random.Random(5)
+    bot_data = dict(zip(("catalog", "moved_overrides", "manual_categories"), make_layers(args.items)))
+    ctx = types.SimpleNamespace(application=types.SimpleNamespace(bot_data=bot_data))
+    index = tg_bot._get_search_index(ctx)
+    queries = [
+        " ".join(rng.sample([rng.choice(_BRANDS), rng.choice(_MODELS), rng.choice(_MEMORY), rng.choice(_COLORS)],
+                            rng.randint(1, 4)))
+        for _ in range(args.queries)
+    ]
+
+    found = {"substring": 0, "ranked": 0}
+    started = time.perf_counter()
+    for raw in queries:
+        q = tg_bot._normalize_search_text(raw)
+        found["substring"] += bool([r for r, d in zip(index.items, index.norm_descs) if q in d])
+    substring = time.perf_counter() - started
+    started = time.perf_counter()
+    for raw in queries:
+        found["ranked"] += bool(index.ranked_search(tg_bot._parse_search_query(raw))[0])
+    ranked = time.perf_counter() - started
+
+    print(f"Товаров: {args.items}, запросов: {args.queries} (1–4 слова в случайном порядке)")
+    print(f"{'способ':<10} {'мс/запрос':>10} {'нашлось':>9}")
+    for name, elapsed in (("substring", substring), ("ranked", ranked)):
+        print(f"{name:<10} {elapsed / args.queries * 1000:>10.2f} {found[name]:>5}/{args.queries}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    p = sub.add_parser("catalog-memory", help="память каталога: dict против колоночного снимка")
+    p.add_argument("--items", type=int, default=100_000)
+    p.set_defaults(func=bench_catalog_memory)
+
+    p = sub.add_parser("persistence", help="сохранение user_data: запись на апдейт против пакетной")
+    p.add_argument("--users", type=int, default=5000)
+    p.add_argument("--rounds", type=int, default=5)
+    p.set_defaults(func=bench_persistence)
+
+    p = sub.add_parser("ingest-xlsx", help="разбор прайса: pd.read_excel, потоковый openpyxl и CSV")
+    p.add_argument("--rows", type=int, default=50_000)
+    p.set_defaults(func=bench_ingest_xlsx)
+
+    p = sub.add_parser("export", help="выгрузка каталога: DataFrame против потоковой записи")
+    p.add_argument("--items", type=int, default=50_000)
+    p.set_defaults(func=bench_export)
+
+    p = sub.add_parser("history", help="история версий каталога: дельты и откат")
+    p.add_argument("--items", type=int, default=50_000)
+    p.add_argument("--versions", type=int, default=10)
+    p.add_argument("--changed", type=float, default=0.03)
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser("concurrency", help="стресс-тест: параллельные админы и покупатели, порядок апдейтов")
+    p.add_argument("--items", type=int, default=5000)
+    p.add_argument("--admins", type=int, default=4)
+    p.add_argument("--ops", type=int, default=25)
+    p.add_argument("--customers", type=int, default=100)
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--per-user", type=int, default=3)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.set_defaults(func=bench_concurrency)
+
+    p = sub.add_parser("search-cache", help="поиск: повторные запросы без кэша и с LRU-кэшем ответов")
+    p.add_argument("--items", type=int, default=50_000)
+    p.add_argument("--queries", type=int, default=2000)
+    p.add_argument("--mutate-every", type=int, default=500)
+    p.set_defaults(func=bench_search_cache)
+
+    p = sub.add_parser("search-rank", help="многословный поиск: подстрока против пересечения с BM25")
+    p.add_argument("--items", type=int, default=50_000)
+    p.add_argument("--queries", type=int, default=500)
+    p.set_defaults(func=bench_search_rank)
+
+    args = parser.parse_args()
+    started = time.perf_counter()
+    args.func(args)
+    print(f"Готово за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
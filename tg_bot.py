@@ -3,24 +3,40 @@ import os
 import asyncio
 import tempfile
 import json
+import io
 import html
+import re
+import contextlib
+import time
+import itertools
+import heapq
+import bisect
+import math
+import secrets
+from collections import Counter, OrderedDict
+from typing import NamedTuple
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from pathlib import Path
 from dotenv import load_dotenv
 from telegram.constants import ParseMode
 load_dotenv()
 
-import pandas as pd
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton,
+    InlineQueryResultArticle, InputTextMessageContent,
+)
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     filters,
 )
-import shutil
 
 # ---------------------------------------------------------------------------
 # Замените значение переменной на ваш токен или установите переменную
@@ -132,7 +148,7 @@ PREFERRED_CATEGORY_ORDER: list[str] = [
 
 def make_admin_panel_markup() -> InlineKeyboardMarkup:
     buttons = [
-        [InlineKeyboardButton("📥 Добавить каталог (.xlsx)", callback_data="adminpanel_add_catalog")],
+        [InlineKeyboardButton("📥 Добавить каталог (.xlsx/.csv)", callback_data="adminpanel_add_catalog")],
         [InlineKeyboardButton("🔀 Изменить категорию товаров", callback_data="adminpanel_change_category")],
         [InlineKeyboardButton("📝 Ручные (manual)", callback_data="adminpanel_manual_root")],
         [InlineKeyboardButton("👤 Управление администраторами", callback_data="adminpanel_edit_admins")],
@@ -157,6 +173,9 @@ async def show_admin_panel(update_or_query, context):
     )
 
 
+_PREFERRED_CATEGORIES = frozenset(PREFERRED_CATEGORY_ORDER)
+
+
 def _sort_categories(cat_names: list[str]) -> list[str]:
     """Возвращает список категорий в желаемом порядке отображения.
 
@@ -164,10 +183,8 @@ def _sort_categories(cat_names: list[str]) -> list[str]:
     2. Остальные (кроме "Другое") – по алфавиту.
     3. "Другое" – последней, если присутствует.
     """
-    order_map = {name: idx for idx, name in enumerate(PREFERRED_CATEGORY_ORDER)}
-
     preferred = [c for c in PREFERRED_CATEGORY_ORDER if c in cat_names]
-    other = sorted([c for c in cat_names if c not in order_map and c != "Другое"])
+    other = sorted([c for c in cat_names if c not in _PREFERRED_CATEGORIES and c != "Другое"])
     tail = ["Другое"] if "Другое" in cat_names else []
     return preferred + other + tail
 
@@ -185,6 +202,7 @@ def _load_catalog_from_disk() -> dict | None:
 
 def get_full_catalog(context) -> dict:
     """Объединяет основной каталог, перенесённые товары и manual_categories для вывода и поиска."""
+    _refresh_shared_catalog(context.application.bot_data)
     catalog = context.application.bot_data.get("catalog") or {}
     moved = context.application.bot_data.get("moved_overrides") or {}
     manual = context.application.bot_data.get("manual_categories") or {}
@@ -215,6 +233,1112 @@ def _save_catalog_to_disk(catalog: dict) -> None:
         pass
 
 
+# -------------------------------------------------------------------
+# Версия каталога и поисковый индекс (нечёткий поиск с опечатками)
+# -------------------------------------------------------------------
+
+def _catalog_version(context) -> int:
+    """Текущая версия объединённого каталога (auto + moved + manual)."""
+    _refresh_shared_catalog(context.application.bot_data)
+    return context.application.bot_data.get("catalog_version", 0)
+
+
+def _bump_catalog_version(context) -> int:
+    """Вызывается после любого изменения каталога: сбрасывает производные кэши."""
+    bot_data = context.application.bot_data
+    bot_data["catalog_version"] = bot_data.get("catalog_version", 0) + 1
+    bot_data.pop("search_index", None)
+    bot_data.pop("catalog_store", None)
+    return bot_data["catalog_version"]
+
+
+# -------------------------------------------------------------------
+# Индекс позиций по нормализованному описанию (все три слоя)
+# -------------------------------------------------------------------
+class ItemIndex:
+    """
+    Нормализованное описание → где лежат позиции с ним: по слоям, списком
+    (категория, подкатегория, сам товар). Ключи — строки _norm_desc, так что
+    поиск позиции — один хеш-лукап вместо прохода по каталогу с регуляркой.
+
+    Индекс живёт в bot_data["item_index"] и обновляется в тех же местах, где
+    меняются слои (add / remove). Он привязан к объектам слоёв: если слой
+    заменён целиком (загрузка с диска, общий снимок), индекс строится заново.
+    """
+
+    __slots__ = ("layers", "sources")
+
+    def __init__(self, auto: dict | None = None, moved: dict | None = None, manual: dict | None = None):
+        self.layers: list[dict[str, list[tuple]]] = [{}, {}, {}]
+        self.sources = (auto, moved, manual)
+        for layer_id, data in enumerate(self.sources):
+            self.add_layer(layer_id, data or {})
+
+    def add_layer(self, layer: int, data: dict) -> None:
+        for cat, subs in data.items():
+            for sub, items in subs.items():
+                self.add_items(layer, cat, sub, items)
+
+    def add(self, layer: int, cat: str, sub: str, item: dict) -> str:
+        key = _norm_desc(item.get("desc", ""))
+        self.layers[layer].setdefault(key, []).append((cat, sub, item))
+        return key
+
+    def add_items(self, layer: int, cat: str, sub: str, items) -> None:
+        for item in items:
+            self.add(layer, cat, sub, item)
+
+    def remove(self, layer: int, item: dict, key: str | None = None) -> None:
+        """Убирает именно этот объект товара (сравнение по identity)."""
+        key = _norm_desc(item.get("desc", "")) if key is None else key
+        entries = self.layers[layer].get(key)
+        if not entries:
+            return
+        for i, entry in enumerate(entries):
+            if entry[2] is item:
+                del entries[i]
+                break
+        if not entries:
+            del self.layers[layer][key]
+
+    def remove_items(self, layer: int, items) -> None:
+        for item in items:
+            self.remove(layer, item)
+
+    def entries(self, layer: int, key: str) -> list[tuple]:
+        return self.layers[layer].get(key, [])
+
+    def __contains__(self, key: str) -> bool:
+        return any(key in layer for layer in self.layers)
+
+    def matches(self, sources: tuple) -> bool:
+        return all(a is b for a, b in zip(self.sources, sources))
+
+
+def _get_item_index(context) -> ItemIndex:
+    """Индекс для текущих слоёв bot_data; перестраивается, только если слой заменили."""
+    bot_data = context.application.bot_data
+    sources = (
+        bot_data.get("catalog"),
+        bot_data.get("moved_overrides"),
+        bot_data.get("manual_categories"),
+    )
+    index = bot_data.get("item_index")
+    if index is None or not index.matches(sources):
+        index = bot_data["item_index"] = ItemIndex(*sources)
+    return index
+
+
+def _drop_from_layer(layer: dict, cat: str, sub: str, doomed: set[int]) -> None:
+    """Удаляет из layer[cat][sub] товары с id из doomed, пустые ветки — тоже."""
+    items = layer.get(cat, {}).get(sub)
+    if items is None:
+        return
+    kept = [it for it in items if id(it) not in doomed]
+    if kept:
+        layer[cat][sub] = kept
+    else:
+        del layer[cat][sub]
+        if not layer[cat]:
+            del layer[cat]
+
+
+def _shown_items(items: list[dict]) -> list[tuple[str, str]]:
+    """(описание, цена) товаров в том порядке, в каком список показан админу."""
+    return [(str(it.get("desc", "")), str(it.get("price", ""))) for it in items]
+
+
+def _resolve_picks(items: list[dict], picks: list[tuple[int, str, str]]) -> list[int]:
+    """
+    Текущие позиции выбранных товаров. Писатель работает со свежим снимком, и другой
+    админ мог изменить список после показа, поэтому номер проверяется по описанию
+    и цене; сдвинувшийся товар ищется по ним же, пропавший пропускается.
+    """
+    taken: set[int] = set()
+    for idx, desc, price in picks:
+        def same(i: int) -> bool:
+            return (i not in taken and str(items[i].get("desc", "")) == desc
+                    and str(items[i].get("price", "")) == price)
+
+        if not (0 <= idx < len(items) and same(idx)):
+            idx = next((i for i in range(len(items)) if same(i)), None)
+        if idx is not None:
+            taken.add(idx)
+    return sorted(taken)
+
+
+# -------------------------------------------------------------------
+# Компактное колоночное представление объединённого каталога
+# -------------------------------------------------------------------
+from array import array
+
+# Слои каталога в порядке объединения (как в get_full_catalog)
+LAYER_AUTO, LAYER_MOVED, LAYER_MANUAL = 0, 1, 2
+_NO_PRICE = -(2 ** 63)
+_MISSING = object()
+
+
+class CatalogItem:
+    """Лёгкое представление строки ColumnarCatalog; читается как dict товара."""
+
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store: "ColumnarCatalog", row: int):
+        self._store = store
+        self._row = row
+
+    @property
+    def desc(self) -> str:
+        return self._store.desc_at(self._row)
+
+    @property
+    def price(self):
+        return self._store.price_at(self._row)
+
+    @property
+    def cat(self) -> str:
+        return self._store.categories[self._store.cat_ids[self._row]]
+
+    @property
+    def sub(self) -> str:
+        return self._store.subcategories[self._store.sub_ids[self._row]]
+
+    @property
+    def layer(self) -> int:
+        return self._store.layers[self._row]
+
+    def get(self, key: str, default=None):
+        if key == "desc":
+            return self.desc
+        if key == "price":
+            return self.price
+        return self._store.extras.get(self._row, {}).get(key, default)
+
+    def __getitem__(self, key: str):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def to_dict(self) -> dict:
+        return {"desc": self.desc, "price": self.price, **self._store.extras.get(self._row, {})}
+
+
+class ColumnarCatalog:
+    """
+    Неизменяемый снимок объединённого каталога (auto + moved + manual) в колонках.
+
+    Категории и подкатегории интернированы (cat_ids/sub_ids — массивы номеров),
+    цены лежат в array('q'), описания — в одной строке с массивом концов.
+    Строки сгруппированы по (категория, подкатегория) в порядке get_full_catalog,
+    поэтому товары подкатегории — это непрерывный диапазон строк.
+    """
+
+    def __init__(self, layers: list[dict], version: int = 0):
+        self.version = version
+        self.categories: list[str] = []
+        self.subcategories: list[str] = []
+        self.cat_ids = array("H")
+        self.sub_ids = array("I")
+        self.layers = array("B")
+        self.prices = array("q")
+        self.price_raw: dict[int, object] = {}
+        self.extras: dict[int, dict] = {}
+        self._desc_ends = array("I")
+        self._desc = ""
+        # (cat_id, sub_id) → (start, end); порядок подкатегорий внутри категории
+        self.ranges: dict[tuple[int, int], tuple[int, int]] = {}
+        self.cat_subs: list[list[int]] = []
+
+        # Порядок категорий/подкатегорий — как при последовательном extend слоёв
+        grouped: dict[str, dict[str, list[tuple[int, dict]]]] = {}
+        for layer_no, layer in enumerate(layers):
+            for cat, subs in (layer or {}).items():
+                for sub, items in subs.items():
+                    bucket = grouped.setdefault(cat, {}).setdefault(sub, [])
+                    bucket.extend((layer_no, it) for it in items)
+
+        sub_index: dict[str, int] = {}
+        desc_parts: list[str] = []
+        end = 0
+        for cat, subs in grouped.items():
+            cat_id = len(self.categories)
+            self.categories.append(cat)
+            self.cat_subs.append([])
+            for sub, bucket in subs.items():
+                sub_id = sub_index.setdefault(sub, len(self.subcategories))
+                if sub_id == len(self.subcategories):
+                    self.subcategories.append(sub)
+                start = len(self.prices)
+                for layer_no, it in bucket:
+                    row = len(self.prices)
+                    self.cat_ids.append(cat_id)
+                    self.sub_ids.append(sub_id)
+                    self.layers.append(layer_no)
+                    price = it.get("price", "")
+                    if type(price) is int and _NO_PRICE < price < 2 ** 63:
+                        self.prices.append(price)
+                    else:
+                        self.prices.append(_NO_PRICE)
+                        self.price_raw[row] = price
+                    extra = {k: v for k, v in it.items() if k not in ("desc", "price")}
+                    if extra:
+                        self.extras[row] = extra
+                    desc = str(it.get("desc", ""))
+                    desc_parts.append(desc)
+                    end += len(desc)
+                    self._desc_ends.append(end)
+                self.ranges[(cat_id, sub_id)] = (start, len(self.prices))
+                self.cat_subs[cat_id].append(sub_id)
+        self._desc = "".join(desc_parts)
+        self._cat_index = {name: i for i, name in enumerate(self.categories)}
+        self._sub_index = sub_index
+        # Готовые клавиатуры навигации этой версии (см. _categories_markup)
+        self.markups: dict = {}
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    def __bool__(self) -> bool:
+        return bool(self.categories)
+
+    def desc_at(self, row: int) -> str:
+        start = self._desc_ends[row - 1] if row else 0
+        return self._desc[start:self._desc_ends[row]]
+
+    def price_at(self, row: int):
+        price = self.prices[row]
+        return self.price_raw.get(row, "") if price == _NO_PRICE else price
+
+    def category_counts(self) -> dict[str, int]:
+        """Категория → число товаров (в порядке объединения)."""
+        counts = {}
+        for cat_id, cat in enumerate(self.categories):
+            counts[cat] = sum(
+                self.ranges[(cat_id, s)][1] - self.ranges[(cat_id, s)][0] for s in self.cat_subs[cat_id]
+            )
+        return counts
+
+    def subcategory_counts(self, cat: str) -> dict[str, int]:
+        """Подкатегория → число товаров для категории (пусто, если категории нет)."""
+        cat_id = self._cat_index.get(cat)
+        if cat_id is None:
+            return {}
+        result = {}
+        for sub_id in self.cat_subs[cat_id]:
+            start, end = self.ranges[(cat_id, sub_id)]
+            result[self.subcategories[sub_id]] = end - start
+        return result
+
+    def items(self, cat: str, sub: str) -> list[CatalogItem]:
+        key = (self._cat_index.get(cat), self._sub_index.get(sub))
+        start, end = self.ranges.get(key, (0, 0))
+        return [CatalogItem(self, row) for row in range(start, end)]
+
+    def row_spans(self, cat: str | None = None, sub: str | None = None) -> list[tuple[int, int]]:
+        """Диапазоны строк всего каталога, категории или подкатегории (пусто, если их нет)."""
+        if cat is None:
+            return [(0, len(self.prices))]
+        cat_id = self._cat_index.get(cat)
+        if cat_id is None:
+            return []
+        if sub is None:
+            return [self.ranges[(cat_id, sub_id)] for sub_id in self.cat_subs[cat_id]]
+        span = self.ranges.get((cat_id, self._sub_index.get(sub)))
+        return [span] if span else []
+
+    def iter_rows(self):
+        """(категория, подкатегория, товар) по всем строкам в порядке каталога."""
+        for row in range(len(self.prices)):
+            yield (
+                self.categories[self.cat_ids[row]],
+                self.subcategories[self.sub_ids[row]],
+                CatalogItem(self, row),
+            )
+
+
+def _get_catalog_store(context) -> ColumnarCatalog:
+    """Колоночный снимок каталога, строится один раз на версию (без deepcopy слоёв)."""
+    bot_data = context.application.bot_data
+    version = _catalog_version(context)
+    store = bot_data.get("catalog_store")
+    if store is None or store.version != version:
+        store = ColumnarCatalog(
+            [bot_data.get("catalog"), bot_data.get("moved_overrides"), bot_data.get("manual_categories")],
+            version,
+        )
+        bot_data["catalog_store"] = store
+    return store
+
+
+def _categories_markup(store: ColumnarCatalog) -> InlineKeyboardMarkup | None:
+    """
+    Клавиатура корня каталога: строится один раз на версию (снимок неизменяем)
+    и переиспользуется — InlineKeyboardMarkup в PTB тоже неизменяемый. None — каталог пуст.
+    """
+    markup = store.markups.get("root")
+    if markup is None and store:
+        counts = store.category_counts()
+        markup = store.markups["root"] = InlineKeyboardMarkup([
+            [InlineKeyboardButton(text=f"{cat_name} ({counts[cat_name]})", callback_data=f"cat|{cat_name}")]
+            for cat_name in _sort_categories(list(counts))
+        ])
+    return markup
+
+
+def _subcategories_markup(store: ColumnarCatalog, cat: str, back: str) -> InlineKeyboardMarkup:
+    """Подкатегории с количеством + «← Назад» (back — callback_data кнопки); кэш на версию."""
+    key = ("cat", cat, back)
+    markup = store.markups.get(key)
+    if markup is None:
+        buttons = [
+            [InlineKeyboardButton(text=f"{sub_name} ({count})", callback_data=f"sub|{cat}|{sub_name}")]
+            for sub_name, count in store.subcategory_counts(cat).items()
+        ]
+        buttons.append([InlineKeyboardButton(text="← Назад", callback_data=back)])
+        markup = InlineKeyboardMarkup(buttons)
+        # Несуществующую категорию (устаревшая кнопка) не кэшируем
+        if cat in store._cat_index:
+            store.markups[key] = markup
+    return markup
+
+
+# -------------------------------------------------------------------
+# Общий снимок каталога для нескольких процессов-воркеров
+# -------------------------------------------------------------------
+# Если задан CATALOG_SHARED_DIR, каждое изменение каталога публикуется как
+# неизменяемый файл catalog-v<версия>.json, а указатель CURRENT хранит номер
+# последней версии. Воркеры (реплики вебхука) раз в SHARED_POLL_INTERVAL
+# секунд делают stat указателя и подхватывают новую версию. Все записи идут
+# через catalog_writer(): файловая блокировка + обновление до последней версии.
+SHARED_CATALOG_DIR: str | None = os.getenv("CATALOG_SHARED_DIR") or None
+SHARED_POLL_INTERVAL = float(os.getenv("CATALOG_SHARED_POLL", "1.0"))
+SHARED_SNAPSHOTS_KEEP = 5
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировки между процессами нет, только один воркер
+    fcntl = None
+
+
+def _shared_path(name: str) -> Path:
+    return Path(SHARED_CATALOG_DIR) / name
+
+
+def _read_shared_version() -> int:
+    try:
+        return int(_shared_path("CURRENT").read_text(encoding="utf-8").strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _atomic_write_bytes(path: Path, data: bytes) -> None:
+    """Пишем во временный файл рядом и переименовываем: читатели видят файл целиком."""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+def _atomic_write_text(path: Path, text: str) -> None:
+    _atomic_write_bytes(path, text.encode("utf-8"))
+
+
+def _publish_shared_snapshot(bot_data: dict, version: int) -> None:
+    """Публикует слои каталога как неизменяемую версию и переключает CURRENT."""
+    payload = {
+        "version": version,
+        "catalog": bot_data.get("catalog") or {},
+        "moved_overrides": bot_data.get("moved_overrides") or {},
+        "manual_categories": bot_data.get("manual_categories") or {},
+    }
+    _atomic_write_text(_shared_path(f"catalog-v{version:08d}.json"), json.dumps(payload, ensure_ascii=False))
+    _atomic_write_text(_shared_path("CURRENT"), str(version))
+    # Старые версии больше никто не откроет: воркеры читают только CURRENT
+    old = sorted(_shared_path("").glob("catalog-v*.json"))[:-SHARED_SNAPSHOTS_KEEP]
+    for p in old:
+        try:
+            p.unlink()
+        except OSError:
+            pass
+
+
+def _load_shared_snapshot(bot_data: dict, version: int) -> bool:
+    try:
+        with open(_shared_path(f"catalog-v{version:08d}.json"), "r", encoding="utf-8") as f:
+            payload = json.load(f)
+    except (OSError, ValueError):
+        return False
+    bot_data["catalog"] = payload.get("catalog") or {}
+    bot_data["moved_overrides"] = payload.get("moved_overrides") or {}
+    bot_data["manual_categories"] = payload.get("manual_categories") or {}
+    bot_data["catalog_version"] = version
+    bot_data.pop("search_index", None)
+    bot_data.pop("catalog_store", None)
+    return True
+
+
+def _refresh_shared_catalog(bot_data: dict, force: bool = False) -> None:
+    """Дешёвый опрос: не чаще раза в SHARED_POLL_INTERVAL — один stat указателя."""
+    if not SHARED_CATALOG_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - bot_data.get("shared_polled_at", 0.0) < SHARED_POLL_INTERVAL:
+        return
+    bot_data["shared_polled_at"] = now
+    try:
+        stamp = os.stat(_shared_path("CURRENT")).st_mtime_ns
+    except OSError:
+        return
+    if not force and stamp == bot_data.get("shared_stamp"):
+        return
+    version = _read_shared_version()
+    if version > bot_data.get("catalog_version", 0) and not _load_shared_snapshot(bot_data, version):
+        return  # снимок ещё не дописан/удалён — повторим на следующем опросе
+    bot_data["shared_stamp"] = stamp
+
+
+def _acquire_writer_lock():
+    """Блокирующий flock на файле writer.lock (вызывать в потоке)."""
+    fd = open(_shared_path("writer.lock"), "a+")
+    if fcntl is not None:
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+    return fd
+
+
+def _release_writer_lock(fd) -> None:
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_UN)
+    finally:
+        fd.close()
+
+
+@contextlib.asynccontextmanager
+async def catalog_writer(context):
+    """
+    Единственный писатель каталога (auto / moved / manual).
+
+    Апдейты обрабатываются параллельно, поэтому изменения слоёв сериализуются
+    asyncio.Lock процесса (не реентерабельный — писатели не вкладываются друг в друга).
+    Читатели блокировку не берут: они работают с неизменяемым снимком версии
+    (_get_catalog_store), а версия меняется только внутри писателя.
+
+    В общем режиме дополнительно держит файловую блокировку, перед изменением
+    подтягивает последнюю опубликованную версию, а при выходе публикует новую,
+    если внутри был вызван _bump_catalog_version.
+    """
+    bot_data = context.application.bot_data
+    lock = bot_data.get("catalog_lock")
+    if lock is None:
+        lock = bot_data["catalog_lock"] = asyncio.Lock()
+    async with lock:
+        if not SHARED_CATALOG_DIR:
+            yield
+            return
+        lock_fd = await asyncio.to_thread(_acquire_writer_lock)
+        try:
+            _refresh_shared_catalog(bot_data, force=True)
+            base_version = bot_data.get("catalog_version", 0)
+            yield
+            if bot_data.get("catalog_version", 0) != base_version:
+                version = max(_read_shared_version(), base_version) + 1
+                _publish_shared_snapshot(bot_data, version)
+                bot_data["catalog_version"] = version
+                bot_data.pop("search_index", None)
+                bot_data.pop("catalog_store", None)
+        finally:
+            _release_writer_lock(lock_fd)
+
+
+def _init_shared_catalog(bot_data: dict) -> None:
+    """Старт воркера: берём последнюю версию или публикуем первую из JSON-файлов."""
+    Path(SHARED_CATALOG_DIR).mkdir(parents=True, exist_ok=True)
+    lock_fd = _acquire_writer_lock()
+    try:
+        version = _read_shared_version()
+        if not (version and _load_shared_snapshot(bot_data, version)):
+            version = max(version, 0) + 1
+            _publish_shared_snapshot(bot_data, version)
+            bot_data["catalog_version"] = version
+    finally:
+        _release_writer_lock(lock_fd)
+
+
+# Частые русские написания брендов/моделей → латиница, как в описаниях товаров
+SEARCH_SYNONYMS: dict[str, str] = {
+    "айфон": "iphone",
+    "айпад": "ipad",
+    "макбук": "macbook",
+    "аирподс": "airpods",
+    "эйрподс": "airpods",
+    "эирподс": "airpods",
+    "эпл": "apple",
+    "эппл": "apple",
+    "епл": "apple",
+    "про": "pro",
+    "макс": "max",
+    "мини": "mini",
+    "плюс": "plus",
+    "ультра": "ultra",
+    "эйр": "air",
+    "самсунг": "samsung",
+    "галакси": "galaxy",
+    "сяоми": "xiaomi",
+    "ксиаоми": "xiaomi",
+    "редми": "redmi",
+    "поко": "poco",
+    "хонор": "honor",
+    "хуавей": "huawei",
+    "пиксель": "pixel",
+    "дайсон": "dyson",
+    "джибиэль": "jbl",
+    "маршал": "marshall",
+    "гопро": "gopro",
+    "плейстейшн": "playstation",
+    "вотч": "watch",
+}
+
+_SEARCH_TOKEN_RE = re.compile(r"[a-zа-яё0-9+]+")
+
+
+def _normalize_search_text(text: str) -> str:
+    """Нижний регистр + разделение «буквы|цифры» (iphone15 → iphone 15), как в поиске."""
+    s = str(text or "").lower()
+    s = re.sub(r"([a-zа-яё])(\d)", r"\1 \2", s)
+    s = re.sub(r"(\d)([a-zа-яё])", r"\1 \2", s)
+    return s
+
+
+def _search_tokens(text: str) -> list[str]:
+    return _SEARCH_TOKEN_RE.findall(_normalize_search_text(text))
+
+
+# Фильтры запроса: cat:Телефоны brand:Apple (или кат:/бренд:), значение с пробелами — в кавычках
+_SEARCH_FILTER_RE = re.compile(r'(?<!\S)(cat|brand|кат|бренд):(?:"([^"]*)"|(\S+))', re.IGNORECASE)
+_SEARCH_FILTER_NAMES = {"cat": "cat", "кат": "cat", "brand": "brand", "бренд": "brand"}
+# Ранжированная выдача ограничена лучшими SEARCH_TOP_K позициями
+SEARCH_TOP_K = 300
+BM25_K1 = 1.2
+BM25_B = 0.75
+# BM25F: слово из названия категории/подкатегории весит меньше слова из описания
+BM25_FIELD_WEIGHT = 0.5
+
+
+class SearchQuery(NamedTuple):
+    text: str           # свободные слова без фильтров
+    cat: str | None     # фильтр категории, нижний регистр
+    brand: str | None   # фильтр подкатегории (бренда), нижний регистр
+
+    @property
+    def key(self) -> str:
+        """Ключ кэша: одинаковый у запросов с одинаковой выдачей."""
+        return "\x1f".join((_normalize_search_text(self.text.strip()), self.cat or "", self.brand or ""))
+
+    def allows(self, cat: str, sub: str) -> bool:
+        """Фильтр совпадает с именем целиком или с его началом (cat:телеф → Телефоны)."""
+        return (
+            (self.cat is None or cat.lower().startswith(self.cat))
+            and (self.brand is None or sub.lower().startswith(self.brand))
+        )
+
+
+def _parse_search_query(raw: str) -> SearchQuery:
+    filters: dict[str, str] = {}
+
+    def take(match: re.Match) -> str:
+        value = (match.group(2) if match.group(2) is not None else match.group(3)).strip().lower()
+        if value:
+            filters[_SEARCH_FILTER_NAMES[match.group(1).lower()]] = value
+        return " "
+
+    text = _SEARCH_FILTER_RE.sub(take, str(raw or ""))
+    return SearchQuery(" ".join(text.split()), filters.get("cat"), filters.get("brand"))
+
+
+def _trigrams(token: str) -> set[str]:
+    padded = f"${token}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _max_typos(token: str) -> int:
+    """Допустимое число опечаток: короткие слова и числа — только точно."""
+    if token.isdigit() or len(token) <= 3:
+        return 0
+    if len(token) <= 5:
+        return 1
+    return 2
+
+
+def _bounded_damerau(a: str, b: str, limit: int) -> int | None:
+    """Расстояние Дамерау–Левенштейна (OSA) с отсечкой: None, если больше limit."""
+    if abs(len(a) - len(b)) > limit:
+        return None
+    prev2: list[int] = []
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        row_min = cur[0]
+        ca = a[i - 1]
+        for j in range(1, len(b) + 1):
+            cb = b[j - 1]
+            cost = 0 if ca == cb else 1
+            v = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                v = min(v, prev2[j - 2] + 1)
+            cur[j] = v
+            if v < row_min:
+                row_min = v
+        if row_min > limit:
+            return None
+        prev2, prev = prev, cur
+    return prev[-1] if prev[-1] <= limit else None
+
+
+class CatalogSearchIndex:
+    """
+    Индекс колоночного снимка каталога (одна версия).
+
+    items      — плоский список (категория, подкатегория, товар);
+    norm_descs — описания после _normalize_search_text (поиск по подстроке);
+    postings   — токен описания, подкатегории или категории → номера товаров;
+    grams      — триграмма → токены словаря (кандидаты для нечёткого поиска);
+    bm25_len   — k1 × нормировка длины товара (описание + BM25_FIELD_WEIGHT × название категории);
+    field_desc — токен названия категории/подкатегории → товары, у которых он есть
+                 и в описании (array по возрастанию): tf такого слова 1 + вес поля, а не только вес поля;
+    brands, categories — имена подкатегорий (нижний регистр) и категорий.
+    """
+
+    def __init__(self, store: ColumnarCatalog):
+        self.version = store.version
+        self.items: list[tuple[str, str, dict]] = []
+        self.norm_descs: list[str] = []
+        self.postings: dict[str, list[int]] = {}
+        self.grams: dict[str, list[str]] = {}
+        self.field_desc: dict[str, array] = {}
+        # (категория, подкатегория) → tf слов её названия
+        self._field_tf: dict[tuple[str, str], Counter] = {}
+        lengths: list[float] = []
+        for item_id, (cat, sub, item) in enumerate(store.iter_rows()):
+            norm = _normalize_search_text(item.desc)
+            self.items.append((cat, sub, item))
+            self.norm_descs.append(norm)
+            # Бренд и категория — тоже слова товара: «apple iphone 15» при описании «iPhone 15 …»
+            desc_tokens = _SEARCH_TOKEN_RE.findall(norm)
+            field = self._field_tf.get((cat, sub))
+            if field is None:
+                field = self._field_tf[(cat, sub)] = Counter(_search_tokens(f"{cat} {sub}"))
+            lengths.append(len(desc_tokens) + BM25_FIELD_WEIGHT * sum(field.values()))
+            desc_set = set(desc_tokens)
+            for tok in desc_set.union(field):
+                self.postings.setdefault(tok, []).append(item_id)
+            for tok in desc_set.intersection(field):
+                self.field_desc.setdefault(tok, array("I")).append(item_id)
+        self.field_vocab = {tok for field in self._field_tf.values() for tok in field}
+        self.brands = {sub.lower() for _, sub, _ in self.items}
+        self.categories = {cat for cat, _, _ in self.items}
+        avg_len = sum(lengths) / len(lengths) if lengths else 1.0
+        self.bm25_len = [BM25_K1 * (1 - BM25_B + BM25_B * n / avg_len) for n in lengths]
+        for tok in self.postings:
+            if _max_typos(tok):
+                for g in _trigrams(tok):
+                    self.grams.setdefault(g, []).append(tok)
+        self._synonym_grams: dict[str, list[str]] = {}
+        for word in SEARCH_SYNONYMS:
+            for g in _trigrams(word):
+                self._synonym_grams.setdefault(g, []).append(word)
+
+    @staticmethod
+    def _fuzzy_lookup(token: str, grams: dict[str, list[str]]) -> dict[str, int]:
+        """Кандидаты по общим триграммам + проверка ограниченным расстоянием правки."""
+        limit = _max_typos(token)
+        if not limit:
+            return {}
+        q_grams = _trigrams(token)
+        # Каждая правка портит не более трёх триграмм (q-gram lemma)
+        need = max(1, len(q_grams) - 3 * limit)
+        counts: dict[str, int] = {}
+        for g in q_grams:
+            for cand in grams.get(g, ()):
+                counts[cand] = counts.get(cand, 0) + 1
+        found: dict[str, int] = {}
+        for cand, shared in counts.items():
+            if shared < need:
+                continue
+            dist = _bounded_damerau(token, cand, min(limit, _max_typos(cand)))
+            if dist is not None:
+                found[cand] = dist
+        return found
+
+    def _expand_token(self, token: str) -> dict[str, int]:
+        """Токен запроса → {токен словаря: штраф}."""
+        variants: dict[str, int] = {}
+        if token in self.postings:
+            variants[token] = 0
+        # Русское написание бренда: точное или с опечаткой («айфн» → «айфон» → iphone)
+        synonyms = {token: 0} if token in SEARCH_SYNONYMS else self._fuzzy_lookup(token, self._synonym_grams)
+        for word, dist in synonyms.items():
+            latin = SEARCH_SYNONYMS[word]
+            if latin in self.postings and variants.get(latin, dist + 1) > dist:
+                variants[latin] = dist
+            for cand, d in self._fuzzy_lookup(latin, self.grams).items():
+                if variants.get(cand, dist + d + 1) > dist + d:
+                    variants[cand] = dist + d
+        if token not in self.postings:
+            for cand, dist in self._fuzzy_lookup(token, self.grams).items():
+                if variants.get(cand, dist + 1) > dist:
+                    variants[cand] = dist
+        return variants
+
+    def _idf(self, token: str) -> float:
+        df = len(self.postings[token])
+        return math.log(1 + (len(self.items) - df + 0.5) / (df + 0.5))
+
+    def _tf(self, token: str, item_id: int) -> float:
+        """tf слова у товара: 1 за описание (повторы в описаниях редки) + вес поля за название категории."""
+        cat, sub, _ = self.items[item_id]
+        field = self._field_tf[(cat, sub)].get(token, 0)
+        if not field:
+            return 1.0
+        in_desc = self.field_desc.get(token, ())
+        pos = bisect.bisect_left(in_desc, item_id)
+        return (pos < len(in_desc) and in_desc[pos] == item_id) + BM25_FIELD_WEIGHT * field
+
+    def ranked_search(self, query: SearchQuery, k: int | None = SEARCH_TOP_K) -> tuple[list[int], int]:
+        """
+        (номера товаров, всего совпадений): товары, у которых есть все слова запроса
+        (пересечение списков, начиная с самого короткого), по убыванию BM25F; лучшие k — через кучу.
+        Слова, которых нет ни в одном названии категории, у всех кандидатов имеют tf 1 —
+        их вклад считается сразу суммой idf; tf остальных зависит от того, нашлось слово
+        в описании или только в категории («apple» в описании выше, чем только бренд Apple).
+        """
+        tokens = []
+        for tok in dict.fromkeys(_search_tokens(query.text)):
+            tok = tok if tok in self.postings else SEARCH_SYNONYMS.get(tok, tok)
+            if tok not in self.postings:
+                return [], 0
+            tokens.append(tok)
+        if not tokens:
+            return [], 0
+        tokens.sort(key=lambda t: len(self.postings[t]))
+        ids = set(self.postings[tokens[0]])
+        for tok in tokens[1:]:
+            ids.intersection_update(self.postings[tok])
+            if not ids:
+                return [], 0
+        if query.cat is not None or query.brand is not None:
+            ids = {i for i in ids if query.allows(self.items[i][0], self.items[i][1])}
+        plain = sum(self._idf(t) for t in tokens if t not in self.field_vocab) * (BM25_K1 + 1)
+        fielded = [(t, self._idf(t) * (BM25_K1 + 1)) for t in tokens if t in self.field_vocab]
+        lens = self.bm25_len
+
+        def key(i: int) -> tuple[float, int]:
+            score = plain / (1 + lens[i])
+            for tok, weight in fielded:
+                tf = self._tf(tok, i)
+                score += weight * tf / (tf + lens[i])
+            return score, -i
+        if k is None or len(ids) <= k:
+            return sorted(ids, key=key, reverse=True), len(ids)
+        return heapq.nlargest(k, ids, key=key), len(ids)
+
+    def fuzzy_search(self, query: str) -> list[tuple[str, str, dict]]:
+        """Все токены запроса должны найтись (с опечатками); сортировка по сумме правок."""
+        tokens = _search_tokens(query)
+        if not tokens:
+            return []
+        scores: dict[int, int] | None = None
+        for tok in tokens:
+            token_hits: dict[int, int] = {}
+            for cand, dist in self._expand_token(tok).items():
+                for item_id in self.postings[cand]:
+                    if dist < token_hits.get(item_id, dist + 1):
+                        token_hits[item_id] = dist
+            if not token_hits:
+                return []
+            if scores is None:
+                scores = token_hits
+            else:
+                scores = {i: s + token_hits[i] for i, s in scores.items() if i in token_hits}
+                if not scores:
+                    return []
+        ranked = sorted(scores, key=lambda i: (scores[i], i))
+        return [self.items[i] for i in ranked]
+
+
+def _get_search_index(context) -> CatalogSearchIndex:
+    """Индекс строится один раз на версию каталога и хранится в bot_data."""
+    bot_data = context.application.bot_data
+    index = bot_data.get("search_index")
+    if index is None or index.version != _catalog_version(context):
+        index = CatalogSearchIndex(_get_catalog_store(context))
+        bot_data["search_index"] = index
+    return index
+
+
+def _search_catalog(
+    context, raw: str, limit: int | None = SEARCH_TOP_K
+) -> tuple[list[tuple[str, str, dict]], bool]:
+    """Поиск по объединённому каталогу: (результаты, был ли нечёткий поиск)."""
+    results, fuzzy, _ = _run_search(context, raw, limit)
+    return results, fuzzy
+
+
+def _run_search(
+    context, raw: str, limit: int | None = SEARCH_TOP_K
+) -> tuple[list[tuple[str, str, dict]], bool, int]:
+    """
+    (результаты, был ли нечёткий поиск, всего совпадений — до обрезки до limit).
+
+    Без фильтров сначала — как в исходном поиске: «macbook» → Ноутбуки/Apple, точное
+    имя бренда, имя категории. Дальше: все слова запроса (в любом порядке) с ранжированием
+    по BM25 и не больше limit позиций; подстрока в описании; нечёткий поиск по индексу.
+    Фильтры cat:/brand: сужают каждый шаг; запрос из одних фильтров — весь их срез.
+    """
+    index = _get_search_index(context)
+    query = _parse_search_query(raw)
+    q = _normalize_search_text(query.text.strip())
+    filtered = query.cat is not None or query.brand is not None
+
+    if not filtered:
+        if q.replace(" ", "").startswith("macbook"):
+            results = [r for r in index.items if r[0] == "Ноутбуки" and r[1] == "Apple"]
+            return results, False, len(results)
+
+        if q in index.brands:
+            results = [r for r in index.items if r[1].lower() == q]
+            return results, False, len(results)
+
+        matched_cats = {
+            cat for cat in index.categories
+            if cat.lower() == q or cat.lower().startswith(q) or q.startswith(cat.lower())
+        }
+        if matched_cats:
+            results = [r for r in index.items if r[0] in matched_cats]
+            return results, False, len(results)
+    elif not q:
+        results = [r for r in index.items if query.allows(r[0], r[1])]
+        return results, False, len(results)
+
+    ranked, total = index.ranked_search(query, limit)
+    if ranked:
+        return [index.items[i] for i in ranked], False, total
+
+    results = [
+        r for r, d in zip(index.items, index.norm_descs)
+        if q in d and (not filtered or query.allows(r[0], r[1]))
+    ]
+    if results:
+        return results, False, len(results)
+    results = index.fuzzy_search(query.text)
+    if filtered:
+        results = [r for r in results if query.allows(r[0], r[1])]
+    return results, bool(results), len(results)
+
+
+
+# -------------------------------------------------------------------
+# Кэш отрисованных результатов поиска (LRU с учётом размера в байтах)
+# -------------------------------------------------------------------
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+SEARCH_MESSAGE_MAX_LEN = 4000
+SEARCH_PAGE_SIZE = 10
+# Сколько последних выдач помнить для листания (старые кнопки отвечают «повторите поиск»)
+SEARCH_SESSIONS_MAX = 2000
+
+
+class SearchResultCache:
+    """
+    Нормализованный запрос → готовые сообщения ответа (заголовок, HTML-куски).
+    Размер считается в байтах UTF-8; при смене версии каталога кэш очищается целиком,
+    поэтому любая правка каталога его инвалидирует. Ответы крупнее 1/8 бюджета
+    не кэшируются, чтобы один запрос вида «а» не вытеснял всё остальное.
+    """
+
+    def __init__(self, max_bytes: int = SEARCH_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.version: int | None = None
+        self.entries: OrderedDict[str, tuple[tuple[str, ...], int]] = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _sync_version(self, version: int) -> None:
+        if version == self.version:
+            return
+        if self.entries:
+            self.invalidations += 1
+        self.entries.clear()
+        self.bytes = 0
+        self.version = version
+
+    def get(self, query: str, version: int) -> tuple[str, ...] | None:
+        self._sync_version(version)
+        entry = self.entries.get(query)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(query)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, query: str, version: int, messages: tuple[str, ...]) -> None:
+        self._sync_version(version)
+        size = len(query.encode()) + sum(len(m.encode()) for m in messages)
+        if size > self.max_bytes // 8:
+            return
+        old = self.entries.pop(query, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self.entries[query] = (messages, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def format_stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = f"{self.hits / total:.0%}" if total else "—"
+        return (
+            f"Кэш поиска: {len(self.entries)} запросов, "
+            f"{self.bytes / 1024:.0f} из {self.max_bytes / 1024:.0f} КБ\n"
+            f"Попаданий: {self.hits}, промахов: {self.misses} (hit rate {ratio})\n"
+            f"Вытеснено: {self.evictions}, сбросов по версии каталога: {self.invalidations}"
+        )
+
+
+def _get_search_cache(context) -> SearchResultCache:
+    bot_data = context.application.bot_data
+    cache = bot_data.get("search_cache")
+    if cache is None:
+        cache = bot_data["search_cache"] = SearchResultCache()
+    return cache
+
+
+def _render_search_results(
+    results: list[tuple[str, str, dict]], fuzzy: bool, total: int | None = None
+) -> tuple[str, ...]:
+    """
+    (заголовок, HTML-страницы): на странице до SEARCH_PAGE_SIZE позиций и не больше
+    SEARCH_MESSAGE_MAX_LEN символов; без результатов — только заголовок.
+    total — сколько всего совпадений, если results обрезаны до лучших.
+    """
+    if not results:
+        return ("Ничего не найдено по вашему запросу.",)
+    total = max(total or 0, len(results))
+    if fuzzy:
+        header = f"Точных совпадений нет. Возможно, вы искали (позиций: {total}):"
+    else:
+        header = f"Найдено позиций: {total}"
+    if total > len(results):
+        header += f", показаны лучшие {len(results)}"
+
+    # Запас под заголовок, который выводится над каждой страницей
+    limit = SEARCH_MESSAGE_MAX_LEN - len(header) - 2
+    pages = []
+    current = ""
+    count = 0
+    for cat, sub, item in results:
+        desc = html.escape(str(item["desc"]))
+        price = str(item.get("price", "")).strip()
+        line = f"<b>{desc}</b>"
+        if price:
+            line += f" — <i>{html.escape(price)} ₽</i>"
+        segment = f"{line}\n<i>{cat} / {sub}</i>\n\n"
+        if current and (count == SEARCH_PAGE_SIZE or len(current) + len(segment) > limit):
+            pages.append(current)
+            current, count = "", 0
+        current += segment
+        count += 1
+    if current:
+        pages.append(current)
+    return (header, *pages)
+
+
+def _search_messages(context, raw: str) -> tuple[str, ...]:
+    """Ответ на поисковый запрос через кэш; ключ — запрос в том виде, в каком его ищет _search_catalog."""
+    cache = _get_search_cache(context)
+    key = _parse_search_query(raw).key
+    version = _catalog_version(context)
+    messages = cache.get(key, version)
+    if messages is None:
+        messages = _render_search_results(*_run_search(context, raw))
+        cache.put(key, version, messages)
+    return messages
+
+
+def _search_sessions(context) -> OrderedDict:
+    """Токен выдачи → её сообщения (тот же кортеж, что и в кэше поиска, без копирования)."""
+    bot_data = context.application.bot_data
+    sessions = bot_data.get("search_sessions")
+    if sessions is None:
+        sessions = bot_data["search_sessions"] = OrderedDict()
+    return sessions
+
+
+def _store_search_results(context, messages: tuple[str, ...]) -> str:
+    """Сохраняет выдачу под коротким случайным токеном для кнопок «srch|токен|страница»."""
+    sessions = _search_sessions(context)
+    token = secrets.token_urlsafe(6)
+    sessions[token] = messages
+    while len(sessions) > SEARCH_SESSIONS_MAX:
+        sessions.popitem(last=False)
+    return token
+
+
+def _search_page(token: str, messages: tuple[str, ...], page: int) -> tuple[str, InlineKeyboardMarkup]:
+    """Текст страницы page (с заголовком выдачи) и кнопки листания."""
+    header, pages = messages[0], messages[1:]
+    page = max(0, min(page, len(pages) - 1))
+    nav = []
+    if len(pages) > 1:
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"srch|{token}|{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{len(pages)}", callback_data=f"srch|{token}|-"))
+        if page < len(pages) - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"srch|{token}|{page + 1}"))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton("← Назад", callback_data="back|root")])
+    return f"{html.escape(header)}\n\n{pages[page]}", InlineKeyboardMarkup(rows)
+
+
+async def handle_search_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """srch|токен|страница — листание сохранённой выдачи: один editMessageText, без повторного поиска."""
+    query = update.callback_query
+    _, token, page = query.data.split("|", 2)
+    if page == "-":
+        await query.answer()
+        return
+    if await _rate_limited(update, context, "browse"):
+        return
+    messages = _search_sessions(context).get(token)
+    if messages is None:
+        await query.answer("Результаты поиска устарели — повторите поиск.", show_alert=True)
+        return
+    _search_sessions(context).move_to_end(token)
+    await query.answer()
+    text, markup = _search_page(token, messages, int(page))
+    await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+
+async def search_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /search_stats — размер и эффективность кэша поиска (только админ)."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id or not is_admin(user_id):
+        await update.message.reply_text("Извините, команда доступна только администратору.")
+        return
+    await update.message.reply_text(_get_search_cache(context).format_stats())
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         # При /start отменяем все промежуточные шаги ручного ввода
     for key in [
@@ -228,6 +1352,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "manualprod_brand",
         "manualprod_select_map",
         "manualprod_del_map",
+        "manualprod_shown",
         "change_step",
         "change_cat",
         "change_sub",
@@ -237,6 +1362,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "manualprice_cat",
         "manualprice_brand",
         "manualprice_indices",
+        "manualprice_picks",
+        "manualprice_shown",
         "manualprice_select_map",
     ]:
         context.user_data.pop(key, None)
@@ -253,236 +1380,215 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(greet_text, reply_markup=get_main_menu_markup(is_admin_user))
 
     # Показать каталог, если он уже был загружен администратором
-    # Используем объединённый каталог
-    full_catalog = get_full_catalog(context)
-    if full_catalog:
-        buttons = []
-        for cat_name in _sort_categories(list(full_catalog.keys())):
-            subdict = full_catalog[cat_name]
-            count = sum(len(items) for items in subdict.values())
-            buttons.append([InlineKeyboardButton(text=f"{cat_name} ({count})", callback_data=f"cat|{cat_name}")])
-        markup = InlineKeyboardMarkup(buttons)
+    # Клавиатура категорий — готовая для текущей версии каталога
+    markup = _categories_markup(_get_catalog_store(context))
+    if markup:
         await update.message.reply_text("Выберите категорию:", reply_markup=markup)
     else:
         await update.message.reply_text("Каталог пока не загружен. Пожалуйста, попробуйте позже.")
 
 
 # -------------------------------------------------------------------
-# Правила классификации категорий и брендов (обновлено)
+# Правила классификации категорий и брендов (classification_rules.json)
 # -------------------------------------------------------------------
+# Каскад правил, бренды и ключевые слова категорий лежат в файле данных:
+# новый бренд или правило — правка файла и /reload_rules, без перезапуска.
+#
+# Правило (проверяются по порядку, срабатывает первое; текст — в нижнем регистре):
+#   name       — имя для отчётов;
+#   category   — категория результата;
+#   when       — регулярка (re.search) ИЛИ when_any — список подстрок
+#                (bounded: true — подстрока не должна быть частью слова);
+#   also       — регулярка, которая тоже должна найтись (необязательно);
+#   unless     — регулярка, которой не должно быть (необязательно);
+#   brand      — фиксированный бренд, ИЛИ brand_map — свой список «подстрока → бренд»,
+#                иначе бренд ищется по общему списку brands (первое совпадение по порядку).
+# Если ни одно правило не сработало: категория — по category_keywords,
+# бренд — по первому слову описания или по вхождению из brands.
+# Необязательный examples — [[описание, категория, бренд], ...]: проверяются при загрузке.
+# Файл правил поставляется вместе с кодом, поэтому путь — рядом с модулем
+CLASSIFICATION_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "classification_rules.json")
+
+_WORD_EDGE_BEFORE = r"(?<![а-яa-z0-9])"
+_WORD_EDGE_AFTER = r"(?![а-яa-z0-9])"
+
+
+class RulesetError(ValueError):
+    """Файл правил не прошёл проверку; в args — список ошибок."""
+
+
+class ClassificationRule:
+    __slots__ = ("name", "category", "when", "also", "unless", "brand", "brand_map", "default_brand")
+
+    def __init__(self, spec: dict, default_brand: str):
+        self.name = spec["name"]
+        self.category = spec["category"]
+        if "when_any" in spec:
+            body = "|".join(re.escape(kw) for kw in spec["when_any"])
+            if spec.get("bounded"):
+                body = f"{_WORD_EDGE_BEFORE}(?:{body}){_WORD_EDGE_AFTER}"
+            self.when = re.compile(body)
+        else:
+            self.when = re.compile(spec["when"])
+        self.also = re.compile(spec["also"]) if spec.get("also") else None
+        self.unless = re.compile(spec["unless"]) if spec.get("unless") else None
+        self.brand = spec.get("brand")
+        self.brand_map = list(spec["brand_map"].items()) if spec.get("brand_map") else None
+        self.default_brand = spec.get("default_brand", default_brand)
+
+    def matches(self, desc_low: str) -> bool:
+        return (
+            self.when.search(desc_low) is not None
+            and (self.also is None or self.also.search(desc_low) is not None)
+            and (self.unless is None or self.unless.search(desc_low) is None)
+        )
 
 
-# Каждый элемент: (Категория, [список ключевых слов в нижнем регистре])
-# Порядок — чем выше, тем выше приоритет.
-CATEGORY_KEYWORDS: list[tuple[str, list[str]]] = [
-    # Воздухоочистители
-    ("Воздухоочистители", [
-        "очиститель воздуха", "воздухоочиститель", "purifier"
-    ]),
-    # Отдельные специфичные категории → приоритет выше
-    ("Телефоны противоударные", [
-        "blackview", "doogee", "oukitel", "unihertz", "rugged", "armor", "tank", "cyber", "mega"
-    ]),
-    ("Телефоны кнопочные", ["nokia", "f+", "button phone", "feature phone"]),
-    ("Игровые консоли", [
-        "playstation", "ps4", "ps5", "xbox", "switch", "steam deck", "steamdeck",
-        "джойстик", "игровая консоль", "игровая приставка"
-    ]),
-    ("VR-гарнитуры", [
-    "vr", "vr шлем", "vr-шлем", "vr headset", "virtual reality",
-    "oculus", "quest", "meta quest", "vive", "htc vive", "pico",
-    "valve index", "reverb", "hp reverb", "ps vr", "psvr", "psvr2", "ps vr2"
-    ]),
-    (
-        "Экшен-камеры",
-        [
-            # GoPro
-            "gopro", "go pro", "hero", "gopro hero", "gopro hero 10", "gopro hero 11", "gopro hero 12",
-            "gopro hero 13", "gopro hero 14", "gopro hero 15", "gopro hero 16", "gopro hero 17", "gopro hero 18", "gopro hero 19", "gopro hero 20",
-            # DJI Osmo Action
-            "dji", "osmo action", "action 5", "action5", "osmo action 5", "osmoaction",
-            # Insta360
-            "insta", "insta360", "insta 360"
-        ],
-    ),
-    # Новая категория: Фен-стайлер (фены, стайлеры для волос)
-    (
-        "Фен-стайлер",
-        [
-            "фен",
-            "стайлер",
-            "фен-стайлер",
-            "hair dryer",
-            "styler",
-            "airwrap",
-            "supersonic",
-            "hd08",
-            "hd-08",
-            "hd16",
-            "hd-16",
-            "hs08",
-            "hs-08",
-            "ht01",
-            "ht-01",
-        ],
-    ),
-    ("Пылесосы", ["пылесос", "vacuum", "робот-пылесос", "dyson", "dreame", "submarine"]),
-    ("Планшеты", ["ipad", " galaxy tab", "tab ", "redmi pad", "poco pad", "tablet", "pad "]),
-    ("Ноутбуки", ["ноутбук", "macbook", "magicbook", "matebook", "redmi book", "aspire", "ideapad", "ultrabook", "chromebook"]),
-    ("Колонки", ["колонка", "speaker", "jbl", "marshall", "sber", "яндекс", "boombox", "partybox", "stanmore", "woburn", "макс"]),
-    ("Наушники", ["наушник", "наушники", "airpods", "buds", "earphones", "earbuds", "sony wh-", "jbl tune", "marshall minor", "marshall major", "гарнитура"]),
-    ("Часы", ["часы", "watch", "smart band", "galaxy fit", "fitbit", "amazfit", "gtr", "gt3"]),
-    ("Телефоны", [
-        "iphone", "samsung", "x.mi", "x.poco", "x.redmi", "honor", "google pixel", "zte", "realme",
-        "oneplus", "asus zenfone", "смартфон", "smartphone", "galaxy"
-    ]),
-    ("Аксессуары", [
-        "сзу", "сетевое зарядное устройство", "кабель", "переходник", "pencil", "keyboard", "mouse",
-        "adapter", "magsafe", "беспроводная зарядка", "powerbank", "power bank", "чехол", "case", "cover"
-    ]),
-        ("Камеры видеонаблюдения", [
-        "видеонаблюдени", "ip-камера", "ip камера", "cctv",
-        "security camera", "ezviz", "hikvision", "dahua",
-        "imou", "reolink", "wifi камера", "wi-fi камера", "tapo",
-        "домашняя камера", "камера наблюдения"
-    ]),
-    ("Грили", [
-        "гриль", "грили", "грильница", "электрогриль",
-        "газовый гриль", "угольный гриль"
-    ]),
-    ("Квадрокоптеры", [
-        "квадрокоптер", "квадрокоптеры", "коптер", "дрон",
-        "drone", "quadcopter", "fpv", "mavic", "phantom", "air 2s", "mini 3", "mini 4"
-    ]),
-    ("Электроинструменты", [
-        "шуруповерт", "шуруповёрт", "дрель", "перфоратор", "болгарка",
-        "углошлифовальная", "лобзик", "пила", "шлифмашина", "фрезер",
-        "реноватор", "сабельная пила", "гайковерт", "гайковёрт", "штроборез"
-    ]),
-    ("Бритвы, триммеры", [
-        "бритва", "электробритва", "триммер", "машинка для стрижки",
-        "шейвер", "shaver", "groom"
-    ]),
-    ("Эпиляторы", [
-        "эпилятор", "фотоэпилятор", "ipl", "лазерная эпиляция"
-    ]),
-    ("Зубные щетки", [
-        "зубная щетка", "зубные щетки", "электрическая щетка",
-        "oral-b", "oral b", "sonicare", "oclean", "soocas", "щетка зубная", "щётка"
-    ]),
-]
-
-BRAND_KEYWORDS: dict[str, str] = {
-    # Смартфоны и электроника
-    "apple": "Apple",
-    "iphone": "Apple",
-    "samsung": "Samsung",
-    "galaxy": "Samsung",
-    "xiaomi": "Xiaomi",
-    "redmi": "Xiaomi",
-    "poco": "Xiaomi",
-    "mi ": "Xiaomi",
-    "honor": "HONOR",
-    "huawei": "Huawei",
-    "google": "Google",
-    "pixel": "Google",
-    "zte": "ZTE",
-    "realme": "Realme",
-    "oneplus": "OnePlus",
-    "asus": "ASUS",
-    "zenfone": "ASUS",
-    "lenovo": "Lenovo",
-    "acer": "Acer",
-    "gigabyte": "Gigabyte",
-    "machenike": "Machenike",
-    # Наушники и звук
-    "jbl": "JBL",
-    "marshall": "Marshall",
-    "sony": "SONY",
-    "sber": "Sber",
-    "яндекс": "Яндекс",
-    # Пылесосы и техника
-    "dyson": "Dyson",
-    "dreame": "Dreame",
-    # Телефоны кнопочные / противоударные
-    "nokia": "Nokia",
-    "f+": "F+",
-    "digma linx": "Digma Linx",
-    "blackview": "Blackview",
-    "doogee": "DOOGEE",
-    "hotwav": "Hotwav",
-    "oukitel": "OUKITEL",
-    "unihertz": "Unihertz",
-    # Прочее
-    "gopro": "GoPro",
-    "garmin": "Garmin",
-    "fitbit": "Fitbit",
-    # Экшен-камеры
-    "dji": "DJI",
-    "osmo": "DJI",
-    "insta": "Insta360",
-    "insta360": "Insta360",
-    # VR 
-    "oculus": "Oculus",
-    "quest": "Oculus",
-    "meta": "Meta",
-    "htc": "HTC",
-    "vive": "HTC",
-    "pico": "Pico",
-    "valve": "Valve",
-    "valve index": "Valve",
-    "hp": "HP",
-    "reverb": "HP",         # HP Reverb
-    "playstation": "SONY",  # чтобы PS VR/PS VR2 получили бренд SONY
-    
-    # Камеры видеонаблюдения
-    "hikvision": "Hikvision",
-    "dahua": "Dahua",
-    "ezviz": "EZVIZ",
-    "imou": "IMOU",
-    "reolink": "Reolink",
-    "tapo": "TP-Link Tapo",
-    "tp-link": "TP-Link",
-    "tplink": "TP-Link",
-
-    # Квадрокоптеры
-    "autel": "Autel",
-    "hubsan": "Hubsan",
-    "syma": "Syma",
-    "parrot": "Parrot",
-
-    # Электроинструменты
-    "bosch": "Bosch",
-    "makita": "Makita",
-    "dewalt": "DeWALT",
-    "de walt": "DeWALT",
-    "metabo": "Metabo",
-    "ryobi": "Ryobi",
-
-    # Грили
-    "weber": "Weber",
-    "tefal": "Tefal",
-    "redmond": "REDMOND",
-    "kitfort": "Kitfort",
-    "polaris": "Polaris",
-    "george foreman": "George Foreman",
-
-    # Бритвы, триммеры
-    "philips": "Philips",
-    "braun": "Braun",
-    "panasonic": "Panasonic",
-    "remington": "Remington",
-
-    # Эпиляторы
-    "rowenta": "Rowenta",
-
-    # Зубные щетки
-    "oral-b": "Oral-B",
-    "oral b": "Oral-B",
-    "sonicare": "Philips",
-    "oclean": "Oclean",
-    "soocas": "SOOCAS",
-}
+class ClassificationRuleset:
+    """Проверенный и скомпилированный набор правил; неизменяем после создания."""
+
+    def __init__(self, data: dict):
+        errors = _validate_ruleset(data)
+        if errors:
+            raise RulesetError(*errors)
+        self.data = data
+        self.default_category = data.get("default_category", "Другое")
+        self.default_brand = data.get("default_brand", "Общее")
+        self.brands: dict[str, str] = dict(data["brands"])
+        self.brand_items = list(self.brands.items())
+        self.category_keywords: list[tuple[str, list[str]]] = [(c, list(kws)) for c, kws in data["category_keywords"]]
+        self.rules = [ClassificationRule(spec, self.default_brand) for spec in data["rules"]]
+        failed = []
+        for desc, cat, sub in data.get("examples", []):
+            got = self.classify(desc)
+            if got != (cat, sub):
+                failed.append(f"пример «{desc}»: ожидалось {cat} / {sub}, получено {got[0]} / {got[1]}")
+        if failed:
+            raise RulesetError(*failed)
+
+    def lookup_brand(self, desc_low: str, pairs=None, default: str | None = None) -> str:
+        for kw, brand in pairs or self.brand_items:
+            if kw in desc_low:
+                return brand
+        return self.default_brand if default is None else default
+
+    def rule_result(self, rule: ClassificationRule, desc_low: str) -> tuple[str, str]:
+        if rule.brand is not None:
+            return rule.category, rule.brand
+        return rule.category, self.lookup_brand(desc_low, rule.brand_map, rule.default_brand)
+
+    def fallback(self, desc: str, desc_low: str) -> tuple[str, str]:
+        """Категория по ключевым словам, бренд — по первому слову или вхождению."""
+        category = self.default_category
+        for cat, keywords in self.category_keywords:
+            if any(kw in desc_low for kw in keywords):
+                category = cat
+                break
+        first_word = desc.split()[0].strip(',.;:"()').lower() if desc.split() else ""
+        if first_word and first_word in self.brands:
+            return category, self.brands[first_word]
+        return category, self.lookup_brand(desc_low)
+
+    def classify(self, desc: str) -> tuple[str, str]:
+        desc_low = desc.lower()
+        for rule in self.rules:
+            if rule.matches(desc_low):
+                return self.rule_result(rule, desc_low)
+        return self.fallback(desc, desc_low)
+
+    def classify_traced(self, desc: str) -> tuple[tuple[str, str], list[tuple[str, float, bool]]]:
+        """То же, что classify, плюс трасса: (правило, секунд на проверку, сработало)."""
+        perf = time.perf_counter
+        trace = []
+        started = perf()
+        desc_low = desc.lower()
+        for rule in self.rules:
+            hit = rule.matches(desc_low)
+            if hit:
+                result = self.rule_result(rule, desc_low)
+            now = perf()
+            trace.append((rule.name, now - started, hit))
+            started = now
+            if hit:
+                return result, trace
+        result = self.fallback(desc, desc_low)
+        trace.append(("fallback", perf() - started, True))
+        return result, trace
+
+
+def _validate_ruleset(data) -> list[str]:
+    """Все ошибки структуры и регулярок сразу — чтобы исправить файл за один заход."""
+    if not isinstance(data, dict):
+        return ["корень файла должен быть объектом"]
+    errors = []
+    brands = data.get("brands")
+    if not isinstance(brands, dict) or not all(isinstance(k, str) and isinstance(v, str) for k, v in brands.items()):
+        errors.append("brands: нужен объект «подстрока → бренд»")
+    cat_kws = data.get("category_keywords")
+    if not isinstance(cat_kws, list) or not all(
+        isinstance(e, list) and len(e) == 2 and isinstance(e[0], str)
+        and isinstance(e[1], list) and all(isinstance(k, str) for k in e[1])
+        for e in cat_kws
+    ):
+        errors.append("category_keywords: нужен список пар [категория, [ключевые слова]]")
+    rules = data.get("rules")
+    if not isinstance(rules, list):
+        return errors + ["rules: нужен список правил"]
+    names = set()
+    for i, spec in enumerate(rules, 1):
+        where = f"rules[{i}]"
+        if not isinstance(spec, dict):
+            errors.append(f"{where}: правило должно быть объектом")
+            continue
+        where = f"rules[{i}] ({spec.get('name', '?')})"
+        for key in ("name", "category"):
+            if not isinstance(spec.get(key), str) or not spec.get(key):
+                errors.append(f"{where}: не задано {key}")
+        if spec.get("name") in names:
+            errors.append(f"{where}: имя правила повторяется")
+        names.add(spec.get("name"))
+        if ("when" in spec) == ("when_any" in spec):
+            errors.append(f"{where}: нужно ровно одно из when / when_any")
+        if "when_any" in spec and not (
+            isinstance(spec["when_any"], list) and spec["when_any"] and all(isinstance(k, str) and k for k in spec["when_any"])
+        ):
+            errors.append(f"{where}: when_any — непустой список строк")
+        for key in ("when", "also", "unless"):
+            if key in spec:
+                try:
+                    re.compile(spec[key])
+                except (re.error, TypeError) as exc:
+                    errors.append(f"{where}: {key}: {exc}")
+        if "brand" in spec and "brand_map" in spec:
+            errors.append(f"{where}: brand и brand_map вместе не используются")
+        if "brand_map" in spec and not (
+            isinstance(spec["brand_map"], dict) and all(isinstance(v, str) for v in spec["brand_map"].values())
+        ):
+            errors.append(f"{where}: brand_map — объект «подстрока → бренд»")
+        unknown = set(spec) - set(ClassificationRule.__slots__) - {"when_any", "bounded"}
+        if unknown:
+            errors.append(f"{where}: неизвестные поля {', '.join(sorted(unknown))}")
+    return errors
+
+
+def _load_ruleset(path: str = CLASSIFICATION_RULES_FILE) -> ClassificationRuleset:
+    """Читает и проверяет файл правил; ошибки — RulesetError / OSError / ValueError."""
+    with open(path, "r", encoding="utf-8") as f:
+        return ClassificationRuleset(json.load(f))
+
+
+def _install_ruleset(ruleset: ClassificationRuleset) -> None:
+    """Атомарная подмена: классификация берёт ссылку на набор один раз на описание."""
+    global _ruleset, CATEGORY_KEYWORDS, BRAND_KEYWORDS
+    _ruleset = ruleset
+    CATEGORY_KEYWORDS = ruleset.category_keywords
+    BRAND_KEYWORDS = ruleset.brands
+
+
+_ruleset: ClassificationRuleset
+CATEGORY_KEYWORDS: list[tuple[str, list[str]]]
+BRAND_KEYWORDS: dict[str, str]
+_install_ruleset(_load_ruleset())
 
 
 # --- Новая команда: /add_catalog ---
@@ -496,11 +1602,17 @@ async def add_catalog_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         elif chat_id:
             await context.bot.send_message(chat_id=chat_id, text="Извините, команда доступна только администратору.")
         return
+    # Новая сессия загрузки: прежние неподтверждённые файлы отбрасываем
+    _reset_ingest_session(context, user_id)
     context.user_data["awaiting_file"] = True
+    prompt = (
+        "Отправьте один или несколько файлов (.xlsx, .csv или .tsv) с обновлённой базой товаров. "
+        "Из Excel читаются все листы; после загрузки нажмите «Обработать»."
+    )
     if update.message:
-        await update.message.reply_text("Отправьте Excel-файл (.xlsx) с обновлённой базой товаров.")
+        await update.message.reply_text(prompt)
     elif chat_id:
-        await context.bot.send_message(chat_id=chat_id, text="Отправьте Excel-файл (.xlsx) с обновлённой базой товаров.")
+        await context.bot.send_message(chat_id=chat_id, text=prompt)
 
 
 
@@ -653,266 +1765,776 @@ async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await update.message.reply_text(text, reply_markup=back_markup, parse_mode=ParseMode.HTML)
 
 
-import re
-
-def extract_category(description: str) -> tuple[str, str]:
-    """
-    Категоризация товара по описанию с учетом приоритетов, перекрестных признаков и гибких правил.
-    """
-    desc = description or ""
-    desc_low = desc.lower()
-    category = "Другое"
-    subcategory = "Общее"
-
-    # 1. Воздухоочистители (бренды: Xiaomi, Dyson, Philips, Sharp, Boneco, Levoit)
-    if any(x in desc_low for x in ["очиститель воздуха", "воздухоочиститель", "purifier"]):
-        for kw, brand in [
-            ("xiaomi", "Xiaomi"),
-            ("dyson", "Dyson"),
-            ("philips", "Philips"),
-            ("sharp", "Sharp"),
-            ("boneco", "Boneco"),
-            ("levoit", "Levoit")
-        ]:
-            if kw in desc_low:
-                return "Воздухоочистители", brand
-        return "Воздухоочистители", "Общее"
-
-    # 2. Игровые консоли: SteamDeck как отдельный бренд
-    if "steam deck" in desc_low or "steamdeck" in desc_low:
-        return "Игровые консоли", "SteamDeck"
-
-    # 3. Исключить Mi TV Box из телефонов/Xiaomi
-    if ("mi tv box" in desc_low or "xiaomi tv box" in desc_low) and ("телефон" in desc_low or "xiaomi" in desc_low):
-        return "Другое", "Общее"
+# -------------------------------------------------------------------
+# Правила переклассификации (задаются админом, применяются при загрузке)
+# -------------------------------------------------------------------
+# Вместо переноса отдельных позиций админ задаёт правило «шаблон → категория /
+# подкатегория». Все правила собираются в одну регулярку-альтернацию, и каждое
+# описание проверяется за один вызов match(): срабатывает первое подходящее
+# правило. Правила действуют раньше встроенной классификации, поэтому новые
+# варианты товара из следующих прайсов сразу попадают куда нужно.
+RECLASS_RULES_FILE = "reclass_rules.json"
 
 
-    # --- 1. Наушники (приоритет: явное слово, AirPods, EarPods, Buds, Earphones, Earbuds, гарнитура, даже если есть type-c, usb-c и т.д.) ---
-    headphones_pattern = r"\b(наушник|наушники|airpods|air pods|air pod|earpods|ear pods|ear pod|earphones|earphone|earbuds|earbud|buds|гарнитура)\b"
-    if re.search(headphones_pattern, desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Наушники", brand
-        return "Наушники", "Общее"
+def _load_reclass_rules() -> list[dict]:
+    if os.path.exists(RECLASS_RULES_FILE):
+        try:
+            with open(RECLASS_RULES_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return []
 
 
-    # --- 2. Планшеты (Pad, Tab, Tablet, кроме Notepad) ---
-    # Гибкий паттерн: tab, tablet, pad, galaxy tab, redmi pad, poco pad, ipad, и т.д.
-    tablet_pattern = r"(ipad|\btab\b|tablet|pad(?![a-z]))"
-    if (re.search(tablet_pattern, desc_low) or re.search(r"pad[\s\d]", desc_low)) and not re.search(r"notepad", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Планшеты", brand
-        return "Планшеты", "Общее"
+def _save_reclass_rules(rules: list[dict]) -> None:
+    try:
+        with open(RECLASS_RULES_FILE, "w", encoding="utf-8") as f:
+            json.dump(rules, f, ensure_ascii=False, indent=2)
+    except Exception:
+        pass
 
-    # --- 3. Явные аксессуары (расширено) ---
-    accessories_kw = [
-        "аксессуар", "чехол", "стекло", "кабель", "шнур", "переходник", "adapter", "зарядка", "powerbank", "power bank", "magsafe", "pencil", "cover", "case", "screen protector", "беспроводная зарядка", "сетевое зарядное устройство", "сзу", "блок", "адаптер", "блок питания", "usb", "type-c", "lightning", "micro-usb", "магнитный кабель", "стекло защитное", "защитное стекло", "док-станция", "док станция", "док", "hub", "разветвитель", "splitter", "держатель", "mount", "подставка", "ремешок", "strap", "ремень", "пленка", "film", "наклейка", "наклейки", "stylus", "стилус"
-    ]
-    if any(re.search(rf"(?<![а-яa-z0-9]){re.escape(kw)}(?![а-яa-z0-9])", desc_low) for kw in accessories_kw):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Аксессуары", brand
-        return "Аксессуары", "Общее"
 
-    # --- 3. Колонки (исключая наушники) ---
-    if re.search(r"\b(колонка|speaker|boombox|partybox|stanmore|woburn)\b", desc_low) and not re.search(r"наушник|наушники|buds|earbuds|гарнитура", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Колонки", brand
-        return "Колонки", "Общее"
+def _validate_rule_pattern(pattern: str) -> str | None:
+    """Текст ошибки или None. Шаблон встраивается в общую регулярку, отсюда ограничения."""
+    try:
+        compiled = re.compile(pattern, re.IGNORECASE)
+    except re.error as exc:
+        return f"некорректное регулярное выражение: {exc}"
+    if compiled.groupindex or re.search(r"\\[1-9]|\(\?P=", pattern):
+        return "именованные группы и обратные ссылки не поддерживаются, используйте (?:...)"
+    return None
 
 
-    # --- 4. Фен-стайлеры (Dyson, Supersonic, Airwrap и др.) ---
-    if re.search(r"фен|стайлер|hair dryer|styler|airwrap|supersonic|hd08|hd-08|hd16|hd-16|hs08|hs-08|ht01|ht-01", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Фен-стайлер", brand
-        return "Фен-стайлер", "Общее"
+class ReclassRules:
+    """Набор правил, скомпилированный в одну регулярку: ^(?:(?=.*?p0)(?P<r0>)|…)."""
 
-    # --- 5. Пылесосы (все бренды, любые слова) ---
-    # Паттерн: пылесос, vacuum, cleaner, робот-пылесос, robot vacuum, robot cleaner, робот vacuum, робот cleaner, dreame, dyson, submarine
-    if re.search(r"пылесос|vacuum|cleaner|робот-пылесос|robot vacuum|robot cleaner|робот vacuum|робот cleaner|dreame|dyson|submarine", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Пылесосы", brand
-        return "Пылесосы", "Общее"
+    __slots__ = ("rules", "regex")
 
-    # --- 5. Часы и браслеты (Garmin, Band, Instinct и др.) ---
-    if re.search(r"\b(часы|watch|band|fitbit|amazfit|gtr|gt3|instinct|forerunner|fenix|coros|garmin|band)\b", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Часы", brand
-        return "Часы", "Общее"
+    def __init__(self, rules: list[dict]):
+        self.rules = rules
+        parts = [f"(?=.*?(?:{rule['pattern']}))(?P<r{i}>)" for i, rule in enumerate(rules)]
+        self.regex = re.compile("^(?:" + "|".join(parts) + ")", re.IGNORECASE | re.DOTALL) if parts else None
 
-    # --- 6. Планшеты (Pad, Tab, Tablet, кроме Notepad) ---
-    if (re.search(r"\bipad\b|\btab\b|\btablet\b|\bpad\b", desc_low) or re.search(r"pad[\s\d]", desc_low)) and not re.search(r"notepad", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Планшеты", brand
-        return "Планшеты", "Общее"
+    def match(self, description: str) -> tuple[str, str] | None:
+        if self.regex is None:
+            return None
+        m = self.regex.match(description)
+        if m is None:
+            return None
+        rule = self.rules[int(m.lastgroup[1:])]
+        return rule["cat"], rule["sub"]
 
-    # --- 7. Ноутбуки (Apple, Matebook, CPU, дюймы, модели, book, клавиатура) ---
-    # Явные признаки ноутбука: 'book' + дюймы, или 'клавиатура' (RU клавиатура и др.)
-    if (re.search(r"book", desc_low) and re.search(r"\d{2}\"", desc)) or re.search(r"клавиатура", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Ноутбуки", brand
-        return "Ноутбуки", "Общее"
-    # Apple MacBook: Air/Pro + 13"/14"/15"/16"/M1/M2/M3/M4
-    if (re.search(r"macbook|air|pro", desc_low) and (re.search(r"\d{2}\"", desc) or re.search(r"\bm[1-4]\b", desc_low))) or re.search(r"macbook", desc_low):
-        return "Ноутбуки", "Apple"
-    # Matebook, ноутбуки других брендов
-    if re.search(r"matebook|notebook|ultrabook|chromebook|magicbook|aspire|ideapad|thinkpad|vivobook|zenbook|legion|gigabyte|machenike|lenovo|acer|asus|hp|dell|msi|huawei", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Ноутбуки", brand
-        return "Ноутбуки", "Общее"
-    # Intel/AMD CPU + 13"/14"/15"/16"
-    if re.search(r"(intel|amd|ryzen|core i[3579]|pentium|celeron)", desc_low) and re.search(r"\d{2}\"", desc):
-        return "Ноутбуки", "Общее"
-
-    # --- 7. Телефоны (Mate X, бренды, явные признаки) ---
-    # Huawei Mate X6 — телефон, Matebook — ноутбук
-    if re.search(r"matebook", desc_low):
-        return "Ноутбуки", "Huawei"
-    if re.search(r"mate", desc_low) and not re.search(r"matebook", desc_low):
-        return "Телефоны", "Huawei"
-    # Смартфоны по брендам и ключевым словам
-    # Исключить Mi TV Box из телефонов/Xiaomi (ещё раз для надёжности)
-    if ("mi tv box" in desc_low or "xiaomi tv box" in desc_low):
-        return "Другое", "Общее"
-    phone_kw = ["iphone", "смартфон", "smartphone", "galaxy", "pixel", "zenfone", "oneplus", "realme", "zte", "redmi", "poco", "xiaomi", "samsung", "huawei", "honor"]
-    if any(re.search(rf"(?<![а-яa-z0-9]){re.escape(kw)}(?![а-яa-z0-9])", desc_low) for kw in phone_kw):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                # Исключить Mi TV Box из телефонов/Xiaomi
-                if brand == "Xiaomi" and ("mi tv box" in desc_low or "xiaomi tv box" in desc_low):
-                    return "Другое", "Общее"
-                return "Телефоны", brand
-        return "Телефоны", "Общее"
 
+def _usable_reclass_rules(rules: list[dict]) -> list[dict]:
+    """
+    Правила из файла, которые можно собрать в общую регулярку. Файл правят и руками,
+    поэтому неподходящее правило пропускается, а не роняет бота при старте.
+    """
+    usable = []
+    for rule in rules:
+        try:
+            if _validate_rule_pattern(rule["pattern"]) is None:
+                ReclassRules([rule])
+                usable.append(rule)
+        except (KeyError, TypeError, re.error):
+            continue
+    return usable
 
-    # --- 8. Кнопочные телефоны ---
-    if re.search(r"button phone|feature phone|nokia|f\+|digma linx", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Телефоны кнопочные", brand
-        return "Телефоны кнопочные", "Общее"
 
-    # --- 9. Противоударные телефоны ---
-    if re.search(r"противоударный|rugged|armor|tank|cyber|mega|blackview|doogee|hotwav|oukitel|unihertz", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Телефоны противоударные", brand
-        return "Телефоны противоударные", "Общее"
+_reclass_rules = ReclassRules([])
+_reclass_rules_mtime: int | None = -1
 
-    # --- НОВОЕ: VR-гарнитуры ---
-    if re.search(r"(?:\bvr\b|vr-?шлем|vr\s?headset|virtual\s+reality|meta\s?quest|oculus|quest(?:\s?(?:2|3|pro))?|htc\s?vive|(?:^|\b)vive\b|pico|valve\s?index|hp\s?reverb|reverb\s?g2|ps\s?vr2?|psvr2?)", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "VR-гарнитуры", brand
-        return "VR-гарнитуры", "Общее"
-    
-    # --- 9. Игровые консоли (без VR) ---
-    if re.search(r"playstation|ps4|ps5|xbox|switch|steam deck|steamdeck|джойстик|игровая консоль|игровая приставка", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Игровые консоли", brand
-        return "Игровые консоли", "Общее"
-    
-        # --- НОВОЕ: Камеры видеонаблюдения ---
-    if re.search(r"(видеонаблюдени|ip[-\s]?камера|cctv|security camera|wi-?fi\s?камера|домашняя камера|ezviz|hikvision|dahua|imou|reolink|tapo)", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Камеры видеонаблюдения", brand
-        return "Камеры видеонаблюдения", "Общее"
 
-    # --- НОВОЕ: Квадрокоптеры ---
-    if re.search(r"\b(квадро?коптеры?|коптер|дрон|drone|quadcopter|fpv)\b", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Квадрокоптеры", brand
-        return "Квадрокоптеры", "Общее"
+def _refresh_reclass_rules() -> ReclassRules:
+    """Перечитывает файл правил, если он изменился (вызывается раз на разбор прайса)."""
+    global _reclass_rules, _reclass_rules_mtime
+    try:
+        mtime = os.stat(RECLASS_RULES_FILE).st_mtime_ns
+    except OSError:
+        mtime = None
+    if mtime != _reclass_rules_mtime:
+        _reclass_rules = ReclassRules(_usable_reclass_rules(_load_reclass_rules()))
+        _reclass_rules_mtime = mtime
+    return _reclass_rules
 
-    # --- НОВОЕ: Грили ---
-    if re.search(r"\b(гриль|грили|грильница|электрогриль|газовый гриль|угольный гриль)\b", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Грили", brand
-        return "Грили", "Общее"
 
-    # --- НОВОЕ: Электроинструменты ---
-    if re.search(r"\b(шуруповёрт|шуруповерт|дрель|перфоратор|болгарка|углошлифовальная|лобзик|пила|шлифмашин|фрезер|реноватор|сабельная пила|гайковёрт|гайковерт|штроборез)\b", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Электроинструменты", brand
-        return "Электроинструменты", "Общее"
+_refresh_reclass_rules()
 
-    # --- НОВОЕ: Бритвы, триммеры ---
-    if re.search(r"\b(бритва|электробритва|триммер|машинка для стрижки|шейвер|shaver|groom)\b", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Бритвы, триммеры", brand
-        return "Бритвы, триммеры", "Общее"
 
-    # --- НОВОЕ: Эпиляторы ---
-    if re.search(r"\b(эпилятор|фотоэпилятор|ipl|лазерн\w*\sэпиляц\w*)\b", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Эпиляторы", brand
-        return "Эпиляторы", "Общее"
+def _set_reclass_rules(rules: list[dict]) -> None:
+    _save_reclass_rules(rules)
+    _refresh_reclass_rules()
 
-    # --- НОВОЕ: Зубные щетки ---
-    if re.search(r"(зубн\w*\sщ(е|ё)тка|электрическ\w*\sщ(е|ё)тка|oral-?b|sonicare|oclean|soocas)", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Зубные щетки", brand
-        return "Зубные щетки", "Общее"
 
-    # --- 10. Экшен-камеры ---
-    if re.search(r"gopro|osmo action|insta360|insta 360|dji|hero", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                 return "Экшен-камеры", brand
-        return "Экшен-камеры", "Общее"
+def _format_reclass_rules(rules: list[dict]) -> str:
+    if not rules:
+        return "Правил переклассификации нет."
+    lines = ["<b>Правила переклассификации</b> (срабатывает первое подходящее):"]
+    for i, rule in enumerate(rules, 1):
+        lines.append(
+            f"{i}. <code>{html.escape(rule['pattern'])}</code> → "
+            f"{html.escape(rule['cat'])} / {html.escape(rule['sub'])}"
+        )
+    return "\n".join(lines)
 
-    # --- 11. Фен-стайлеры ---
-    if re.search(r"фен|стайлер|hair dryer|styler|airwrap|supersonic|hd08|hd-08|hd16|hd-16|hs08|hs-08|ht01|ht-01", desc_low):
-        return "Фен-стайлер", "Общее"
 
-    # --- 12. Пылесосы ---
-    if re.search(r"пылесос|vacuum|робот-пылесос|dyson|dreame|submarine", desc_low):
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                return "Пылесосы", brand
-        return "Пылесосы", "Общее"  
+async def rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /rules — список правил переклассификации (только админ)."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id or not is_admin(user_id):
+        await update.message.reply_text("Извините, команда доступна только администратору.")
+        return
+    await update.message.reply_text(
+        _format_reclass_rules(_refresh_reclass_rules().rules)
+        + "\n\nДобавить: /rule_add шаблон; Категория; Подкатегория\nУдалить: /rule_del номер",
+        parse_mode=ParseMode.HTML,
+    )
 
-    # --- 13. Категория по ключевым словам (fallback) ---
-    for cat, keywords in CATEGORY_KEYWORDS:
-        if any(kw in desc_low for kw in keywords):
-            category = cat
-            break
 
-    # --- 14. Бренд по ключевым словам (fallback) ---
-    first_word = desc.split()[0].strip(',.;:"()').lower() if desc else ""
-    if first_word and first_word in BRAND_KEYWORDS:
-        subcategory = BRAND_KEYWORDS[first_word]
-    else:
-        for kw, brand in BRAND_KEYWORDS.items():
-            if kw in desc_low:
-                subcategory = brand
-                break
+async def rule_add_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /rule_add шаблон; Категория; Подкатегория (только админ)."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id or not is_admin(user_id):
+        await update.message.reply_text("Извините, команда доступна только администратору.")
+        return
+    raw = (update.message.text or "").partition(" ")[2].strip()
+    parts = [p.strip() for p in raw.rsplit(";", 2)]
+    if len(parts) != 3 or not all(parts):
+        await update.message.reply_text(
+            "Формат: /rule_add шаблон; Категория; Подкатегория\n"
+            "Например: /rule_add itel; Телефоны; Общее"
+        )
+        return
+    pattern, cat, sub = parts
+    error = _validate_rule_pattern(pattern)
+    if error:
+        await update.message.reply_text(f"Шаблон не принят: {error}")
+        return
+    rules = list(_refresh_reclass_rules().rules)
+    rules.append({"pattern": pattern, "cat": cat, "sub": sub})
+    # Шаблон отдельно может компилироваться, а в общей регулярке — нет (например, (?i) в середине)
+    try:
+        ReclassRules(rules)
+    except re.error as exc:
+        await update.message.reply_text(f"Шаблон не принят: не встраивается в общий набор правил: {exc}")
+        return
+    _set_reclass_rules(rules)
+    await update.message.reply_text(
+        f"Правило {len(rules)} добавлено. Оно применится при следующей загрузке прайса.\n\n"
+        + _format_reclass_rules(rules),
+        parse_mode=ParseMode.HTML,
+    )
+
+
+async def rule_del_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /rule_del номер (только админ)."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id or not is_admin(user_id):
+        await update.message.reply_text("Извините, команда доступна только администратору.")
+        return
+    rules = list(_refresh_reclass_rules().rules)
+    try:
+        idx = int((context.args or [""])[0]) - 1
+    except ValueError:
+        idx = -1
+    if not 0 <= idx < len(rules):
+        await update.message.reply_text("Укажите номер правила из списка /rules, например: /rule_del 2")
+        return
+    removed = rules.pop(idx)
+    _set_reclass_rules(rules)
+    await update.message.reply_text(
+        f"Удалено правило: {html.escape(removed['pattern'])} → {html.escape(removed['cat'])} / {html.escape(removed['sub'])}\n\n"
+        + _format_reclass_rules(rules),
+        parse_mode=ParseMode.HTML,
+    )
+
+
+import re
+
+def extract_category(description: str) -> tuple[str, str]:
+    """
+    Категоризация товара по описанию: правила админа, затем каскад из classification_rules.json.
+    """
+    desc = description or ""
+    # 0. Правила админа (/rule_add) важнее встроенных
+    if _classify_profile is not None:
+        return _classify_profile.classify(desc)
+    rule = _reclass_rules.match(desc)
+    if rule is not None:
+        return rule
+    return _ruleset.classify(desc)
+
+
+def extract_category_traced(description: str) -> tuple[tuple[str, str], list[tuple[str, float, bool]]]:
+    """extract_category с трассой по правилам (для /classify_trace и профилирования)."""
+    desc = description or ""
+    started = time.perf_counter()
+    rule = _reclass_rules.match(desc)
+    admin_step = ("admin_rules", time.perf_counter() - started, rule is not None)
+    if rule is not None:
+        return rule, [admin_step]
+    result, trace = _ruleset.classify_traced(desc)
+    return result, [admin_step, *trace]
+
+
+class RuleProfile:
+    """Сводка по загрузке: сколько раз сработало каждое правило и сколько стоили его проверки."""
+
+    def __init__(self, data: dict | None = None):
+        data = data or {}
+        self.items = data.get("items", 0)
+        self.hits: dict[str, int] = dict(data.get("hits", {}))
+        self.cost: dict[str, float] = dict(data.get("cost", {}))
+        self.order: list[str] = list(data.get("order", []))
+
+    def classify(self, desc: str) -> tuple[str, str]:
+        result, trace = extract_category_traced(desc)
+        self.items += 1
+        for name, seconds, hit in trace:
+            if name not in self.cost:
+                self.cost[name] = 0.0
+                self.order.append(name)
+            self.cost[name] += seconds
+            if hit:
+                self.hits[name] = self.hits.get(name, 0) + 1
+        return result
+
+    def merge(self, other: "RuleProfile") -> None:
+        self.items += other.items
+        for name in other.order:
+            if name not in self.cost:
+                self.cost[name] = 0.0
+                self.order.append(name)
+            self.cost[name] += other.cost[name]
+        for name, n in other.hits.items():
+            self.hits[name] = self.hits.get(name, 0) + n
+
+    def as_dict(self) -> dict:
+        return {"items": self.items, "hits": self.hits, "cost": self.cost, "order": self.order}
+
+    def format(self, limit: int = 40) -> str:
+        """Правила по убыванию суммарной стоимости; № — место в каскаде."""
+        if not self.items:
+            return "Профиль пуст: при включённом профилировании ещё не было загрузок."
+        total = sum(self.cost.values()) or 1e-12
+        position = {name: i for i, name in enumerate(self.order)}
+        lines = [
+            f"Профиль классификации: {self.items} описаний, {total * 1000:.1f} мс",
+            "№  правило — срабатываний, мс, доля времени",
+        ]
+        for name in sorted(self.cost, key=self.cost.get, reverse=True)[:limit]:
+            lines.append(
+                f"{position[name]:>2} {name} — {self.hits.get(name, 0)}, "
+                f"{self.cost[name] * 1000:.1f}, {self.cost[name] / total:.0%}"
+            )
+        return "\n".join(lines)
+
+
+# Профиль текущего разбора (в процессе-обработчике); None — профилирование выключено
+_classify_profile: RuleProfile | None = None
+
+
+# -------------------------------------------------------------------
+# Потоковое чтение прайс-листов (без DataFrame)
+# -------------------------------------------------------------------
+# Строки читаются openpyxl в режиме read_only по одной и сразу классифицируются,
+# поэтому память не зависит от размера файла (кроме самого каталога).
+# Значения приводятся так же, как это делает pd.read_excel: пустая ячейка → NaN,
+# целое float → int, а тип колонки цены (int / float / object) выводится по всем
+# её значениям — как dtype в DataFrame.
+INGEST_CHUNK_ROWS = 5000
+DESC_COLUMNS = ("description", "desription")
+PRICE_COLUMNS = ("price", "Цена", "Price")
+
+_NAN = float("nan")
+# Строки, которые pandas по умолчанию читает как NaN
+_PANDAS_NA_STRINGS = frozenset({
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+})
+
+
+def _norm_desc(s) -> str:
+    """Ключ сопоставления товаров между загрузками и слоями каталога."""
+    # То же, что re.sub(r"\s+", " ", ...strip().lower()), но в разы быстрее
+    return " ".join(str(s or "").lower().split())
+
+
+def _excel_cell(value):
+    """Значение ячейки так, как его отдаёт pd.read_excel до вывода типа колонки."""
+    if value is None:
+        return _NAN
+    if isinstance(value, str):
+        return _NAN if value in _PANDAS_NA_STRINGS else value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _column_names(header: tuple) -> list:
+    """Имена колонок как в DataFrame: пустые → "Unnamed: N", повторы → "имя.1"."""
+    names, seen = [], {}
+    for i, name in enumerate(header):
+        name = f"Unnamed: {i}" if name is None else name
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _iter_excel_rows(source, sheet: int | str = 0):
+    """
+    Строки листа по одной (openpyxl read_only): сначала список имён колонок,
+    затем кортежи значений той же длины — как csv.reader. source — путь или байты файла.
+    """
+    import openpyxl
+
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[sheet] if isinstance(sheet, int) else wb[sheet]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        names = _column_names(header)
+        yield names
+        width = len(names)
+        blank = (_NAN,) * width
+        pending_blank = 0
+        for values in rows:
+            if all(v is None for v in values):
+                # pandas отбрасывает только хвостовые пустые строки
+                pending_blank += 1
+                continue
+            for _ in range(pending_blank):
+                yield blank
+            pending_blank = 0
+            if len(values) != width:
+                values = tuple(values[:width]) + (None,) * (width - len(values))
+            yield tuple(map(_excel_cell, values))
+    finally:
+        wb.close()
+
+
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_DELIMITERS = ",;\t|"
+
+
+def _detect_text_encoding(sample: bytes) -> str:
+    """utf-8 (с BOM или без), иначе cp1251 — так выгружают 1С и Excel."""
+    import codecs
+
+    try:
+        # final=False: образец может обрываться посреди многобайтового символа
+        codecs.getincrementaldecoder("utf-8-sig")().decode(sample, final=False)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "cp1251"
+
+
+def _iter_csv_rows(source, delimiter: str | None = None):
+    """
+    Строки CSV/TSV по одной в том же виде, что _iter_excel_rows:
+    имена колонок, затем кортежи значений. Разделитель определяется по началу
+    файла (для .tsv — табуляция); пустые строки пропускаются, как в pd.read_csv.
+    Числа остаются строками — тип колонки цены выводит _build_catalog_from_rows.
+    source — путь или байты файла (у байтов .tsv не угадать — передайте delimiter).
+    """
+    import csv
+
+    in_memory = isinstance(source, (bytes, bytearray))
+    if in_memory:
+        sample = bytes(source[:CSV_SNIFF_BYTES])
+    else:
+        with open(source, "rb") as fh:
+            sample = fh.read(CSV_SNIFF_BYTES)
+    encoding = _detect_text_encoding(sample)
+    if delimiter is None and not in_memory and str(source).lower().endswith(".tsv"):
+        delimiter = "\t"
+    if delimiter is None:
+        text = sample.decode(encoding, errors="ignore")
+        try:
+            delimiter = csv.Sniffer().sniff(text, delimiters=CSV_DELIMITERS).delimiter
+        except csv.Error:
+            delimiter = ","
+
+    if in_memory:
+        opened = io.TextIOWrapper(io.BytesIO(source), encoding=encoding, newline="")
+    else:
+        opened = open(source, encoding=encoding, newline="")
+    with opened as fh:
+        reader = csv.reader(fh, delimiter=delimiter)
+        header = next((r for r in reader if r), None)
+        if header is None:
+            return
+        names = _column_names([name or None for name in header])
+        yield names
+        width = len(names)
+        for values in reader:
+            if not values:
+                continue
+            if len(values) != width:
+                values = values[:width] + [None] * (width - len(values))
+            yield tuple(map(_excel_cell, values))
+
+
+def _resolve_columns(names: list, aliases: tuple[str, ...]) -> list[int]:
+    """Индексы колонок-синонимов в порядке приоритета (только присутствующие)."""
+    return [names.index(alias) for alias in aliases if alias in names]
+
+
+def _first_truthy(values: tuple, indexes: list[int]):
+    """values[a] or values[b] or … — как в исходном разборе DataFrame; + индекс колонки."""
+    for idx in indexes:
+        value = values[idx]
+        if value:
+            return value, idx
+    return "", None
+
+
+def _first_price(values: tuple, indexes: list[int]):
+    """
+    _first_truthy для колонок цены. В CSV числа приходят строками, и «0» был бы
+    истинным, а та же ячейка из xlsx — число 0, ложное; нулевая числовая строка
+    считается ложной, чтобы каталог из CSV и xlsx совпадал.
+    """
+    for idx in indexes:
+        value = values[idx]
+        if isinstance(value, str):
+            try:
+                if float(value.strip()) == 0:
+                    continue
+            except ValueError:
+                pass
+        if value:
+            return value, idx
+    return "", None
+
+
+def _value_kind(value) -> str:
+    """Какой dtype pandas вывел бы для колонки из одного этого значения."""
+    kind = type(value)
+    if kind is int:
+        return "int"
+    if kind is float:
+        return "missing" if value != value else "float"
+    if kind is str:
+        try:
+            num = float(value.strip())
+        except ValueError:
+            return "object"
+        return "int" if num.is_integer() and not any(c in value for c in ".eE") else "float"
+    return "object"
+
+
+class _PriceColumnTypes:
+    """Вывод dtype колонок цены по всем значениям — как это делает pandas."""
+
+    def __init__(self, indexes: list[int]):
+        self.indexes = indexes
+        self.stats: dict[int, set[str]] = {idx: set() for idx in indexes}
+        # Товары и ключи карты цен по колонке, из которой взята цена
+        self.items: dict[int, list[dict]] = {idx: [] for idx in indexes}
+        self.keys: dict[int, list[str]] = {idx: [] for idx in indexes}
+
+    def observe(self, values: tuple) -> None:
+        for idx in self.indexes:
+            self.stats[idx].add(_value_kind(values[idx]))
+
+    def track(self, idx: int | None, item: dict, key: str) -> None:
+        if idx is not None:
+            self.items[idx].append(item)
+            self.keys[idx].append(key)
+
+    @staticmethod
+    def _convert(value, to_float: bool):
+        if isinstance(value, str):
+            return float(value) if to_float else int(value.strip())
+        if to_float and type(value) is int:
+            return float(value)
+        return value
+
+    def apply(self, price_by_desc: dict) -> None:
+        """Приводит цены к итоговому типу колонки (как DataFrame)."""
+        for idx in self.indexes:
+            kinds = self.stats[idx]
+            if "object" in kinds:
+                continue
+            to_float = bool(kinds & {"float", "missing"})
+            for item, key in zip(self.items[idx], self.keys[idx]):
+                value = item["price"]
+                item["price"] = self._convert(value, to_float)
+                # Ключ мог быть перезаписан более поздней строкой с другой колонкой
+                if price_by_desc.get(key) is value:
+                    price_by_desc[key] = item["price"]
+
+
+def _iter_chunks(rows, size: int = INGEST_CHUNK_ROWS):
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, size)):
+        yield chunk
+
+
+def _build_catalog_from_rows(rows) -> tuple[dict, dict]:
+    """
+    Один проход по строкам прайса: (каталог, «нормализованное описание → цена»).
+
+    rows — имена колонок, затем кортежи значений. Строки обрабатываются
+    порциями по INGEST_CHUNK_ROWS, так что в памяти держится только текущая
+    порция и накопленный результат.
+    """
+    catalog: dict[str, dict[str, list[dict]]] = {}
+    price_by_desc: dict[str, object] = {}
+    _refresh_reclass_rules()
+    rows = iter(rows)
+    names = next(rows, None)
+    if names is None:
+        return catalog, price_by_desc
+    desc_cols = _resolve_columns(names, DESC_COLUMNS)
+    price_cols = _resolve_columns(names, PRICE_COLUMNS)
+    types = _PriceColumnTypes(price_cols)
+    for chunk in _iter_chunks(rows):
+        for values in chunk:
+            types.observe(values)
+            desc = str(_first_truthy(values, desc_cols)[0])
+            price, price_col = _first_price(values, price_cols)
+            cat, sub = extract_category(desc)
+            item = {"desc": desc, "price": price}
+            catalog.setdefault(cat, {}).setdefault(sub, []).append(item)
+            key = _norm_desc(desc)
+            price_by_desc[key] = price
+            types.track(price_col, item, key)
+    types.apply(price_by_desc)
+    return catalog, price_by_desc
+
+
+# -------------------------------------------------------------------
+# Сессия загрузки: несколько файлов и листов от разных поставщиков
+# -------------------------------------------------------------------
+# Админ присылает один или несколько файлов, затем нажимает «Обработать».
+# Каждый лист разбирается в отдельном процессе, затем позиции объединяются:
+# дубли по нормализованному описанию схлопываются по правилу INGEST_MERGE_RULE.
+#   lowest_price — остаётся позиция с минимальной ценой;
+#   priority     — остаётся позиция поставщика, раньше стоящего в SUPPLIER_PRIORITY
+#                  (подстроки имени файла через запятую), затем — более ранний файл.
+INGEST_MERGE_RULE = os.getenv("INGEST_MERGE_RULE", "lowest_price")
+SUPPLIER_PRIORITY = [s.strip().lower() for s in os.getenv("SUPPLIER_PRIORITY", "").split(",") if s.strip()]
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0")) or (os.cpu_count() or 1)
+INGEST_MAX_FILES = 20
+
+MERGE_RULE_TITLES = {
+    "lowest_price": "минимальная цена",
+    "priority": "приоритет поставщика",
+}
+
+
+INGEST_EXTENSIONS = (".xlsx", ".csv", ".tsv")
+_TEXT_EXTENSIONS = (".csv", ".tsv")
+
+
+CLASSIFY_CHUNK_ITEMS = 5000
+
+
+def _init_classification_worker(ruleset_data: dict, reclass_rules: list[dict]) -> None:
+    """Процесс пула классифицирует теми же правилами, что сейчас действуют в боте."""
+    global _reclass_rules
+    _install_ruleset(ClassificationRuleset(ruleset_data))
+    _reclass_rules = ReclassRules(reclass_rules)
+
+
+def _classification_pool(max_workers: int = INGEST_WORKERS):
+    import concurrent.futures
+    import multiprocessing
+
+    # spawn, а не fork: у бота есть потоки (to_thread, SQLite), fork их не переносит
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_classification_worker,
+        initargs=(_ruleset.data, _reclass_rules.rules),
+    )
+
+
+def _classify_chunk(descs: list[str]) -> list[tuple[str, str]]:
+    return [extract_category(d) for d in descs]
+
+
+async def _classify_in_workers(descs: list[str]) -> list[tuple[str, str]]:
+    """extract_category для списка описаний — порциями в пуле процессов."""
+    if not descs:
+        return []
+    loop = asyncio.get_running_loop()
+    chunks = [descs[i:i + CLASSIFY_CHUNK_ITEMS] for i in range(0, len(descs), CLASSIFY_CHUNK_ITEMS)]
+    with _classification_pool(min(INGEST_WORKERS, len(chunks))) as pool:
+        parts = await asyncio.gather(*(loop.run_in_executor(pool, _classify_chunk, c) for c in chunks))
+    return [result for part in parts for result in part]
+
+
+def _list_source_sheets(data: bytes, name: str) -> list[str]:
+    """Листы книги; у CSV/TSV один безымянный «лист»."""
+    if name.lower().endswith(_TEXT_EXTENSIONS):
+        return [""]
+    import openpyxl
+
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, keep_links=False)
+    try:
+        return list(wb.sheetnames)
+    finally:
+        wb.close()
+
+
+def _parse_ingest_sheet(data: bytes, name: str, sheet: str, profile: bool = False) -> dict | None:
+    """
+    Разбор одного листа в процессе-обработчике прямо из байтов загрузки (name — имя файла).
+    None — на листе нет колонки с описанием (служебный лист, пропускаем).
+    profile — вернуть в "profile" сводку по правилам классификации.
+    """
+    if name.lower().endswith(_TEXT_EXTENSIONS):
+        rows = _iter_csv_rows(data, "\t" if name.lower().endswith(".tsv") else None)
+    else:
+        rows = _iter_excel_rows(data, sheet)
+    names = next(rows, None)
+    if names is None or not _resolve_columns(names, DESC_COLUMNS):
+        return None
+    global _classify_profile
+    _classify_profile = RuleProfile() if profile else None
+    try:
+        catalog, price_by_desc = _build_catalog_from_rows(itertools.chain([names], rows))
+        result = {"catalog": catalog, "price_by_desc": price_by_desc}
+        if profile:
+            result["profile"] = _classify_profile.as_dict()
+        return result
+    finally:
+        _classify_profile = None
+
+
+def _price_number(price) -> float | None:
+    """Цена как число для сравнения; None — цены нет или она нечисловая."""
+    if isinstance(price, bool):
+        return None
+    if isinstance(price, (int, float)):
+        return None if price != price else float(price)
+    try:
+        return float(str(price).replace(" ", "").replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _supplier_rank(file_name: str) -> int:
+    name = file_name.lower()
+    for rank, pattern in enumerate(SUPPLIER_PRIORITY):
+        if pattern in name:
+            return rank
+    return len(SUPPLIER_PRIORITY)
 
-    # --- 15. Особое правило: для категории Go Pro всегда бренд GoPro ---
-    if category == "Go Pro":
-        subcategory = "GoPro"
 
-    return category, subcategory
+def _merge_ingest_sources(sources: list[dict], rule: str = INGEST_MERGE_RULE) -> tuple[dict, dict]:
+    """
+    Объединяет разобранные листы в один каталог.
+
+    sources — в порядке загрузки: {"name", "file", "catalog", "price_by_desc"}.
+    Возвращает (каталог, «описание → цена») и дописывает в каждый источник
+    статистику: rows (позиций), kept (оставлено), dropped (проиграли дублям).
+    Один источник возвращается как есть — результат тот же, что у одиночной загрузки.
+    """
+    for src in sources:
+        src["rows"] = sum(len(items) for subs in src["catalog"].values() for items in subs.values())
+        src["kept"], src["dropped"] = src["rows"], 0
+    if len(sources) == 1:
+        return sources[0]["catalog"], sources[0]["price_by_desc"]
+
+    def rank(src_idx: int, price) -> tuple:
+        if rule == "priority":
+            return (sources[src_idx]["priority"], src_idx)
+        number = _price_number(price)
+        return (number is None, number or 0.0, src_idx)
+
+    for src in sources:
+        src["priority"] = _supplier_rank(src["file"])
+        src["kept"] = 0
+    # ключ -> (ранг, индекс источника, категория, подкатегория, товар)
+    best: dict[str, tuple] = {}
+    for src_idx, src in enumerate(sources):
+        for cat, subs in src["catalog"].items():
+            for sub, items in subs.items():
+                for item in items:
+                    key = _norm_desc(item["desc"])
+                    candidate = (rank(src_idx, item["price"]), src_idx, cat, sub, item)
+                    current = best.get(key)
+                    if current is None:
+                        best[key] = candidate
+                    elif candidate[0] < current[0]:
+                        sources[current[1]]["dropped"] += 1
+                        best[key] = candidate
+                    else:
+                        src["dropped"] += 1
+
+    catalog: dict[str, dict[str, list[dict]]] = {}
+    price_by_desc: dict[str, object] = {}
+    for key, (_, src_idx, cat, sub, item) in best.items():
+        catalog.setdefault(cat, {}).setdefault(sub, []).append(item)
+        price_by_desc[key] = item["price"]
+        sources[src_idx]["kept"] += 1
+    return catalog, price_by_desc
+
+
+async def _parse_ingest_files(files: list[dict], profile: RuleProfile | None = None) -> tuple[list[dict], list[str]]:
+    """Разбирает все листы всех файлов параллельно в пуле процессов; profile — собрать сводку по правилам."""
+    loop = asyncio.get_running_loop()
+    with _classification_pool() as pool:
+        sheet_lists = await asyncio.gather(*(
+            loop.run_in_executor(pool, _list_source_sheets, f["data"], f["name"]) for f in files
+        ))
+        tasks = [
+            (f, sheet, f["name"] if len(sheets) == 1 else f"{f['name']} / {sheet}")
+            for f, sheets in zip(files, sheet_lists)
+            for sheet in sheets
+        ]
+        parsed = await asyncio.gather(*(
+            loop.run_in_executor(pool, _parse_ingest_sheet, f["data"], f["name"], sheet, profile is not None)
+            for f, sheet, _ in tasks
+        ))
+
+    sources, skipped = [], []
+    for (f, _, name), result in zip(tasks, parsed):
+        if result is None:
+            skipped.append(name)
+            continue
+        sheet_profile = result.pop("profile", None)
+        if profile is not None and sheet_profile:
+            profile.merge(RuleProfile(sheet_profile))
+        sources.append({"name": name, "file": f["name"], **result})
+    return sources, skipped
+
+
+def _ingest_session_markup(n_files: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✅ Обработать ({n_files})", callback_data="ingest_run")],
+        [InlineKeyboardButton("❌ Отмена", callback_data="ingest_cancel")],
+    ])
+
+
+def _ingest_uploads(context, user_id: int) -> list[dict]:
+    """
+    Файлы сессии загрузки {"name", "data"} — в памяти, в bot_data: user_data
+    сохраняется на диск, а байтам прайсов там не место.
+    """
+    return context.application.bot_data.setdefault("ingest_uploads", {}).setdefault(user_id, [])
+
+
+def _reset_ingest_session(context, user_id: int) -> None:
+    """Завершает сессию загрузки и отбрасывает её файлы."""
+    context.user_data["awaiting_file"] = False
+    context.application.bot_data.get("ingest_uploads", {}).pop(user_id, None)
 
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None: 
-    """При получении документа проверяем, что это .xlsx, скачиваем и обрабатываем."""
+    """Принимаем .xlsx/.csv/.tsv в сессию загрузки; обработка — по кнопке «Обработать»."""
     user_id = update.effective_user.id if update.effective_user else None
     awaiting_file = context.user_data.get("awaiting_file")
     if not user_id or not is_admin(user_id) or not awaiting_file:
@@ -921,140 +2543,1692 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    # Сбрасываем флаг ожидания файла
-    context.user_data["awaiting_file"] = False
-
     document = update.message.document
     if not document:
         return
 
-    if not document.file_name.lower().endswith(".xlsx"):
+    if not document.file_name.lower().endswith(INGEST_EXTENSIONS):
         await update.message.reply_text(
-            "Пожалуйста, отправьте файл в формате .xlsx. Другие форматы не поддерживаются."
+            "Пожалуйста, отправьте файл в формате .xlsx, .csv или .tsv. Другие форматы не поддерживаются."
         )
         return
 
-    # Сохраняем файл во временную директорию
-    tmp_dir = Path(tempfile.mkdtemp())
-    src_path = tmp_dir / document.file_name
+    files = _ingest_uploads(context, user_id)
+    if len(files) >= INGEST_MAX_FILES:
+        await update.message.reply_text(
+            f"В одной загрузке не больше {INGEST_MAX_FILES} файлов. Нажмите «Обработать».",
+            reply_markup=_ingest_session_markup(len(files)),
+        )
+        return
+
+    # Скачиваем сразу в память: разбор идёт из буфера, без временных файлов
     file_obj = await document.get_file()
-    await file_obj.download_to_drive(str(src_path))
+    buffer = io.BytesIO()
+    await file_obj.download_to_memory(buffer)
+    files.append({"name": document.file_name, "data": buffer.getvalue()})
+
+    await update.message.reply_text(
+        f"Файл принят: {document.file_name} (всего: {len(files)}).\n"
+        "Отправьте ещё файлы или нажмите «Обработать».",
+        reply_markup=_ingest_session_markup(len(files)),
+    )
+
 
+async def run_ingest_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Кнопка «Обработать»: разбор всех файлов сессии, слияние и обновление каталога."""
+    query = update.callback_query
+    user_id = query.from_user.id
+    files = list(_ingest_uploads(context, user_id))
+    if not files:
+        await query.answer("Нет загруженных файлов.", show_alert=True)
+        return
+    await query.answer()
+    _reset_ingest_session(context, user_id)
+    semaphore = _action_semaphore(context, "ingest", INGEST_CONCURRENCY)
+    if semaphore.locked():
+        await query.edit_message_text(f"Файлов: {len(files)}. Идёт другая загрузка — обработаю следом…")
+    async with semaphore:
+        await query.edit_message_text(f"Обрабатываю файлов: {len(files)}…")
+        await _process_ingest_files(update, context, files)
+
+
+async def _process_ingest_files(update: Update, context: ContextTypes.DEFAULT_TYPE, files: list[dict]) -> None:
+    """Разбор, слияние и применение файлов сессии; вызывается под семафором загрузок."""
     try:
-        # Читаем Excel
-        df = pd.read_excel(src_path)
+        profile = RuleProfile() if context.application.bot_data.get("classify_profile") else None
+        sources, skipped = await _parse_ingest_files(files, profile)
+        catalog, excel_price_by_desc = _merge_ingest_sources(sources)
     except Exception as exc:
-        await update.message.reply_text(
-            "Не удалось прочитать файл как Excel: " f"{exc}"
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Не удалось прочитать файл: " f"{exc}",
         )
         return
 
-    # Сохраняем копию файла, чтобы пользователи могли скачивать актуальную версию
+    # Сохраняем копию первого Excel-файла, чтобы пользователи могли скачивать актуальную версию:
+    # запись в отдельном потоке, через временный файл и os.replace — без полузаписанного файла
+    first_xlsx = next((f["data"] for f in files if f["name"].lower().endswith(".xlsx")), None)
+    if first_xlsx:
+        try:
+            await asyncio.to_thread(_atomic_write_bytes, Path(LATEST_EXCEL_FILE), first_xlsx)
+        except Exception:
+            pass
+
+    label = "загрузка: " + ", ".join(f["name"] for f in files)
+    if not await _apply_ingested_catalog(context, catalog, excel_price_by_desc, label):
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Не удалось сформировать категории по описанию.",
+        )
+        return
     try:
-        shutil.copy(src_path, LATEST_EXCEL_FILE)
+        price_changes = await _record_prices(context)
     except Exception:
-        pass
-
-    # Строим каталог по описанию
-    catalog: dict[str, dict[str, list[dict[str, str]]]] = {}
-    for _, row in df.iterrows():
-        desc = str(row.get("description") or row.get("desription") or "")
-        price = row.get("price") or row.get("Цена") or row.get("Price") or ""
-        cat, sub = extract_category(desc)
-        catalog.setdefault(cat, {}).setdefault(sub, []).append({"desc": desc, "price": price})
-
+        # Журнал цен вспомогательный: его сбой не должен отменять загрузку
+        price_changes = []
+    _notify_watchers(context, price_changes)
+    _notify_subscribers(context, price_changes)
+
+    # После успешной загрузки каталога выводим отчёт по источникам
+    lines = ["Каталог успешно добавлен, нажмите /start, чтобы ознакомиться с категориями"]
+    if len(sources) > 1:
+        total = sum(len(items) for subs in catalog.values() for items in subs.values())
+        lines.append("")
+        lines.append(
+            f"Источников: {len(sources)}, позиций после слияния: {total} "
+            f"(правило: {MERGE_RULE_TITLES.get(INGEST_MERGE_RULE, INGEST_MERGE_RULE)})"
+        )
+        for src in sources:
+            lines.append(f"• {src['name']}: строк {src['rows']}, оставлено {src['kept']}, дублей {src['dropped']}")
+    if skipped:
+        lines.append("Пропущены листы без колонки description: " + ", ".join(skipped))
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(lines))
+    if profile is not None:
+        context.application.bot_data["classify_profile_report"] = profile
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=profile.format())
+
+
+async def _apply_ingested_catalog(
+    context: ContextTypes.DEFAULT_TYPE, catalog: dict, excel_price_by_desc: dict, label: str = "загрузка прайса"
+) -> bool:
+    """
+    Синхронизирует ручные слои с новым прайсом и сохраняет каталог. False — каталог пуст.
+    Состояние до и после попадает в историю версий (label — подпись новой версии).
+    """
     # === СИНХРОНИЗАЦИЯ ПЕРЕНЕСЁННЫХ (moved_overrides) С EXCEL И УБОРКА ДУБЛЕЙ ===
-    def _norm_desc(s: str) -> str:
-        import re as _re
-        return _re.sub(r"\s+", " ", str(s or "").strip().lower())
-
-    # 1) Карта "нормализованное описание -> цена" из Excel
-    excel_price_by_desc: dict[str, str] = {}
-    for _, row in df.iterrows():
-        d = str(row.get("description") or row.get("desription") or "")
-        p = row.get("price") or row.get("Цена") or row.get("Price") or ""
-        excel_price_by_desc[_norm_desc(d)] = p
-
-    # 2) Обновляем цены в moved_overrides и удаляем те, которых больше нет в Excel
-    overrides = context.application.bot_data.get("moved_overrides")
-    if overrides is None:
-        overrides = _load_moved_overrides()
-
-    changed = False
-    to_del_cats = []
-    for cat, brands in list(overrides.items()):
-        to_del_brands = []
-        for brand, items in list(brands.items()):
-            new_items = []
-            for it in items:
-                key = _norm_desc(it.get("desc", ""))
-                if key in excel_price_by_desc:
-                    new_price = excel_price_by_desc[key]
+    # Работаем через ItemIndex: перебираем только ключи ручных слоёв, без
+    # повторной нормализации их описаний и без вложенных проходов по каталогу.
+    async with catalog_writer(context):
+        bot_data = context.application.bot_data
+        if bot_data.get("moved_overrides") is None:
+            bot_data["moved_overrides"] = _load_moved_overrides()
+        if bot_data.get("manual_categories") is None:
+            bot_data["manual_categories"] = _load_manual_categories()
+        overrides = bot_data["moved_overrides"]
+        await _record_history(context, HISTORY_MANUAL_LABEL)
+        index = _get_item_index(context)
+
+        # 2) Обновляем цены в moved_overrides и удаляем те, которых больше нет в Excel
+        changed = False
+        doomed: dict[tuple[str, str], set[int]] = {}
+        for key, entries in list(index.layers[LAYER_MOVED].items()):
+            if key in excel_price_by_desc:
+                new_price = excel_price_by_desc[key]
+                for _, _, it in entries:
                     if str(it.get("price", "")) != str(new_price):
                         it["price"] = new_price
                         changed = True
-                    new_items.append(it)
+            else:
+                # Позиции больше нет в Excel -> удаляем из перенесённых
+                for cat, brand, it in list(entries):
+                    doomed.setdefault((cat, brand), set()).add(id(it))
+                    index.remove(LAYER_MOVED, it, key)
+                changed = True
+        for (cat, brand), ids in doomed.items():
+            _drop_from_layer(overrides, cat, brand, ids)
+
+        if changed:
+            _save_moved_overrides(overrides)
+            _bump_catalog_version(context)
+
+        # 3) Убираем из авто-каталога все позиции, что уже есть в moved_overrides ИЛИ manual_categories
+        new_auto = ItemIndex(catalog)
+        new_keys = new_auto.layers[LAYER_AUTO]
+        doomed = {}
+        for layer in (LAYER_MOVED, LAYER_MANUAL):
+            for key in index.layers[layer]:
+                for cat, sub, item in new_keys.pop(key, ()):
+                    doomed.setdefault((cat, sub), set()).add(id(item))
+        for (cat, sub), ids in doomed.items():
+            _drop_from_layer(catalog, cat, sub, ids)
+        # === КОНЕЦ СИНХРОНИЗАЦИИ ===
+
+        if not catalog:
+            return False
+
+        # Сохраняем каталог в bot_data (общий для всех пользователей)
+        bot_data["catalog"] = catalog
+        # Индекс: новый авто-слой уже посчитан выше, ручные слои не менялись
+        index.layers[LAYER_AUTO] = new_keys
+        index.sources = (catalog, *index.sources[1:])
+        # А также на диск, чтобы каталог сохранялся между перезапусками бота
+        _save_catalog_to_disk(catalog)
+        _bump_catalog_version(context)
+        await _record_history(context, label)
+    return True
+
+
+# -------------------------------------------------------------------
+# Горячая замена правил классификации: /reload_rules
+# -------------------------------------------------------------------
+RECLASSIFY_ATTEMPTS = 3
+
+
+def _regroup_layer(entries: list[tuple], results: list[tuple[str, str]]) -> tuple[dict, Counter]:
+    """Раскладывает товары слоя по новым (категория, подкатегория); + счётчик переходов откуда → куда."""
+    layer: dict[str, dict[str, list[dict]]] = {}
+    moves: Counter = Counter()
+    for (cat, sub, item), (new_cat, new_sub) in zip(entries, results):
+        layer.setdefault(new_cat, {}).setdefault(new_sub, []).append(item)
+        if (cat, sub) != (new_cat, new_sub):
+            moves[(cat, sub), (new_cat, new_sub)] += 1
+    return layer, moves
+
+
+async def _plan_reclassification(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    """
+    Прогоняет текущие правила по всем авто-товарам (порциями в пуле процессов).
+    План ничего не меняет: новый слой, переходы и версия каталога, от которой считали.
+    Перенесённые и ручные позиции — решения админа, их не трогаем.
+    """
+    bot_data = context.application.bot_data
+    version = _catalog_version(context)
+    auto = bot_data.get("catalog") or {}
+    entries = [(cat, sub, item) for cat, subs in auto.items() for sub, items in subs.items() for item in items]
+    results = await _classify_in_workers([str(item.get("desc", "")) for _, _, item in entries])
+    new_auto, moves = _regroup_layer(entries, results)
+    return {"version": version, "catalog": new_auto, "moves": moves, "total": len(entries)}
+
+
+async def _apply_reclassification(context: ContextTypes.DEFAULT_TYPE, plan: dict) -> bool:
+    """Публикует план одной заменой слоя; False — каталог успели изменить после расчёта."""
+    bot_data = context.application.bot_data
+    async with catalog_writer(context):
+        if bot_data.get("catalog_version", 0) != plan["version"]:
+            return False
+        if plan["moves"]:
+            await _record_history(context, HISTORY_MANUAL_LABEL)
+            bot_data["catalog"] = plan["catalog"]
+            _save_catalog_to_disk(plan["catalog"])
+            _bump_catalog_version(context)
+            await _record_history(context, "переклассификация")
+    return True
+
+
+async def _reclassify_auto_layer(context: ContextTypes.DEFAULT_TYPE) -> tuple[int, int] | None:
+    """
+    План + применение без подтверждения (после /reload_rules). Если каталог
+    изменился, пока шёл расчёт, — считаем заново. None — так и не удалось.
+    """
+    for _ in range(RECLASSIFY_ATTEMPTS):
+        plan = await _plan_reclassification(context)
+        if await _apply_reclassification(context, plan):
+            return sum(plan["moves"].values()), plan["total"]
+    return None
+
+
+async def _reclassify_in_background(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    try:
+        outcome = await _reclassify_auto_layer(context)
+    except Exception as exc:
+        await context.bot.send_message(chat_id=chat_id, text=f"Переклассификация не удалась: {exc}")
+        return
+    if outcome is None:
+        text = "Каталог всё время меняется — переклассификация отложена. Повторите /reload_rules позже."
+    else:
+        moved, total = outcome
+        text = f"Каталог переклассифицирован: перемещено {moved} из {total} позиций."
+    await context.bot.send_message(chat_id=chat_id, text=text)
+
+
+async def reload_rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /reload_rules — перечитать classification_rules.json без перезапуска (только админ)."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id or not is_admin(user_id):
+        await update.message.reply_text("Извините, команда доступна только администратору.")
+        return
+    try:
+        ruleset = await asyncio.to_thread(_load_ruleset)
+    except RulesetError as exc:
+        errors = [str(e) for e in exc.args]
+        text = "Файл правил не принят, действуют прежние правила:\n• " + "\n• ".join(errors[:20])
+        if len(errors) > 20:
+            text += f"\n…и ещё {len(errors) - 20}"
+        await update.message.reply_text(text)
+        return
+    except (OSError, ValueError) as exc:
+        await update.message.reply_text(f"Не удалось прочитать файл правил: {exc}")
+        return
+
+    _install_ruleset(ruleset)
+    await update.message.reply_text(
+        f"Правила обновлены: {len(ruleset.rules)} правил, {len(ruleset.brands)} брендов. "
+        "Переклассифицирую каталог в фоне — бот продолжает работать."
+    )
+    context.application.create_task(
+        _reclassify_in_background(context, update.effective_chat.id), update=update
+    )
+
+
+# -------------------------------------------------------------------
+# История версий каталога (обратные дельты) и /rollback
+# -------------------------------------------------------------------
+CATALOG_HISTORY_FILE = "catalog_history.json.gz"
+CATALOG_HISTORY_KEEP = int(os.getenv("CATALOG_HISTORY_KEEP", "20"))
+HISTORY_MANUAL_LABEL = "правки вручную"
+
+
+def _copy_state(layers: list) -> list[dict]:
+    """Независимая копия слоёв: товары — плоские словари, копируем до уровня товара."""
+    return [
+        {cat: {sub: [dict(it) for it in items] for sub, items in subs.items()} for cat, subs in (layer or {}).items()}
+        for layer in layers
+    ]
+
+
+def _history_state(bot_data: dict) -> list[dict]:
+    """Независимая копия слоёв auto / moved / manual."""
+    return _copy_state([bot_data.get("catalog"), bot_data.get("moved_overrides"), bot_data.get("manual_categories")])
+
+
+def _state_items(state: list[dict]) -> int:
+    return sum(len(items) for layer in state for subs in layer.values() for items in subs.values())
+
+
+def _delta_items(base: list[dict], target: list[dict]) -> list | None:
+    """
+    Как получить target из base: [начало, длина] — отрезок base, dict — новый товар.
+    None — списки совпадают. Неизменённые товары хранятся только номерами.
+    Сначала сверяем по порядку (обычно товары стоят на тех же местах), при
+    расхождении ищем равный товар в base по описанию.
+    """
+    if base == target:
+        return None
+    by_desc: dict | None = None
+    ops: list = []
+    nxt = 0
+    for item in target:
+        i = nxt if nxt < len(base) and base[nxt] == item else None
+        if i is None:
+            if by_desc is None:
+                by_desc = {}
+                for j, it in enumerate(base):
+                    by_desc.setdefault(it.get("desc"), []).append(j)
+            i = next((j for j in by_desc.get(item.get("desc"), ()) if base[j] == item), None)
+        if i is None:
+            ops.append(item)
+            nxt += 1
+            continue
+        if ops and isinstance(ops[-1], list) and sum(ops[-1]) == i:
+            ops[-1][1] += 1
+        else:
+            ops.append([i, 1])
+        nxt = i + 1
+    return ops
+
+
+def _delta_layer(base: dict, target: dict) -> dict:
+    """Дельта слоя: порядок категорий/подкатегорий target (None — как в base) + изменённые подкатегории."""
+    keys = [[cat, list(subs)] for cat, subs in target.items()]
+    ops: dict[str, dict[str, list]] = {}
+    for cat, subs in target.items():
+        base_subs = base.get(cat, {})
+        for sub, items in subs.items():
+            delta = _delta_items(base_subs.get(sub, []), items)
+            if delta is not None:
+                ops.setdefault(cat, {})[sub] = delta
+    same_keys = keys == [[cat, list(subs)] for cat, subs in base.items()]
+    return {"keys": None if same_keys else keys, "ops": ops}
+
+
+def _apply_layer_delta(base: dict, delta: dict) -> dict:
+    keys = delta["keys"] if delta["keys"] is not None else [[cat, list(subs)] for cat, subs in base.items()]
+    layer: dict[str, dict[str, list]] = {}
+    for cat, subs in keys:
+        target_subs = layer.setdefault(cat, {})
+        for sub in subs:
+            src = base.get(cat, {}).get(sub, [])
+            ops = delta["ops"].get(cat, {}).get(sub)
+            if ops is None:
+                target_subs[sub] = list(src)
+                continue
+            items = target_subs[sub] = []
+            for op in ops:
+                if isinstance(op, list):
+                    items.extend(src[op[0]:op[0] + op[1]])
                 else:
-                    # Позиции больше нет в Excel -> удаляем из перенесённых
-                    changed = True
-            if new_items:
-                overrides[cat][brand] = new_items
+                    items.append(op)
+    return layer
+
+
+def _load_history() -> dict | None:
+    import gzip
+
+    try:
+        with gzip.open(CATALOG_HISTORY_FILE, "rt", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_history(history: dict) -> None:
+    import gzip
+
+    try:
+        data = gzip.compress(json.dumps(history, ensure_ascii=False).encode("utf-8"), compresslevel=5)
+        _atomic_write_bytes(Path(CATALOG_HISTORY_FILE), data)
+    except Exception:
+        pass
+
+
+def _history_commit(history: dict | None, state: list[dict], label: str) -> dict | None:
+    """
+    Новая история, где state — текущая версия (head). Прежняя head уходит в back
+    как дельта «новая → прежняя», поэтому полная копия в файле одна, остальные
+    версии — дельты. None — состояние не изменилось, записывать нечего.
+    Переданную history не меняет: её в это время может сохранять фоновый поток.
+    """
+    head = {"at": time.time(), "label": label, "items": _state_items(state), "state": state}
+    if history is None:
+        return {"seq": 1, "head": {"id": 1, **head}, "back": []}
+    prev = history["head"]
+    if prev["state"] == state:
+        return None
+    delta = [_delta_layer(new, old) for new, old in zip(state, prev["state"])]
+    back = [{k: v for k, v in prev.items() if k != "state"} | {"delta": delta}, *history["back"]]
+    seq = history["seq"] + 1
+    return {"seq": seq, "head": {"id": seq, **head}, "back": back[:CATALOG_HISTORY_KEEP]}
+
+
+def _history_restore(history: dict, version_id: int) -> list[dict] | None:
+    """
+    Слои версии version_id: от head по дельтам назад. None — такой версии нет.
+    Товары общие с историей (и дельта может сослаться на один товар дважды) —
+    перед тем как отдать слои в bot_data, их копируют (_copy_state).
+    """
+    state = history["head"]["state"]
+    found = history["head"]["id"] == version_id
+    for entry in history["back"]:
+        if found:
+            break
+        state = [_apply_layer_delta(layer, delta) for layer, delta in zip(state, entry["delta"])]
+        found = entry["id"] == version_id
+    return state if found else None
+
+
+def _history_stamp() -> tuple[int, int] | None:
+    try:
+        st = os.stat(CATALOG_HISTORY_FILE)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+async def _get_history(bot_data: dict) -> dict:
+    """
+    bot_data["catalog_history"]: разобранная история (history, None — пусто),
+    version — catalog_version, при которой записана head (только в этом процессе),
+    task — фоновая запись файла. Файл читается один раз; в общем режиме — заново,
+    если его переписал другой воркер.
+    """
+    cache = bot_data.get("catalog_history")
+    if cache is not None and not (SHARED_CATALOG_DIR and cache["stamp"] != _history_stamp()):
+        return cache
+    if cache is not None and cache["task"] is not None:
+        await cache["task"]
+    stamp = _history_stamp()
+    history = await asyncio.to_thread(_load_history)
+    cache = bot_data["catalog_history"] = {"history": history, "version": None, "stamp": stamp, "task": None}
+    return cache
+
+
+async def _write_history_behind(cache: dict) -> None:
+    """Пишет файл, пока в памяти есть несохранённая версия; промежуточные версии пропускаются."""
+    saved = None
+    while cache["history"] is not saved:
+        saved = cache["history"]
+        await asyncio.to_thread(_save_history, saved)
+        cache["stamp"] = _history_stamp()
+
+
+async def _flush_history(bot_data: dict) -> None:
+    cache = bot_data.get("catalog_history")
+    if cache is not None and cache["task"] is not None:
+        await cache["task"]
+
+
+async def _record_history(context, label: str, state: list[dict] | None = None) -> None:
+    """
+    Записывает текущие слои (или готовый state, не связанный с bot_data) как версию,
+    если они отличаются от последней записанной. Вызывается внутри catalog_writer:
+    до крупного изменения (с HISTORY_MANUAL_LABEL — сохранить накопившиеся правки
+    админа) и после него. Если каталог не менялся с записи head, нечего и сравнивать.
+
+    История живёт в памяти, файл дописывается в фоне. В общем режиме файл пишется
+    сразу: следующий писатель — возможно, другой воркер — должен увидеть эту версию.
+    """
+    bot_data = context.application.bot_data
+    cache = await _get_history(bot_data)
+    version = bot_data.get("catalog_version", 0)
+    if state is None:
+        if cache["history"] is not None and cache["version"] == version:
+            return
+        state = _history_state(bot_data)
+    history = await asyncio.to_thread(_history_commit, cache["history"], state, label)
+    cache["version"] = version
+    if history is None:
+        return
+    cache["history"] = history
+    if cache["task"] is None or cache["task"].done():
+        cache["task"] = asyncio.get_running_loop().create_task(_write_history_behind(cache))
+    if SHARED_CATALOG_DIR:
+        await cache["task"]
+
+
+def _format_history_entry(entry: dict) -> str:
+    at = time.strftime("%d.%m.%Y %H:%M", time.localtime(entry["at"]))
+    return f"#{entry['id']} — {at} — {entry['label']} ({entry['items']} поз.)"
+
+
+async def rollback_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /rollback [номер] — список сохранённых версий каталога или откат к версии (только админ)."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id or not is_admin(user_id):
+        await update.message.reply_text("Извините, команда доступна только администратору.")
+        return
+    args = context.args or []
+    bot_data = context.application.bot_data
+    if not args:
+        history = (await _get_history(bot_data))["history"]
+        if not history:
+            await update.message.reply_text("История версий пока пуста: она появится после загрузки прайса.")
+            return
+        lines = ["Текущая версия:", _format_history_entry(history["head"])]
+        if history["back"]:
+            lines.append("\nПредыдущие:")
+            lines.extend(_format_history_entry(e) for e in history["back"])
+            lines.append("\nОткатить: /rollback <номер>")
+        await update.message.reply_text("\n".join(lines))
+        return
+    try:
+        version_id = int(args[0].lstrip("#"))
+    except ValueError:
+        await update.message.reply_text("Использование: /rollback <номер версии>")
+        return
+
+    state = None
+    async with catalog_writer(context):
+        # Несохранённые правки админа — отдельной версией, чтобы откат тоже можно было отменить
+        await _record_history(context, HISTORY_MANUAL_LABEL)
+        history = (await _get_history(bot_data))["history"]
+        if history:
+            state = _history_restore(history, version_id)
+        if state is not None:
+            current_id = history["head"]["id"]
+            layers = _copy_state(state)
+            bot_data["catalog"], bot_data["moved_overrides"], bot_data["manual_categories"] = layers
+            _save_catalog_to_disk(layers[LAYER_AUTO])
+            _save_moved_overrides(layers[LAYER_MOVED])
+            _save_manual_categories(layers[LAYER_MANUAL])
+            _bump_catalog_version(context)
+            # Слои версии уже есть в памяти — снимок заново не снимаем
+            await _record_history(context, f"откат к #{version_id}", state)
+    if state is None:
+        await update.message.reply_text(f"Версия #{version_id} не найдена. Список: /rollback")
+        return
+    await update.message.reply_text(
+        f"✅ Каталог возвращён к версии #{version_id} ({_state_items(state)} поз.).\n"
+        f"Вернуть как было: /rollback {current_id}"
+    )
+
+
+# -------------------------------------------------------------------
+# Журнал цен: только изменения, по одной записи на товар и загрузку
+# -------------------------------------------------------------------
+PRICE_HISTORY_FILE = os.getenv("PRICE_HISTORY_FILE", "price_history.sqlite3")
+# Сколько дней хранить изменения; у каждого товара остаётся последняя цена до этой границы
+PRICE_HISTORY_DAYS = int(os.getenv("PRICE_HISTORY_DAYS", "730"))
+PRICE_HISTORY_COMPACT_EVERY = 24 * 3600
+
+
+class PriceChange(NamedTuple):
+    """Изменение цены товара при загрузке; None — товара нет в прайсе (или нет цены)."""
+    key: str
+    desc: str
+    cat: str
+    sub: str
+    old: float | None
+    new: float | None
+    is_new: bool
+
+
+class PriceHistory:
+    """
+    Append-only журнал цен в SQLite.
+
+    items   — товар по устойчивому ключу (_norm_desc описания) + последняя цена;
+    changes — (item_id, at, price) только когда цена поменялась; NULL — товар
+              пропал из прайса. Таблица WITHOUT ROWID с ключом (item_id, at):
+              история товара лежит подряд, а индекс items(cat, sub) даёт выборку по категории.
+    """
+
+    def __init__(self, path: str):
+        import sqlite3
+        import threading
+
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE,
+                desc TEXT NOT NULL, cat TEXT NOT NULL, sub TEXT NOT NULL, price NUMERIC
+            );
+            CREATE INDEX IF NOT EXISTS items_cat ON items (cat, sub);
+            CREATE TABLE IF NOT EXISTS changes (
+                item_id INTEGER NOT NULL, at INTEGER NOT NULL, price NUMERIC, PRIMARY KEY (item_id, at)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+            """
+        )
+        self._lock = threading.Lock()
+
+    def record(self, rows: dict[str, tuple], at: int | None = None) -> list[PriceChange]:
+        """
+        rows: ключ → (описание, категория, подкатегория, цена-число или None).
+        Дописывает изменения цен против последних известных; товары, которых нет
+        в rows, получают запись NULL. None в rows — цена есть, но нечисловая
+        («по запросу»): такой товар не считается пропавшим, а журнал его не трогает.
+        Возвращает записанные изменения.
+        """
+        at = int(at if at is not None else time.time())
+        with self._lock:
+            known = {key: (item_id, price, desc, cat, sub) for item_id, key, price, desc, cat, sub in
+                     self._db.execute("SELECT id, key, price, desc, cat, sub FROM items")}
+            appended: list[tuple] = []
+            updated: list[tuple] = []
+            changes: list[PriceChange] = []
+            self._db.execute("BEGIN")
+            try:
+                for key, (desc, cat, sub, price) in rows.items():
+                    old = known.pop(key, None)
+                    if price is None:
+                        continue
+                    if old is None:
+                        item_id = self._db.execute(
+                            "INSERT INTO items (key, desc, cat, sub, price) VALUES (?, ?, ?, ?, ?)",
+                            (key, desc, cat, sub, price),
+                        ).lastrowid
+                        appended.append((item_id, at, price))
+                        changes.append(PriceChange(key, desc, cat, sub, None, price, True))
+                        continue
+                    item_id, old_price, *place = old
+                    if old_price != price:
+                        appended.append((item_id, at, price))
+                        changes.append(PriceChange(key, desc, cat, sub, old_price, price, False))
+                    if old_price != price or place != [desc, cat, sub]:
+                        updated.append((desc, cat, sub, price, item_id))
+                for key, (item_id, old_price, *place) in known.items():
+                    if old_price is not None:
+                        appended.append((item_id, at, None))
+                        updated.append((*place, None, item_id))
+                        changes.append(PriceChange(key, *place, old_price, None, False))
+                self._db.executemany("UPDATE items SET desc = ?, cat = ?, sub = ?, price = ? WHERE id = ?", updated)
+                self._db.executemany("INSERT OR REPLACE INTO changes (item_id, at, price) VALUES (?, ?, ?)", appended)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return changes
+
+    def item(self, key: str, limit: int = 10) -> tuple[tuple, list[tuple]] | None:
+        """((описание, категория, подкатегория, цена), [(at, price), …] от новых к старым)."""
+        with self._lock:
+            row = self._db.execute("SELECT id, desc, cat, sub, price FROM items WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            changes = self._db.execute(
+                "SELECT at, price FROM changes WHERE item_id = ? ORDER BY at DESC LIMIT ?", (row[0], limit)
+            ).fetchall()
+        return row[1:], changes
+
+    def category(self, cat: str, since: int, limit: int = 20) -> list[tuple]:
+        """Изменения цен категории после since: (at, описание, подкатегория, было, стало), новые первыми."""
+        with self._lock:
+            return self._db.execute(
+                """
+                SELECT c.at, i.desc, i.sub,
+                       (SELECT p.price FROM changes p WHERE p.item_id = c.item_id AND p.at < c.at
+                        ORDER BY p.at DESC LIMIT 1),
+                       c.price
+                FROM items i JOIN changes c ON c.item_id = i.id
+                WHERE i.cat = ? AND c.at >= ?
+                ORDER BY c.at DESC LIMIT ?
+                """,
+                (cat, since, limit),
+            ).fetchall()
+
+    def compact(self, keep_days: int = PRICE_HISTORY_DAYS, force: bool = False) -> int:
+        """
+        Удаляет изменения старше keep_days, оставляя каждому товару последнюю цену
+        до границы (от неё считается следующее изменение), и давно пропавшие товары.
+        Без force — не чаще раза в PRICE_HISTORY_COMPACT_EVERY. Возвращает число удалённых записей.
+        """
+        now = int(time.time())
+        cutoff = now - keep_days * 86400
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'compacted_at'").fetchone()
+            if not force and row and now - row[0] < PRICE_HISTORY_COMPACT_EVERY:
+                return 0
+            self._db.execute("BEGIN")
+            try:
+                deleted = self._db.execute(
+                    """
+                    DELETE FROM changes WHERE at < ?1 AND at < (
+                        SELECT MAX(p.at) FROM changes p WHERE p.item_id = changes.item_id AND p.at < ?1
+                    )
+                    """,
+                    (cutoff,),
+                ).rowcount
+                gone = "SELECT id FROM items WHERE price IS NULL AND NOT EXISTS " \
+                       "(SELECT 1 FROM changes c WHERE c.item_id = items.id AND c.at >= ?)"
+                deleted += self._db.execute(f"DELETE FROM changes WHERE item_id IN ({gone})", (cutoff,)).rowcount
+                self._db.execute(
+                    "DELETE FROM items WHERE price IS NULL AND NOT EXISTS (SELECT 1 FROM changes c WHERE c.item_id = items.id)"
+                )
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('compacted_at', ?)", (now,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            # Удалённые записи разбросаны по всем товарам — страницы пустеют частично,
+            # место возвращает только пересборка файла (раз в сутки, база небольшая)
+            if deleted:
+                self._db.execute("VACUUM")
+        return deleted
+
+
+_price_history: PriceHistory | None = None
+
+
+def _get_price_history() -> PriceHistory:
+    global _price_history
+    if _price_history is None:
+        _price_history = PriceHistory(PRICE_HISTORY_FILE)
+    return _price_history
+
+
+async def _record_prices(context) -> list[PriceChange]:
+    """После загрузки прайса: цены объединённого каталога → журнал (в отдельном потоке) + плановая чистка."""
+    rows = {}
+    for cat, sub, item in _get_catalog_store(context).iter_rows():
+        desc = item.desc
+        rows[_norm_desc(desc)] = (desc, cat, sub, _price_number(item.price))
+
+    def work() -> list[PriceChange]:
+        history = _get_price_history()
+        changes = history.record(rows)
+        history.compact()
+        return changes
+
+    return await asyncio.to_thread(work)
+
+
+def _format_amount(value) -> str:
+    return f"{value:,.0f}".replace(",", " ")
+
+
+def _format_price_change(old, new) -> str:
+    """«75 000 ₽ (−5 000)»; None — товара не было в прайсе."""
+    if new is None:
+        return "нет в прайсе"
+    text = f"{_format_amount(new)} ₽"
+    if old is not None and old != new:
+        text += f" ({'+' if new > old else '−'}{_format_amount(abs(new - old))})"
+    return text
+
+
+PRICE_HISTORY_ITEMS = 3
+PRICE_HISTORY_CATEGORY_DAYS = 30
+
+
+async def price_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Команда /price_history <запрос> — последние изменения цены найденных товаров;
+    /price_history <категория> — изменения цен в категории за PRICE_HISTORY_CATEGORY_DAYS дней.
+    """
+    raw = " ".join(context.args or []).strip()
+    if not raw:
+        await update.message.reply_text("Использование: /price_history <товар или категория>")
+        return
+    if await _rate_limited(update, context, "search"):
+        return
+    history = _get_price_history()
+    store = _get_catalog_store(context)
+    cat = next((c for c in store.categories if c.lower() == raw.lower()), None)
+    if cat is not None:
+        since = int(time.time()) - PRICE_HISTORY_CATEGORY_DAYS * 86400
+        rows = await asyncio.to_thread(history.category, cat, since)
+        if not rows:
+            await update.message.reply_text(f"В категории «{cat}» цены за {PRICE_HISTORY_CATEGORY_DAYS} дней не менялись.")
+            return
+        lines = [f"📈 <b>{html.escape(cat)}</b>: изменения цен за {PRICE_HISTORY_CATEGORY_DAYS} дней"]
+        for at, desc, sub, old, new in rows:
+            day = time.strftime("%d.%m", time.localtime(at))
+            lines.append(f"{day} — {html.escape(desc)} ({html.escape(sub)}): {_format_price_change(old, new)}")
+        await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+        return
+
+    results, _ = _search_catalog(context, raw)
+    keys = list(dict.fromkeys(_norm_desc(item["desc"]) for _, _, item in results))[:PRICE_HISTORY_ITEMS]
+    blocks = []
+    for key in keys:
+        found = await asyncio.to_thread(history.item, key)
+        if found is None:
+            continue
+        (desc, cat, sub, _), changes = found
+        lines = [f"📈 <b>{html.escape(desc)}</b>", f"<i>{html.escape(cat)} / {html.escape(sub)}</i>"]
+        # changes — от новых к старым; разница считается к предыдущей записи
+        for (at, price), older in zip(changes, changes[1:] + [(None, None)]):
+            day = time.strftime("%d.%m.%Y", time.localtime(at))
+            lines.append(f"{day} — {_format_price_change(older[1], price)}")
+        blocks.append("\n".join(lines))
+    if not blocks:
+        await update.message.reply_text("История цен по запросу не найдена.")
+        return
+    await update.message.reply_text("\n\n".join(blocks), parse_mode=ParseMode.HTML)
+
+
+# -------------------------------------------------------------------
+# Очередь уведомлений: не быстрее NOTIFY_RATE сообщений в секунду
+# -------------------------------------------------------------------
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE", "25"))
+
+
+class NotificationQueue:
+    """
+    Исходящие уведомления пользователям. Один фоновый отправитель разбирает
+    очередь с паузой 1/rate между сообщениями (лимит Telegram — ~30 в секунду
+    на бота), на RetryAfter ждёт сколько велено и повторяет; заблокировавших
+    бота и прочие ошибки отправки пропускает.
+    """
+
+    def __init__(self, bot, rate: float = NOTIFY_RATE):
+        self.bot = bot
+        self.interval = 1.0 / rate
+        self.sent = 0
+        self.failed = 0
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def start(self, application) -> None:
+        if self._task is None or self._task.done():
+            self._task = application.create_task(self._run())
+
+    def put(self, chat_id: int, text: str, **kwargs) -> None:
+        self._queue.put_nowait((chat_id, text, kwargs))
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    async def join(self) -> None:
+        await self._queue.join()
+
+    async def _run(self) -> None:
+        from telegram.error import RetryAfter, TelegramError
+
+        while True:
+            chat_id, text, kwargs = await self._queue.get()
+            try:
+                while True:
+                    try:
+                        await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                        self.sent += 1
+                        break
+                    except RetryAfter as exc:
+                        await asyncio.sleep(exc.retry_after)
+                    except TelegramError:
+                        self.failed += 1
+                        break
+            finally:
+                self._queue.task_done()
+            await asyncio.sleep(self.interval)
+
+
+def _get_notification_queue(context) -> NotificationQueue:
+    bot_data = context.application.bot_data
+    queue = bot_data.get("notify_queue")
+    if queue is None:
+        queue = bot_data["notify_queue"] = NotificationQueue(context.application.bot)
+    queue.start(context.application)
+    return queue
+
+
+# -------------------------------------------------------------------
+# Наблюдение за товарами и запросами: снижение цены и возврат в продажу
+# -------------------------------------------------------------------
+WATCH_MAX_PER_USER = 30
+WATCH_CANDIDATES = 5
+WATCH_MESSAGE_LINES = 20
+
+
+def _get_watches(bot_data: dict) -> dict:
+    """
+    bot_data["watches"] (сохраняется): items — ключ товара → {"desc", "users"},
+    queries — нормализованный запрос → пользователи.
+    """
+    return bot_data.setdefault("watches", {"items": {}, "queries": {}})
+
+
+def _watch_query_terms(query: str) -> tuple[SearchQuery, frozenset[str]]:
+    """Фильтры cat:/brand: и слова запроса; русские написания брендов — в латиницу, как в поиске."""
+    parsed = _parse_search_query(query)
+    return parsed, frozenset(SEARCH_SYNONYMS.get(t, t) for t in _search_tokens(parsed.text))
+
+
+def _watch_query_index(bot_data: dict) -> dict[str, list[tuple[str, SearchQuery, frozenset[str]]]]:
+    """
+    Самое длинное (обычно самое редкое) слово запроса → [(запрос, фильтры, слова)].
+    Изменённый товар проверяется только против запросов, чьё ключевое слово есть
+    у товара; запросы из одних фильтров лежат под ключом "". Производный кэш:
+    сбрасывается при любом изменении запросов.
+    """
+    index = bot_data.get("watch_query_index")
+    if index is None:
+        index = {}
+        for query in _get_watches(bot_data)["queries"]:
+            parsed, terms = _watch_query_terms(query)
+            if terms or parsed.cat is not None or parsed.brand is not None:
+                key = max(terms, key=len) if terms else ""
+                index.setdefault(key, []).append((query, parsed, terms))
+        bot_data["watch_query_index"] = index
+    return index
+
+
+def _user_watches(bot_data: dict, user_id: int) -> list[tuple[str, str, str]]:
+    """("i", ключ, описание) и ("q", запрос, запрос) пользователя — для списка и снятия."""
+    watches = _get_watches(bot_data)
+    result = [("i", key, w["desc"]) for key, w in watches["items"].items() if user_id in w["users"]]
+    result += [("q", query, query) for query, users in watches["queries"].items() if user_id in users]
+    return result
+
+
+def _add_watch(bot_data: dict, user_id: int, kind: str, key: str, desc: str = "") -> bool:
+    """False — у пользователя уже WATCH_MAX_PER_USER подписок."""
+    if len(_user_watches(bot_data, user_id)) >= WATCH_MAX_PER_USER:
+        return False
+    watches = _get_watches(bot_data)
+    if kind == "i":
+        watches["items"].setdefault(key, {"desc": desc, "users": set()})["users"].add(user_id)
+    else:
+        watches["queries"].setdefault(key, set()).add(user_id)
+        bot_data.pop("watch_query_index", None)
+    return True
+
+
+def _remove_watch(bot_data: dict, user_id: int, kind: str, key: str) -> None:
+    watches = _get_watches(bot_data)
+    if kind == "i":
+        entry = watches["items"].get(key)
+        users = entry["users"] if entry else set()
+    else:
+        users = watches["queries"].get(key, set())
+        bot_data.pop("watch_query_index", None)
+    users.discard(user_id)
+    if not users:
+        (watches["items"] if kind == "i" else watches["queries"]).pop(key, None)
+
+
+def _match_watches(bot_data: dict, changes: list[PriceChange]) -> dict[int, list[tuple[str, PriceChange]]]:
+    """
+    Пользователь → [(повод, изменение)]. Повод: "drop" — цена снизилась,
+    "back" — товар снова в прайсе, "new" — новый товар по запросу. Каждое
+    изменение смотрит в индексы (ключ товара, ключевые токены), а не перебирает подписки.
+    """
+    watches = _get_watches(bot_data)
+    query_index = _watch_query_index(bot_data)
+    hits: dict[int, dict[str, tuple[str, PriceChange]]] = {}
+    for change in changes:
+        if change.new is None:
+            continue
+        if change.old is not None:
+            if change.new >= change.old:
+                continue
+            reason = "drop"
+        else:
+            reason = "new" if change.is_new else "back"
+        users: set[int] = set()
+        if reason != "new" and change.key in watches["items"]:
+            users |= watches["items"][change.key]["users"]
+        if query_index:
+            # Слова товара — как в поисковом индексе: описание, бренд и категория
+            tokens = set(_search_tokens(f"{change.desc} {change.cat} {change.sub}"))
+            tokens.add("")
+            for token in tokens & query_index.keys():
+                for query, parsed, terms in query_index[token]:
+                    if terms <= tokens and parsed.allows(change.cat, change.sub):
+                        users |= watches["queries"][query]
+        for user_id in users:
+            hits.setdefault(user_id, {})[change.key] = (reason, change)
+    return {user_id: list(found.values()) for user_id, found in hits.items()}
+
+
+def _format_watch_alert(found: list[tuple[str, PriceChange]]) -> str:
+    lines = ["🔔 <b>Изменения по вашим подпискам</b>"]
+    for reason, change in found[:WATCH_MESSAGE_LINES]:
+        desc = html.escape(change.desc)
+        if reason == "drop":
+            lines.append(f"📉 {desc} — {_format_price_change(change.old, change.new)}")
+        elif reason == "back":
+            lines.append(f"✅ Снова в наличии: {desc} — {_format_price_change(None, change.new)}")
+        else:
+            lines.append(f"🆕 {desc} — {_format_price_change(None, change.new)}")
+    if len(found) > WATCH_MESSAGE_LINES:
+        lines.append(f"…и ещё {len(found) - WATCH_MESSAGE_LINES}")
+    lines.append("\nУправление подписками: /watches")
+    return "\n".join(lines)
+
+
+def _notify_watchers(context, changes: list[PriceChange]) -> int:
+    """Одно сообщение на пользователя в очередь отправки; возвращает число получателей."""
+    matched = _match_watches(context.application.bot_data, changes)
+    if matched:
+        queue = _get_notification_queue(context)
+        for user_id, found in matched.items():
+            queue.put(user_id, _format_watch_alert(found), parse_mode=ParseMode.HTML)
+    return len(matched)
+
+
+async def watch_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /watch <запрос> — следить за снижением цены товара или за запросом."""
+    raw = " ".join(context.args or []).strip()
+    if not raw:
+        await update.message.reply_text(
+            "Использование: /watch <товар>, например /watch iphone 15 pro 256\n"
+            "Мы сообщим, когда цена снизится или товар снова появится. Ваши подписки: /watches"
+        )
+        return
+    if await _rate_limited(update, context, "search"):
+        return
+    results, _ = _search_catalog(context, raw)
+    candidates: dict[str, str] = {}
+    for _, _, item in results:
+        desc = str(item["desc"])
+        candidates.setdefault(_norm_desc(desc), desc)
+        if len(candidates) >= WATCH_CANDIDATES:
+            break
+    context.user_data["watch_pending"] = {"query": raw, "items": list(candidates.items())}
+    buttons = [
+        [InlineKeyboardButton(f"🔔 {desc[:60]}", callback_data=f"watch|i|{n}")]
+        for n, desc in enumerate(candidates.values())
+    ]
+    buttons.append([InlineKeyboardButton(f"🔔 Все товары по запросу «{raw[:30]}»", callback_data="watch|q")])
+    await update.message.reply_text("За чем следить?", reply_markup=InlineKeyboardMarkup(buttons))
+
+
+async def watches_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /watches — список подписок пользователя с кнопками отмены."""
+    user_id = update.effective_user.id if update.effective_user else None
+    found = _user_watches(context.application.bot_data, user_id) if user_id else []
+    if not found:
+        await update.message.reply_text("Подписок пока нет. Добавить: /watch <товар>")
+        return
+    context.user_data["watch_list"] = [(kind, key) for kind, key, _ in found]
+    buttons = [
+        [InlineKeyboardButton(f"❌ {'«' + title + '»' if kind == 'q' else title}"[:64], callback_data=f"unwatch|{n}")]
+        for n, (kind, _, title) in enumerate(found)
+    ]
+    await update.message.reply_text("Ваши подписки (нажмите, чтобы отменить):", reply_markup=InlineKeyboardMarkup(buttons))
+
+
+async def handle_watch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """watch|i|n, watch|q — подписаться на кандидата из /watch; unwatch|n — отменить из /watches."""
+    query = update.callback_query
+    parts = query.data.split("|")
+    user_id = query.from_user.id
+    bot_data = context.application.bot_data
+    if parts[0] == "unwatch":
+        watch_list = context.user_data.get("watch_list") or []
+        n = int(parts[1])
+        if n < len(watch_list):
+            _remove_watch(bot_data, user_id, *watch_list[n])
+        await query.answer("Подписка отменена.")
+        # Убираем только нажатую кнопку: номера остальных ссылаются на тот же снимок watch_list
+        rows = [row for row in query.message.reply_markup.inline_keyboard if row[0].callback_data != query.data]
+        await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(rows) if rows else None)
+        return
+
+    pending = context.user_data.get("watch_pending")
+    if not pending:
+        await query.answer("Запрос устарел — отправьте /watch ещё раз.", show_alert=True)
+        return
+    if parts[1] == "q":
+        kind, key, title = "q", " ".join(_search_tokens(pending["query"])), pending["query"]
+    else:
+        n = int(parts[2])
+        if n >= len(pending["items"]):
+            await query.answer()
+            return
+        kind, (key, title) = "i", pending["items"][n]
+    if not key or not _add_watch(bot_data, user_id, kind, key, title):
+        await query.answer(f"Не больше {WATCH_MAX_PER_USER} подписок. Список: /watches", show_alert=True)
+        return
+    context.user_data.pop("watch_pending", None)
+    await query.answer()
+    await query.edit_message_text(f"🔔 Готово: сообщим, когда подешевеет или появится «{title}».")
+
+
+# -------------------------------------------------------------------
+# Подписки на категории и бренды: уведомляем только о том, что изменилось
+# -------------------------------------------------------------------
+SUBSCRIPTION_MESSAGE_LINES = 20
+
+
+def _get_subscriptions(bot_data: dict) -> dict:
+    """
+    bot_data["subscriptions"] (сохраняется) — сам индекс «категория → подписчики»:
+    cat — категория → пользователи, sub — категория → подкатегория (бренд) → пользователи.
+    Подписка на весь каталог — прежний bot_data["subscribers"].
+    """
+    return bot_data.setdefault("subscriptions", {"cat": {}, "sub": {}})
+
+
+def _subscription_users(bot_data: dict, cat: str | None = None, sub: str | None = None) -> set[int]:
+    subs = _get_subscriptions(bot_data)
+    if cat is None:
+        return bot_data.setdefault("subscribers", set())
+    if sub is None:
+        return subs["cat"].setdefault(cat, set())
+    return subs["sub"].setdefault(cat, {}).setdefault(sub, set())
+
+
+def _toggle_subscription(bot_data: dict, user_id: int, cat: str | None = None, sub: str | None = None) -> bool:
+    """Включает/выключает подписку; True — теперь подписан."""
+    users = _subscription_users(bot_data, cat, sub)
+    if user_id in users:
+        users.discard(user_id)
+    else:
+        users.add(user_id)
+    subs = _get_subscriptions(bot_data)
+    # Пустые множества не храним — индекс остаётся компактным
+    if cat is not None and sub is None and not users:
+        subs["cat"].pop(cat, None)
+    if sub is not None and not users:
+        subs["sub"][cat].pop(sub, None)
+        if not subs["sub"][cat]:
+            subs["sub"].pop(cat, None)
+    return user_id in users
+
+
+def _subscription_fanout(bot_data: dict, changes: list[PriceChange]) -> dict[int, list[str]]:
+    """
+    Пользователь → строки сводки. Идём от изменившихся (категория, подкатегория)
+    к их подписчикам по индексу, а не перебираем всех подписчиков: обновление
+    «Грилей» достаётся только подписчикам «Грилей» (и всего каталога).
+    """
+    if not changes:
+        return {}
+    per_sub = Counter((c.cat, c.sub) for c in changes)
+    per_cat: Counter = Counter()
+    for (cat, _), n in per_sub.items():
+        per_cat[cat] += n
+    subs = _get_subscriptions(bot_data)
+    everything = bot_data.get("subscribers") or set()
+    summary = [f"• {cat}: {per_cat[cat]} изм." for cat in _sort_categories(list(per_cat))]
+    lines: dict[int, list[str]] = {user_id: summary for user_id in everything}
+    for cat in _sort_categories(list(per_cat)):
+        for user_id in subs["cat"].get(cat, ()):
+            if user_id not in everything:
+                lines.setdefault(user_id, []).append(f"• {cat}: {per_cat[cat]} изм.")
+        cat_subs = subs["sub"].get(cat)
+        if not cat_subs:
+            continue
+        for sub in sorted(s for c, s in per_sub if c == cat and s in cat_subs):
+            for user_id in cat_subs[sub]:
+                if user_id not in everything and user_id not in subs["cat"].get(cat, ()):
+                    lines.setdefault(user_id, []).append(f"• {cat} / {sub}: {per_sub[(cat, sub)]} изм.")
+    return {user_id: found for user_id, found in lines.items() if found}
+
+
+def _notify_subscribers(context, changes: list[PriceChange]) -> int:
+    """Одно сообщение на подписчика изменившихся категорий; возвращает число получателей."""
+    fanout = _subscription_fanout(context.application.bot_data, changes)
+    if fanout:
+        queue = _get_notification_queue(context)
+        for user_id, lines in fanout.items():
+            text = ["📦 Каталог обновлён:", *lines[:SUBSCRIPTION_MESSAGE_LINES]]
+            if len(lines) > SUBSCRIPTION_MESSAGE_LINES:
+                text.append(f"…и ещё {len(lines) - SUBSCRIPTION_MESSAGE_LINES}")
+            text.append(f"\nНастроить подписку: «{BTN_SUBSCRIBE}»")
+            queue.put(user_id, "\n".join(text))
+    return len(fanout)
+
+
+def _subscription_markup(bot_data: dict, store: ColumnarCatalog, user_id: int, cat_id: int | None = None) -> InlineKeyboardMarkup:
+    """
+    Без cat_id — весь каталог и категории (✅ — вся категория, ☑️ — часть брендов);
+    с cat_id — «вся категория» и её бренды. Номера из снимка — в кнопках версия.
+    """
+    v = store.version
+    subs = _get_subscriptions(bot_data)
+
+    def mark(on: bool) -> str:
+        return "✅ " if on else ""
+
+    if cat_id is None:
+        rows = [[InlineKeyboardButton(
+            mark(user_id in bot_data.get("subscribers", ())) + "Весь каталог", callback_data=f"subt|{v}|*|*"
+        )]]
+        cat_ids = {cat: i for i, cat in enumerate(store.categories)}
+        for cat in _sort_categories(list(cat_ids)):
+            if user_id in subs["cat"].get(cat, ()):
+                prefix = "✅ "
+            elif any(user_id in users for users in subs["sub"].get(cat, {}).values()):
+                prefix = "☑️ "
             else:
-                to_del_brands.append(brand)
-        for b in to_del_brands:
-            del overrides[cat][b]
-        if not overrides.get(cat):
-            to_del_cats.append(cat)
-    for c in to_del_cats:
-        del overrides[c]
-
-    if changed:
-        _save_moved_overrides(overrides)
-        context.application.bot_data["moved_overrides"] = overrides
-
-    # 3) Убираем из авто-каталога все позиции, что уже есть в moved_overrides ИЛИ manual_categories
-    manual = context.application.bot_data.get("manual_categories") or _load_manual_categories()
-
-    occupied_descs = {
-        _norm_desc(mi.get("desc", ""))
-        for source in (overrides, manual)
-        for brands in source.values()
-        for sublist in brands.values()
-        for mi in sublist
-    }
+                prefix = ""
+            rows.append([InlineKeyboardButton(prefix + cat, callback_data=f"subs|{v}|{cat_ids[cat]}")])
+        return InlineKeyboardMarkup(rows)
+
+    cat = store.categories[cat_id]
+    rows = [[InlineKeyboardButton(
+        mark(user_id in subs["cat"].get(cat, ())) + "Вся категория", callback_data=f"subt|{v}|{cat_id}|*"
+    )]]
+    cat_subs = subs["sub"].get(cat, {})
+    for sub_id in store.cat_subs[cat_id]:
+        sub = store.subcategories[sub_id]
+        rows.append([InlineKeyboardButton(
+            mark(user_id in cat_subs.get(sub, ())) + sub, callback_data=f"subt|{v}|{cat_id}|{sub_id}"
+        )])
+    rows.append([InlineKeyboardButton("← Назад", callback_data=f"subs|{v}|*")])
+    return InlineKeyboardMarkup(rows)
+
+
+async def subscribe_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Кнопка «Подписаться»: выбор категорий и брендов для уведомлений об обновлениях."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id:
+        await update.message.reply_text("Не удалось выполнить подписку.")
+        return
+    store = _get_catalog_store(context)
+    await update.message.reply_text(
+        "Выберите, об обновлениях каких категорий или брендов сообщать:",
+        reply_markup=_subscription_markup(context.application.bot_data, store, user_id),
+    )
+
+
+async def handle_subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """subs|версия|кат — открыть категорию («*» — к списку); subt|версия|кат|подкат — переключить подписку."""
+    query = update.callback_query
+    parts = query.data.split("|")
+    user_id = query.from_user.id
+    bot_data = context.application.bot_data
+    store = _get_catalog_store(context)
+    if parts[1] != str(store.version):
+        await query.answer()
+        await query.edit_message_reply_markup(reply_markup=_subscription_markup(bot_data, store, user_id))
+        return
+    cat_id = None if parts[2] == "*" else int(parts[2])
+    if parts[0] == "subt":
+        cat = store.categories[cat_id] if cat_id is not None else None
+        sub = store.subcategories[int(parts[3])] if parts[3] != "*" else None
+        on = _toggle_subscription(bot_data, user_id, cat, sub)
+        title = " / ".join(filter(None, (cat, sub))) or "весь каталог"
+        await query.answer(f"{'Подписка оформлена' if on else 'Подписка отменена'}: {title}")
+    else:
+        await query.answer()
+    await query.edit_message_reply_markup(reply_markup=_subscription_markup(bot_data, store, user_id, cat_id))
+
+
+RECLASSIFY_DIFF_LINES = 30
+
+
+def _format_reclassify_plan(plan: dict) -> str:
+    moved = sum(plan["moves"].values())
+    if not moved:
+        return f"Все {plan['total']} позиций уже на своих местах — менять нечего."
+    lines = [f"Будет перемещено {moved} из {plan['total']} позиций:"]
+    for ((cat, sub), (new_cat, new_sub)), n in plan["moves"].most_common(RECLASSIFY_DIFF_LINES):
+        lines.append(f"• {cat} / {sub} → {new_cat} / {new_sub}: {n}")
+    rest = len(plan["moves"]) - RECLASSIFY_DIFF_LINES
+    if rest > 0:
+        lines.append(f"…и ещё {rest} направлений")
+    lines.append("\nПеренесённые и ручные позиции не меняются.")
+    return "\n".join(lines)
+
+
+async def reclassify_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /reclassify — пересчитать категории авто-каталога по текущим правилам (только админ)."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id or not is_admin(user_id):
+        await update.message.reply_text("Извините, команда доступна только администратору.")
+        return
+    await update.message.reply_text("Пересчитываю категории по текущим правилам…")
+    try:
+        plan = await _plan_reclassification(context)
+    except Exception as exc:
+        await update.message.reply_text(f"Переклассификация не удалась: {exc}")
+        return
+    markup = None
+    if plan["moves"]:
+        # План держит ссылки на товары — только в bot_data (не сохраняется на диск)
+        context.application.bot_data.setdefault("reclassify_plans", {})[user_id] = plan
+        markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Применить", callback_data="reclassify_apply")],
+            [InlineKeyboardButton("❌ Отмена", callback_data="reclassify_cancel")],
+        ])
+    await update.message.reply_text(_format_reclassify_plan(plan), reply_markup=markup)
+
+
+async def handle_reclassify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Кнопки «Применить» / «Отмена» под диффом /reclassify."""
+    query = update.callback_query
+    user_id = query.from_user.id
+    plan = context.application.bot_data.get("reclassify_plans", {}).pop(user_id, None)
+    await query.answer()
+    if query.data == "reclassify_cancel" or plan is None:
+        await query.edit_message_text("Переклассификация отменена." if plan else "План устарел — запустите /reclassify заново.")
+        return
+    if not await _apply_reclassification(context, plan):
+        await query.edit_message_text("Каталог изменился после расчёта — запустите /reclassify заново.")
+        return
+    await query.edit_message_text(
+        f"✅ Переклассификация применена: перемещено {sum(plan['moves'].values())} из {plan['total']} позиций."
+    )
+
+
+async def classify_trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /classify_trace <описание> — какое правило сработало и сколько стоила каждая проверка."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id or not is_admin(user_id):
+        await update.message.reply_text("Извините, команда доступна только администратору.")
+        return
+    desc = (update.message.text or "").partition(" ")[2].strip()
+    if not desc:
+        await update.message.reply_text("Формат: /classify_trace описание товара")
+        return
+    (cat, sub), trace = extract_category_traced(desc)
+    lines = [f"<b>{html.escape(cat)} / {html.escape(sub)}</b>", ""]
+    for i, (name, seconds, hit) in enumerate(trace):
+        mark = "✅" if hit else "·"
+        lines.append(f"{mark} {i:>2} {html.escape(name)} — {seconds * 1e6:.1f} мкс")
+    total = sum(seconds for _, seconds, _ in trace)
+    lines.append(f"\nПроверено правил: {len(trace)}, всего {total * 1e6:.1f} мкс")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+async def classify_profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /classify_profile on|off — профилирование правил при загрузках; без аргумента — последний отчёт."""
+    user_id = update.effective_user.id if update.effective_user else None
+    if not user_id or not is_admin(user_id):
+        await update.message.reply_text("Извините, команда доступна только администратору.")
+        return
+    bot_data = context.application.bot_data
+    arg = (context.args or [""])[0].lower()
+    if arg in ("on", "off"):
+        bot_data["classify_profile"] = arg == "on"
+        await update.message.reply_text(
+            "Профилирование включено: после каждой загрузки придёт отчёт по правилам."
+            if arg == "on" else "Профилирование выключено."
+        )
+        return
+    status = "включено" if bot_data.get("classify_profile") else "выключено"
+    report = bot_data.get("classify_profile_report") or RuleProfile()
+    await update.message.reply_text(
+        f"Профилирование {status} (/classify_profile on|off).\n\n{report.format()}"
+    )
+
+
+# -------------------------------------------------------------------
+# Ограничение частоты: корзина токенов на пользователя и класс действия,
+# общий лимит одновременных выгрузок и загрузок
+# -------------------------------------------------------------------
+# класс → (ёмкость корзины, токенов в секунду)
+RATE_LIMITS = {
+    "search": (5, 0.5),
+    "export": (3, 1 / 20),
+    "browse": (20, 4.0),
+}
+RATE_BUCKETS_MAX = 10000
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "2"))
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "1"))
+
+
+def _prune_rate_buckets(buckets: dict, now: float) -> None:
+    """Удаляет корзины, которые к этому моменту уже снова полные — они ничем не отличаются от новых."""
+    for key, (tokens, stamp, _) in list(buckets.items()):
+        capacity, rate = RATE_LIMITS[key[1]]
+        if tokens + (now - stamp) * rate >= capacity:
+            del buckets[key]
+
+
+def _take_token(bot_data: dict, user_id: int, action: str) -> tuple[float, bool]:
+    """
+    Списывает токен из корзины (user_id, action). Возвращает (0, False), если действие
+    разрешено, иначе (сколько секунд ждать следующего токена, первый ли это отказ в серии).
+    """
+    capacity, rate = RATE_LIMITS[action]
+    buckets = bot_data.setdefault("rate_buckets", {})
+    now = time.monotonic()
+    key = (user_id, action)
+    if key not in buckets and len(buckets) >= RATE_BUCKETS_MAX:
+        _prune_rate_buckets(buckets, now)
+    tokens, stamp, warned = buckets.get(key, (capacity, now, False))
+    tokens = min(capacity, tokens + (now - stamp) * rate)
+    if tokens >= 1:
+        buckets[key] = (tokens - 1, now, False)
+        return 0.0, False
+    buckets[key] = (tokens, now, True)
+    return (1 - tokens) / rate, not warned
+
+
+async def _rate_limited(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str) -> bool:
+    """
+    True — лимит исчерпан и запрос отклонён. На нажатие кнопки отвечаем всплывающим
+    уведомлением (оно нужно в любом случае), на сообщения — одним предупреждением
+    на серию, остальные молча отбрасываем.
+    """
+    user = update.effective_user
+    if user is None:
+        return False
+    wait, first = _take_token(context.application.bot_data, user.id, action)
+    if not wait:
+        return False
+    text = f"Слишком много запросов — попробуйте через {max(1, round(wait))} с."
+    if update.callback_query is not None:
+        await update.callback_query.answer(text)
+    elif first and update.effective_message is not None:
+        await update.effective_message.reply_text(text)
+    return True
+
+
+def _action_semaphore(context, name: str, limit: int) -> asyncio.Semaphore:
+    """Общий на всё приложение семафор name (выгрузки, загрузки прайсов)."""
+    semaphores = context.application.bot_data.setdefault("semaphores", {})
+    if name not in semaphores:
+        semaphores[name] = asyncio.Semaphore(max(1, limit))
+    return semaphores[name]
+
+
+# -------------------------------------------------------------------
+# Выгрузка каталога: весь / категория / подкатегория / поиск; xlsx, CSV, JSON
+# -------------------------------------------------------------------
+EXPORT_COLUMNS = ("xmlid", "description", "price")
+# Сколько отправленных файлов (file_id) помнить на одну версию каталога
+EXPORT_CACHE_MAX = 200
+
+
+def _export_price(value):
+    """Цена для выгрузки: только цифры строки → int (как прежний Excel), пусто → None."""
+    if type(value) is int and value >= 0:
+        return value
+    digits = "".join(ch for ch in str(value) if ch.isdigit())
+    return int(digits) if digits else None
+
+
+def _export_store_rows(store: ColumnarCatalog, cat: str | None = None, sub: str | None = None):
+    """Строки (xmlid, description, price) прямо из колоночного снимка, без копий товаров."""
+    for start, end in store.row_spans(cat, sub):
+        for row in range(start, end):
+            xmlid = f"{store.categories[store.cat_ids[row]]}/{store.subcategories[store.sub_ids[row]]}"
+            yield xmlid, store.desc_at(row), _export_price(store.price_at(row))
+
+
+def _export_result_rows(results):
+    """Те же строки для результатов поиска (категория, подкатегория, товар)."""
+    for cat, sub, item in results:
+        yield f"{cat}/{sub}", str(item.get("desc", "")), _export_price(item.get("price", ""))
+
+
+def _write_export_xlsx(rows, path: str) -> int:
+    """
+    Пишет строки в xlsx по одной: xlsxwriter в режиме constant_memory, без него —
+    openpyxl write_only. Формат цены #,##0 и ширины колонок — как в прежней выгрузке.
+    """
+    count = 0
+    try:
+        import xlsxwriter
+    except ImportError:
+        xlsxwriter = None
+    if xlsxwriter is not None:
+        workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        try:
+            worksheet = workbook.add_worksheet("catalog")
+            price_fmt = workbook.add_format({"num_format": "#,##0"})
+            worksheet.set_column(0, 0, 24)
+            worksheet.set_column(1, 1, 48)
+            worksheet.set_column(2, 2, 12, price_fmt)
+            worksheet.write_row(0, 0, EXPORT_COLUMNS)
+            for count, (xmlid, desc, price) in enumerate(rows, start=1):
+                worksheet.write_string(count, 0, xmlid)
+                worksheet.write_string(count, 1, desc)
+                if price is not None:
+                    worksheet.write_number(count, 2, price, price_fmt)
+        finally:
+            workbook.close()
+        return count
+
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet("catalog")
+    for letter, width in zip("ABC", (24, 48, 12)):
+        worksheet.column_dimensions[letter].width = width
+    worksheet.append(EXPORT_COLUMNS)
+    for count, (xmlid, desc, price) in enumerate(rows, start=1):
+        price_cell = WriteOnlyCell(worksheet, value=price)
+        if price is not None:
+            price_cell.number_format = "#,##0"
+        worksheet.append([xmlid, desc, price_cell])
+    workbook.save(path)
+    return count
+
+
+def _write_export_csv(rows, path: str) -> int:
+    """CSV с разделителем «;» и BOM — Excel открывает кириллицу без мастера импорта."""
+    import csv
+
+    count = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as fh:
+        writer = csv.writer(fh, delimiter=";")
+        writer.writerow(EXPORT_COLUMNS)
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(row)
+    return count
+
+
+def _write_export_json(rows, path: str) -> int:
+    """JSON-массив объектов {xmlid, description, price}, пишется по одному объекту."""
+    count = 0
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write("[")
+        for count, row in enumerate(rows, start=1):
+            fh.write(",\n" if count > 1 else "\n")
+            fh.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+        fh.write("\n]\n" if count else "]\n")
+    return count
+
+
+EXPORT_FORMATS = {
+    "xlsx": ("Excel (xlsx)", _write_export_xlsx),
+    "csv": ("CSV", _write_export_csv),
+    "json": ("JSON", _write_export_json),
+}
+
+
+def _export_filename(scope: tuple, fmt: str) -> str:
+    """catalog.xlsx, catalog_Телефоны.csv, catalog_Ноутбуки_Apple.json, catalog_поиск_iphone_15.xlsx."""
+    parts = list(scope[1:])
+    if scope[0] == "query":
+        parts.insert(0, "поиск")
+    slug = re.sub(r"[^\w-]+", "_", "_".join(parts)).strip("_")[:60]
+    return f"catalog_{slug}.{fmt}" if slug else f"catalog.{fmt}"
+
+
+def _export_cache(context) -> dict:
+    """
+    Кэш выгрузок текущей версии каталога; сбрасывается со сменой версии.
+    files: (область, формат) → file_id уже отправленного файла;
+    pending: (область, формат) → Future выгрузки, которая готовится прямо сейчас.
+    """
+    bot_data = context.application.bot_data
+    version = _catalog_version(context)
+    cache = bot_data.get("export_cache")
+    if cache is None or cache["version"] != version:
+        cache = bot_data["export_cache"] = {"version": version, "files": {}, "pending": {}}
+    return cache
+
+
+async def _send_export(message, context, scope: tuple, fmt: str) -> None:
+    """
+    Отправляет выгрузку области scope: ("all",), ("cat", кат), ("sub", кат, подкат)
+    или ("query", запрос). Файл пишется потоково в отдельном потоке из неизменяемого
+    снимка; повторный запрос той же версии отправляется по file_id без генерации.
+    Запросы, пришедшие, пока такая же выгрузка готовится, ждут её и получают тот же
+    файл; одновременно готовится не больше EXPORT_CONCURRENCY файлов.
+    """
+    cache = _export_cache(context)
+    files, pending = cache["files"], cache["pending"]
+    key = (scope, fmt)
+    if key in files:
+        await message.reply_document(document=files[key])
+        return
+    if key in pending:
+        file_id, error = await asyncio.shield(pending[key])
+        if file_id:
+            await message.reply_document(document=file_id)
+        else:
+            await message.reply_text(error)
+        return
 
-    for cat_key in list(catalog.keys()):
-        for sub_key in list(catalog[cat_key].keys()):
-            filtered = [
-                item for item in catalog[cat_key][sub_key]
-                if _norm_desc(item.get("desc", "")) not in occupied_descs
-            ]
-            if filtered:
-                catalog[cat_key][sub_key] = filtered
+    future = pending[key] = asyncio.get_running_loop().create_future()
+    file_id, error = None, "Не удалось отправить файл."
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        async with _action_semaphore(context, "export", EXPORT_CONCURRENCY):
+            store = _get_catalog_store(context)
+            if scope[0] == "query":
+                results, _ = _search_catalog(context, scope[1], limit=None)
+                rows = _export_result_rows(results)
             else:
-                del catalog[cat_key][sub_key]
-        if not catalog.get(cat_key):
-            del catalog[cat_key]
-    # === КОНЕЦ СИНХРОНИЗАЦИИ ===
+                rows = _export_store_rows(store, *scope[1:])
+            count = await asyncio.to_thread(EXPORT_FORMATS[fmt][1], rows, path)
+        if not count:
+            error = "Нет позиций для выгрузки."
+            await message.reply_text(error)
+            return
+        with open(path, "rb") as fh:
+            sent = await message.reply_document(document=fh, filename=_export_filename(scope, fmt))
+        if sent.document:
+            file_id = sent.document.file_id
+            if len(files) < EXPORT_CACHE_MAX:
+                files[key] = file_id
+    except Exception as exc:
+        error = f"Не удалось отправить файл: {exc}"
+        await message.reply_text(error)
+    finally:
+        pending.pop(key, None)
+        future.set_result((file_id, error))
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+
+def _export_format_markup(prefix: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(title, callback_data=f"{prefix}|{fmt}") for fmt, (title, _) in EXPORT_FORMATS.items()
+    ]])
+
+
+def _export_scope_markup(store: ColumnarCatalog) -> InlineKeyboardMarkup:
+    """Весь каталог + категории. Номера категорий — из снимка, поэтому в кнопках есть версия."""
+    v = store.version
+    buttons = [[InlineKeyboardButton(f"📦 Весь каталог ({len(store)})", callback_data=f"expf|{v}|*|*")]]
+    for cat_id, (cat, count) in enumerate(store.category_counts().items()):
+        buttons.append([InlineKeyboardButton(f"{cat} ({count})", callback_data=f"exp|{v}|{cat_id}")])
+    return InlineKeyboardMarkup(buttons)
 
-    if not catalog:
-        await update.message.reply_text("Не удалось сформировать категории по описанию.")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /export [запрос] — выгрузка всего каталога, категории или результатов поиска."""
+    query_text = " ".join(context.args or []).strip()
+    if query_text:
+        context.user_data["export_query"] = query_text
+        await update.message.reply_text(
+            f"Выгрузка по запросу «{query_text}». Выберите формат:",
+            reply_markup=_export_format_markup("expq"),
+        )
+        return
+    store = _get_catalog_store(context)
+    if not store:
+        await update.message.reply_text("Каталог пуст.")
         return
+    await update.message.reply_text(
+        "Что выгрузить? Для выгрузки по поиску: /export <запрос>",
+        reply_markup=_export_scope_markup(store),
+    )
 
-    # Сохраняем каталог в bot_data (общий для всех пользователей)
-    context.application.bot_data["catalog"] = catalog
-    # А также на диск, чтобы каталог сохранялся между перезапусками бота
-    _save_catalog_to_disk(catalog)
 
-    # После успешной загрузки каталога выводим сообщение с инструкцией
-    await update.message.reply_text("Каталог успешно добавлен, нажмите /start, чтобы ознакомиться с категориями")
+async def handle_export_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    exp|версия|кат            — выбор подкатегории;
+    expf|версия|кат|подкат    — выбор формата («*» — вся категория / весь каталог);
+    expd|версия|кат|подкат|фмт — выгрузка; expq|фмт — выгрузка по запросу из /export.
+    """
+    query = update.callback_query
+    parts = query.data.split("|")
+    if parts[0] in ("expd", "expq") and await _rate_limited(update, context, "export"):
+        return
+    await query.answer()
+    if parts[0] == "expq":
+        query_text = context.user_data.get("export_query")
+        if not query_text:
+            await query.edit_message_text("Запрос не найден — отправьте /export <запрос> ещё раз.")
+            return
+        await _send_export(query.message, context, ("query", query_text), parts[1])
+        return
+
+    store = _get_catalog_store(context)
+    if parts[1] != str(store.version):
+        await query.edit_message_text(f"Каталог обновился — нажмите «{BTN_GET_EXCEL}» ещё раз.")
+        return
+    cat_id = parts[2]
+    cat = store.categories[int(cat_id)] if cat_id != "*" else None
+    if parts[0] == "exp":
+        buttons = [[InlineKeyboardButton("Вся категория", callback_data=f"expf|{parts[1]}|{cat_id}|*")]]
+        for sub_id in store.cat_subs[int(cat_id)]:
+            start, end = store.ranges[(int(cat_id), sub_id)]
+            buttons.append([InlineKeyboardButton(
+                f"{store.subcategories[sub_id]} ({end - start})",
+                callback_data=f"expf|{parts[1]}|{cat_id}|{sub_id}",
+            )])
+        await query.edit_message_text(f"{cat}: что выгрузить?", reply_markup=InlineKeyboardMarkup(buttons))
+        return
 
-    # Удаляем временный файл
-    try:
-        os.remove(src_path)
-        os.rmdir(tmp_dir)
-    except OSError:
-        pass
+    sub_id = parts[3]
+    sub = store.subcategories[int(sub_id)] if sub_id != "*" else None
+    scope = ("sub", cat, sub) if sub else ("cat", cat) if cat else ("all",)
+    if parts[0] == "expf":
+        title = " / ".join(scope[1:]) or "Весь каталог"
+        await query.edit_message_text(
+            f"{title}. Выберите формат:",
+            reply_markup=_export_format_markup(f"expd|{parts[1]}|{cat_id}|{sub_id}"),
+        )
+        return
+    await _send_export(query.message, context, scope, parts[4])
 
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1090,7 +4264,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             await update.message.reply_text("Не выбраны строки. Укажите номера, например: 1-3,5")
             return
     
-        context.user_data["manualprice_indices"] = indices
+        shown = context.user_data.get("manualprice_shown", [])
+        context.user_data["manualprice_picks"] = [(i, *shown[i]) for i in indices if i < len(shown)]
         context.user_data["manualprice_step"] = "awaiting_price"
         await update.message.reply_text("Введите новую цену (одно значение будет применено ко всем выбранным товарам):")
         return
@@ -1104,23 +4279,28 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     
         cat = context.user_data.pop("manualprice_cat", None)
         brand = context.user_data.pop("manualprice_brand", None)
-        indices = context.user_data.pop("manualprice_indices", [])
+        picks = context.user_data.pop("manualprice_picks", [])
+        context.user_data.pop("manualprice_shown", None)
         context.user_data.pop("manualprice_step", None)
     
-        manual = context.application.bot_data.get("manual_categories", {}) or _load_manual_categories()
-        items = manual.get(cat, {}).get(brand, [])
-    
-        updated = 0
-        for i in indices:
-            if 0 <= i < len(items):
+        async with catalog_writer(context):
+            manual = context.application.bot_data.get("manual_categories", {}) or _load_manual_categories()
+            items = manual.get(cat, {}).get(brand, [])
+
+            updated = 0
+            for i in _resolve_picks(items, picks):
                 items[i]["price"] = new_price
                 items[i]["price_locked"] = True
                 updated += 1
+
+            _save_manual_categories(manual)
+            context.application.bot_data["manual_categories"] = manual
+            _bump_catalog_version(context)
     
-        _save_manual_categories(manual)
-        context.application.bot_data["manual_categories"] = manual
-    
-        await update.message.reply_text(f"✅ Обновлено цен: {updated} шт. в {cat} / {brand}.")
+        note = ""
+        if updated < len(picks):
+            note = f"\nНе найдено {len(picks) - updated} поз. — их изменил или удалил другой администратор."
+        await update.message.reply_text(f"✅ Обновлено цен: {updated} шт. в {cat} / {brand}.{note}")
         # вернёмся в админ-панель (если у вас уже есть вспомогательная функция)
         try:
             await show_admin_panel(update, context)
@@ -1169,15 +4349,17 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 brand = context.user_data.pop("manualcat_brand")
                 context.user_data.pop("manualcat_step", None)
 
-                # Загрузить или инициализировать manual_categories
-                manual_cats = context.application.bot_data.get("manual_categories")
-                if manual_cats is None:
-                    manual_cats = _load_manual_categories()
+                async with catalog_writer(context):
+                    # Загрузить или инициализировать manual_categories
+                    manual_cats = context.application.bot_data.get("manual_categories")
+                    if manual_cats is None:
+                        manual_cats = _load_manual_categories()
 
-                # Создать пустой список товаров в новой подкатегории
-                manual_cats.setdefault(cat, {})[brand] = []
-                context.application.bot_data["manual_categories"] = manual_cats
-                _save_manual_categories(manual_cats)
+                    # Создать пустой список товаров в новой подкатегории
+                    manual_cats.setdefault(cat, {})[brand] = []
+                    context.application.bot_data["manual_categories"] = manual_cats
+                    _save_manual_categories(manual_cats)
+                    _bump_catalog_version(context)
 
                 # Ответить администратору
                 buttons = [
@@ -1220,13 +4402,17 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 brand = context.user_data.pop("manualcat_brand")
                 context.user_data.pop("manualcat_step", None)
 
-                # Сохраняем в manual_categories.json
-                manual_cats = context.application.bot_data.get("manual_categories")
-                if manual_cats is None:
-                    manual_cats = _load_manual_categories()
-                manual_cats.setdefault(cat, {}).setdefault(brand, []).extend(items)
-                context.application.bot_data["manual_categories"] = manual_cats
-                _save_manual_categories(manual_cats)
+                async with catalog_writer(context):
+                    # Сохраняем в manual_categories.json
+                    manual_cats = context.application.bot_data.get("manual_categories")
+                    if manual_cats is None:
+                        manual_cats = _load_manual_categories()
+                    index = _get_item_index(context)
+                    manual_cats.setdefault(cat, {}).setdefault(brand, []).extend(items)
+                    index.add_items(LAYER_MANUAL, cat, brand, items)
+                    context.application.bot_data["manual_categories"] = manual_cats
+                    _save_manual_categories(manual_cats)
+                    _bump_catalog_version(context)
 
                 # Показываем обновлённый список вручную добавленных категорий
                 lines = []
@@ -1277,10 +4463,14 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             brand = context.user_data.pop("manualprod_brand")
             context.user_data.pop("manualprod_step", None)
 
-            manual_cats = context.application.bot_data.get("manual_categories") or _load_manual_categories()
-            manual_cats.setdefault(cat, {}).setdefault(brand, []).extend(items)
-            _save_manual_categories(manual_cats)
-            context.application.bot_data["manual_categories"] = manual_cats
+            async with catalog_writer(context):
+                manual_cats = context.application.bot_data.get("manual_categories") or _load_manual_categories()
+                index = _get_item_index(context)
+                manual_cats.setdefault(cat, {}).setdefault(brand, []).extend(items)
+                index.add_items(LAYER_MANUAL, cat, brand, items)
+                _save_manual_categories(manual_cats)
+                context.application.bot_data["manual_categories"] = manual_cats
+                _bump_catalog_version(context)
 
             await update.message.reply_text(
                 f"Добавлено в {cat} / {brand}: {len(items)} позиций."
@@ -1304,25 +4494,30 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             else:
                 idxs.add(int(part))
 
-        # Переводим в 0-based и сортируем по убыванию, чтобы удалять корректно
-        indices = sorted({i - 1 for i in idxs if i > 0}, reverse=True)
+        # Переводим в 0-based и запоминаем, какой товар стоял под номером в показанном списке
+        shown = context.user_data.pop("manualprod_shown", [])
+        picks = [(i, *shown[i]) for i in sorted({i - 1 for i in idxs if i > 0}) if i < len(shown)]
 
         # Достаём контекст
         cat = context.user_data.pop("manualprod_cat", None)
         brand = context.user_data.pop("manualprod_brand", None)
         context.user_data.pop("manualprod_step", None)
 
-        manual = context.application.bot_data.get("manual_categories", {}) or _load_manual_categories()
-        items = manual.get(cat, {}).get(brand, [])
+        async with catalog_writer(context):
+            manual = context.application.bot_data.get("manual_categories", {}) or _load_manual_categories()
+            items = manual.get(cat, {}).get(brand, [])
 
-        removed = []
-        for i in indices:
-            if 0 <= i < len(items):
+            index = _get_item_index(context)
+            removed = []
+            # С конца, чтобы номера оставшихся не сдвигались
+            for i in reversed(_resolve_picks(items, picks)):
                 removed.append(items.pop(i))
+            index.remove_items(LAYER_MANUAL, removed)
 
-        # Сохраняем изменения
-        _save_manual_categories(manual)
-        context.application.bot_data["manual_categories"] = manual
+            # Сохраняем изменения
+            _save_manual_categories(manual)
+            context.application.bot_data["manual_categories"] = manual
+            _bump_catalog_version(context)
 
         if removed:
             lines = []
@@ -1368,133 +4563,25 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     # --- 1. Обработка режима поиска ---
     if context.user_data.pop("awaiting_search", False):
-        # 1) Нормализуем запрос
         raw = (text or "").strip()
         if not raw:
             await update.message.reply_text("Пустой запрос. Попробуйте ещё раз.")
             return
-        q = raw.lower()
-        q = re.sub(r'([a-zа-яё])(\d)', r'\1 \2', q)
-        q = re.sub(r'(\d)([a-zа-яё])', r'\1 \2', q)
-
-        # 2.1) СПЕЦ-СЛУЧАЙ: «macbook» и его вариации → только Ноутбуки / Apple
-        mac = q.replace(" ", "")
-        if mac.startswith("macbook"):
-            full_catalog = get_full_catalog(context)
-            results = [
-                ("Ноутбуки", "Apple", item)
-                for item in full_catalog.get("Ноутбуки", {}).get("Apple", [])
-            ]
-            if not results:
-                await update.message.reply_text("Ничего не найдено по вашему запросу.")
-                return
-
-            await update.message.reply_text(f"Найдено позиций: {len(results)}")
-            back_markup = InlineKeyboardMarkup(
-                [[InlineKeyboardButton("← Назад", callback_data="back|root")]]
-            )
-
-            lines = []
-            for cat, sub, item in results:
-                desc = html.escape(item["desc"])
-                price = str(item.get("price", "")).strip()
-                line = f"<b>{desc}</b>"
-                if price:
-                    line += f" — <i>{html.escape(price)} ₽</i>"
-                line += f"\n<i>{cat} / {sub}</i>"
-                lines.extend([line, ""])
-
-            MAX_LEN = 4000
-            chunks = []
-            cur = ""
-            for l in lines:
-                seg = l + "\n"
-                if len(cur) + len(seg) > MAX_LEN and cur:
-                    chunks.append(cur)
-                    cur = seg
-                else:
-                    cur += seg
-            if cur:
-                chunks.append(cur)
-
-            for idx, chunk in enumerate(chunks):
-                if idx == len(chunks) - 1:
-                    await update.message.reply_text(chunk, parse_mode="HTML", reply_markup=back_markup)
-                else:
-                    await update.message.reply_text(chunk, parse_mode="HTML")
+        if await _rate_limited(update, context, "search"):
+            # Режим поиска не сбрасываем: запрос можно просто отправить ещё раз
+            context.user_data["awaiting_search"] = True
             return
 
-        full_catalog = get_full_catalog(context)
-        if not full_catalog:
+        if not _get_catalog_store(context):
             await update.message.reply_text("Каталог пока не загружен. Пожалуйста, попробуйте позже.")
             return
 
-        # 3) Собираем результаты
-        results: list[tuple[str, str, dict]] = []
-        brand_subs = {sub.lower() for subs in full_catalog.values() for sub in subs}
-        if q in brand_subs:
-            for cat, subs in full_catalog.items():
-                for sub, items in subs.items():
-                    if sub.lower() == q:
-                        for item in items:
-                            results.append((cat, sub, item))
-        else:
-            matched_cats = [
-                cat for cat in full_catalog
-                if cat.lower() == q or cat.lower().startswith(q) or q.startswith(cat.lower())
-            ]
-            if matched_cats:
-                for cat in matched_cats:
-                    for sub, items in full_catalog[cat].items():
-                        for item in items:
-                            results.append((cat, sub, item))
-            else:
-                for cat, subs in full_catalog.items():
-                    for sub, items in subs.items():
-                        for item in items:
-                            desc = str(item.get("desc", "")).lower()
-                            d = re.sub(r'([a-zа-яё])(\d)', r'\1 \2', desc)
-                            d = re.sub(r'(\d)([a-zа-яё])', r'\1 \2', d)
-                            if q in d:
-                                results.append((cat, sub, item))
-
-        if not results:
-            await update.message.reply_text("Ничего не найдено по вашему запросу.")
+        messages = _search_messages(context, raw)
+        if len(messages) == 1:
+            await update.message.reply_text(messages[0])
             return
-
-        await update.message.reply_text(f"Найдено позиций: {len(results)}")
-        back_markup = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("← Назад", callback_data="back|root")]]
-        )
-
-        lines = []
-        for cat, sub, item in results:
-            desc = html.escape(str(item["desc"]))
-            price = str(item.get("price", "")).strip()
-            line = f"<b>{desc}</b>"
-            if price:
-                line += f" — <i>{html.escape(price)} ₽</i>"
-            line += f"\n<i>{cat} / {sub}</i>"
-            lines.extend([line, ""])
-
-        MAX_LEN = 4000
-        chunks = []
-        current = ""
-        for l in lines:
-            segment = l + "\n"
-            if len(current) + len(segment) > MAX_LEN and current:
-                chunks.append(current)
-                current = segment
-            else:
-                current += segment
-        if current:
-            chunks.append(current)
-
-        for idx, chunk in enumerate(chunks):
-            if idx == len(chunks) - 1:
-                await update.message.reply_text(chunk, parse_mode="HTML", reply_markup=back_markup)
-            else:
-                await update.message.reply_text(chunk, parse_mode="HTML")
+        text, markup = _search_page(_store_search_results(context, messages), messages, 0)
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
         return
 
     # --- Шаг 3.1: парсим номера строк для переноса ---
@@ -1534,15 +4621,15 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     
         # Переходим к выбору новой категории (из полного каталога)
         context.user_data["change_step"] = "awaiting_new_cat"
-        full = get_full_catalog(context)
-        buttons = [[InlineKeyboardButton(cat, callback_data=f"newcat|{cat}")] for cat in full.keys()]
+        store = _get_catalog_store(context)
+        buttons = [[InlineKeyboardButton(cat, callback_data=f"newcat|{cat}")] for cat in store.categories]
         await update.message.reply_text("Выберите <b>новую</b> категорию:", reply_markup=InlineKeyboardMarkup(buttons), parse_mode=ParseMode.HTML)
         return
 
     # --- 2. Обработка нажатий на основные кнопки ---
     if text == BTN_ADMIN_PANEL and is_admin_user:
         admin_buttons = [
-            [InlineKeyboardButton("📥 Добавить каталог (.xlsx)", callback_data="adminpanel_add_catalog")],
+            [InlineKeyboardButton("📥 Добавить каталог (.xlsx/.csv)", callback_data="adminpanel_add_catalog")],
             [InlineKeyboardButton("🔀 Изменить категорию товаров", callback_data="adminpanel_change_category")],
             [InlineKeyboardButton("📝 Ручные (manual)", callback_data="adminpanel_manual_root")],
             [InlineKeyboardButton("👤 Управление администраторами", callback_data="adminpanel_edit_admins")],
@@ -1553,21 +4640,17 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     if text == BTN_SEARCH_CATALOG:
         context.user_data["awaiting_search"] = True
-        await update.message.reply_text("Введите поисковый запрос по каталогу:")
+        await update.message.reply_text(
+            "Введите поисковый запрос по каталогу, например: <i>apple air m2 256</i>\n"
+            "Уточнить можно фильтрами <code>cat:</code> и <code>brand:</code> — "
+            "<i>cat:Ноутбуки brand:Apple 16</i>",
+            parse_mode=ParseMode.HTML,
+        )
         return
 
     if text == BTN_CHOOSE_CATEGORY:
-        full_catalog = get_full_catalog(context)
-        if full_catalog:
-            buttons = []
-            for cat_name in _sort_categories(list(full_catalog.keys())):
-                subdict = full_catalog[cat_name]
-                count = sum(len(items) for items in subdict.values())
-                buttons.append([InlineKeyboardButton(
-                    text=f"{cat_name} ({count})",
-                    callback_data=f"cat|{cat_name}"
-                )])
-            markup = InlineKeyboardMarkup(buttons)
+        markup = _categories_markup(_get_catalog_store(context))
+        if markup:
             await update.message.reply_text("Выберите категорию:", reply_markup=markup)
         else:
             await update.message.reply_text("Каталог пока не загружен. Пожалуйста, попробуйте позже.")
@@ -1583,104 +4666,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     elif text == BTN_GET_EXCEL:
-        import pandas as pd
-        import tempfile, os
-    
-        full_catalog = get_full_catalog(context)
-    
-        # 1) Собираем строки под требуемые столбцы xmlid/description/price
-        rows = []
-        for cat, subdict in full_catalog.items():
-            for sub, items in subdict.items():
-                for item in items:
-                    rows.append({
-                        "xmlid": f"{cat}/{sub}",                          # Категория/Подкатегория
-                        "description": str(item.get("desc", "")),         # Описание
-                        "price": item.get("price", "")                    # Цена (преобразуем ниже в число)
-                    })
-    
-        if not rows:
-            await update.message.reply_text("Каталог пуст.")
-            return
-    
-        # 2) DataFrame в нужном порядке столбцов
-        df = pd.DataFrame(rows, columns=["xmlid", "description", "price"])
-    
-        # 3) Приводим price к числовому виду (int), вытаскивая только цифры
-        def _to_int(v):
-            s = str(v)
-            digits = "".join(ch for ch in s if ch.isdigit())
-            return int(digits) if digits else None
-    
-        df["price"] = df["price"].apply(_to_int)
-    
-        # 4) Пишем XLSX: сначала пробуем xlsxwriter (лучший контроль форматов), иначе openpyxl
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-        tmp_path = tmp.name
-        tmp.close()
-    
-        try:
-            try:
-                import xlsxwriter  # если установлен — используем
-    
-                with pd.ExcelWriter(tmp_path, engine="xlsxwriter") as writer:
-                    sheet_name = "catalog"
-                    df.to_excel(writer, index=False, sheet_name=sheet_name)
-    
-                    workbook  = writer.book
-                    worksheet = writer.sheets[sheet_name]
-    
-                    # Колонки: 0=xmlid, 1=description, 2=price
-                    # Числовой формат для price: #,##0 (будет выглядеть как 75,000)
-                    price_fmt = workbook.add_format({"num_format": "#,##0"})
-                    worksheet.set_column(0, 0, 24)           # xmlid
-                    worksheet.set_column(1, 1, 48)           # description
-                    worksheet.set_column(2, 2, 12, price_fmt)  # price (с форматом)
-    
-            except ImportError:
-                # Фолбэк: openpyxl — тоже задаём формат #,##0 для столбца price
-                from openpyxl.styles import numbers
-                from openpyxl.utils import get_column_letter
-    
-                with pd.ExcelWriter(tmp_path, engine="openpyxl") as writer:
-                    sheet_name = "catalog"
-                    df.to_excel(writer, index=False, sheet_name=sheet_name)
-                    ws = writer.sheets[sheet_name]
-    
-                    # Ширины столбцов
-                    ws.column_dimensions[get_column_letter(1)].width = 24   # xmlid
-                    ws.column_dimensions[get_column_letter(2)].width = 48   # description
-                    ws.column_dimensions[get_column_letter(3)].width = 12   # price
-    
-                    # Формат для price (колонка C, индекс 3 в 1-based)
-                    price_col = 3
-                    for row in range(2, len(df) + 2):  # начиная со 2-й строки (после заголовков)
-                        cell = ws.cell(row=row, column=price_col)
-                        # Только если там число (None/пустые пропускаем)
-                        if isinstance(cell.value, (int, float)):
-                            cell.number_format = "#,##0"
-    
-            await update.message.reply_document(document=open(tmp_path, "rb"), filename="catalog.xlsx")
-            return
-    
-        except Exception as exc:
-            await update.message.reply_text(f"Не удалось отправить файл: {exc}")
-            return
-    
-        finally:
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
-
+        await export_command(update, context)
+        return
 
     if text == BTN_SUBSCRIBE:
-        subs: set[int] = context.application.bot_data.setdefault("subscribers", set())
-        if user_id:
-            subs.add(user_id)
-            await update.message.reply_text("Спасибо! Вы подписаны на обновления.")
-        else:
-            await update.message.reply_text("Не удалось выполнить подписку.")
+        await subscribe_menu(update, context)
         return
 
     # --- 3. Обработка неизвестных сообщений ---
@@ -1710,6 +4700,35 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("Главное меню:")
         await context.bot.send_message(chat_id=update.effective_chat.id, text="Выберите действие:", reply_markup=get_main_menu_markup(is_admin_user))
         return
+    if data.startswith("srch|"):
+        await handle_search_page_callback(update, context)
+        return
+    if data.startswith(("subs|", "subt|")):
+        await handle_subscription_callback(update, context)
+        return
+    if data.startswith(("watch|", "unwatch|")):
+        await handle_watch_callback(update, context)
+        return
+    if data.startswith(("exp|", "expf|", "expd|", "expq|")):
+        await handle_export_callback(update, context)
+        return
+    if data in ("reclassify_apply", "reclassify_cancel"):
+        if not is_admin(query.from_user.id):
+            await query.answer("Извините, команда доступна только администратору.", show_alert=True)
+            return
+        await handle_reclassify_callback(update, context)
+        return
+    if data in ("ingest_run", "ingest_cancel"):
+        if not is_admin(query.from_user.id):
+            await query.answer("Извините, команда доступна только администратору.", show_alert=True)
+            return
+        if data == "ingest_run":
+            await run_ingest_session(update, context)
+        else:
+            _reset_ingest_session(context, query.from_user.id)
+            await query.answer()
+            await query.edit_message_text("Загрузка каталога отменена.")
+        return
     if data == "adminpanel_add_catalog":
         # Выполнить команду /add_catalog
         await add_catalog_command(update, context)
@@ -1772,17 +4791,16 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
             await query.answer("Извините, команда доступна только администратору.", show_alert=True)
             return
 
-        full = get_full_catalog(context)
-        if not full:
+        counts = _get_catalog_store(context).category_counts()
+        if not counts:
             await query.edit_message_text("Каталог пуст.")
             return
 
         # Кнопки категорий с общим количеством позиций (auto + moved + manual)
-        buttons = []
-        for cat_name in _sort_categories(list(full.keys())):
-            subdict = full.get(cat_name, {})
-            count = sum(len(items) for items in subdict.values())
-            buttons.append([InlineKeyboardButton(f"{cat_name} ({count})", callback_data=f"change|cat|{cat_name}")])
+        buttons = [
+            [InlineKeyboardButton(f"{cat_name} ({counts[cat_name]})", callback_data=f"change|cat|{cat_name}")]
+            for cat_name in _sort_categories(list(counts))
+        ]
 
         context.user_data["change_step"] = "awaiting_cat"
         await query.edit_message_text("Выберите категорию, из которой переносим:", reply_markup=InlineKeyboardMarkup(buttons))
@@ -1860,11 +4878,10 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     if data.startswith("newcat|") and context.user_data.get("change_step") == "awaiting_new_cat":
         _, new_cat = data.split("|",1)
         context.user_data["new_cat"] = new_cat
-        full = get_full_catalog(context)
-        subs = full.get(new_cat, {})
+        subs = _get_catalog_store(context).subcategory_counts(new_cat)
         buttons = [
-            [InlineKeyboardButton(f"{sub} ({len(items)})", callback_data=f"newsub|{new_cat}|{sub}")]
-            for sub, items in subs.items()
+            [InlineKeyboardButton(f"{sub} ({count})", callback_data=f"newsub|{new_cat}|{sub}")]
+            for sub, count in subs.items()
         ]
         await query.edit_message_text(
             f"*Новая категория:* {new_cat}\nВыберите подкатегорию:",
@@ -1884,81 +4901,70 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data.pop("change_selection_map", None)
         context.user_data.pop("change_step", None)
     
-        auto_cat = context.application.bot_data.get("catalog") or {}
-        overrides = context.application.bot_data.get("moved_overrides") or _load_moved_overrides()
-        manual    = context.application.bot_data.get("manual_categories") or _load_manual_categories()
-    
-        moved_cnt = 0
-    
-        # Утилита: безопасное удаление конкретного элемента по desc+price
-        def _remove_by_desc_price(lst, desc, price):
-            for j, it in enumerate(lst):
-                if str(it.get("desc","")) == desc and str(it.get("price","")) == price:
-                    lst.pop(j)
-                    return True
-            return False
-    
-        # 1) Обрабатываем авто-товары: auto -> moved_overrides (с orig_cat/sub)
-        auto_list = auto_cat.get(src_cat, {}).get(src_sub, [])
-        for pick in [p for p in picks if p["src"] == "auto"]:
-            desc, price = pick["desc"], pick["price"]
-            if _remove_by_desc_price(auto_list, desc, price):
-                overrides.setdefault(new_cat, {}).setdefault(new_sub, []).append({
-                    "desc": desc,
-                    "price": price,
+        async with catalog_writer(context):
+            auto_cat = context.application.bot_data.get("catalog") or {}
+            overrides = context.application.bot_data.get("moved_overrides") or _load_moved_overrides()
+            manual    = context.application.bot_data.get("manual_categories") or _load_manual_categories()
+
+            moved_cnt = 0
+            context.application.bot_data["moved_overrides"] = overrides
+            context.application.bot_data["manual_categories"] = manual
+            index = _get_item_index(context)
+
+            def _picked_entries(layer: int, src_name: str) -> list[dict]:
+                """Выбранные товары слоя в src_cat/src_sub: по индексу, без прохода по спискам."""
+                found, taken = [], set()
+                for p in picks:
+                    if p["src"] != src_name:
+                        continue
+                    for cat, sub, it in index.entries(layer, _norm_desc(p["desc"])):
+                        if (cat == src_cat and sub == src_sub and id(it) not in taken
+                                and str(it.get("desc", "")) == p["desc"] and str(it.get("price", "")) == p["price"]):
+                            found.append(it)
+                            taken.add(id(it))
+                            # один выбор авто-товара — одна позиция, как прежде
+                            if layer == LAYER_AUTO:
+                                break
+                return found
+
+            # 1) Обрабатываем авто-товары: auto -> moved_overrides (с orig_cat/sub)
+            auto_picked = _picked_entries(LAYER_AUTO, "auto")
+            if auto_picked:
+                _drop_from_layer(auto_cat, src_cat, src_sub, {id(it) for it in auto_picked})
+            for it in auto_picked:
+                index.remove(LAYER_AUTO, it)
+                moved_item = {
+                    "desc": str(it.get("desc", "")),
+                    "price": str(it.get("price", "")),
                     "origin": "auto",
                     "orig_cat": src_cat,
                     "orig_sub": src_sub,
-                })
-                moved_cnt += 1
-    
-        # 2) Обрабатываем перенесённые: moved_overrides -> moved_overrides (orig_* не меняем)
-        moved_list = overrides.get(src_cat, {}).get(src_sub, [])
-        moved_to_keep = []
-        for it in moved_list:
-            # выясняем, выбран ли этот элемент
-            chosen = any(p["src"] == "moved" and p["desc"] == str(it.get("desc","")) and p["price"] == str(it.get("price","")) for p in picks)
-            if chosen:
-                overrides.setdefault(new_cat, {}).setdefault(new_sub, []).append(it)  # переносим как есть
-                moved_cnt += 1
-            else:
-                moved_to_keep.append(it)
-        if moved_list is not None:
-            # обновляем/удаляем исходную ветку только если она существует
-            if src_cat in overrides and src_sub in overrides[src_cat]:
-                if moved_to_keep:
-                    overrides[src_cat][src_sub] = moved_to_keep
-                else:
-                    del overrides[src_cat][src_sub]
-                    if not overrides[src_cat]:
-                        del overrides[src_cat]
-    
-        # 3) Обрабатываем ручные: manual -> manual
-        manual_list = manual.get(src_cat, {}).get(src_sub, [])
-        manual_to_keep = []
-        for it in manual_list:
-            chosen = any(p["src"] == "manual" and p["desc"] == str(it.get("desc","")) and p["price"] == str(it.get("price","")) for p in picks)
-            if chosen:
-                manual.setdefault(new_cat, {}).setdefault(new_sub, []).append(it)
+                }
+                overrides.setdefault(new_cat, {}).setdefault(new_sub, []).append(moved_item)
+                index.add(LAYER_MOVED, new_cat, new_sub, moved_item)
                 moved_cnt += 1
-            else:
-                manual_to_keep.append(it)
-        if manual_list is not None:
-            if manual_to_keep:
-                manual[src_cat][src_sub] = manual_to_keep
-            else:
-                if src_cat in manual and src_sub in manual[src_cat]:
-                    del manual[src_cat][src_sub]
-                    if not manual[src_cat]:
-                        del manual[src_cat]
-    
-        # Сохраняем изменения
-        context.application.bot_data["catalog"] = auto_cat
-        _save_catalog_to_disk(auto_cat)
-        context.application.bot_data["moved_overrides"] = overrides
-        _save_moved_overrides(overrides)
-        context.application.bot_data["manual_categories"] = manual
-        _save_manual_categories(manual)
+
+            # 2) Перенесённые: moved_overrides -> moved_overrides (orig_* не меняем),
+            # 3) ручные: manual -> manual — переносим как есть
+            for layer, layer_data, src_name in ((LAYER_MOVED, overrides, "moved"), (LAYER_MANUAL, manual, "manual")):
+                picked = _picked_entries(layer, src_name)
+                if not picked:
+                    continue
+                _drop_from_layer(layer_data, src_cat, src_sub, {id(it) for it in picked})
+                for it in picked:
+                    index.remove(layer, it)
+                    layer_data.setdefault(new_cat, {}).setdefault(new_sub, []).append(it)
+                    index.add(layer, new_cat, new_sub, it)
+                    moved_cnt += 1
+
+            # Сохраняем изменения
+            context.application.bot_data["catalog"] = auto_cat
+            _save_catalog_to_disk(auto_cat)
+            context.application.bot_data["moved_overrides"] = overrides
+            _save_moved_overrides(overrides)
+            context.application.bot_data["manual_categories"] = manual
+            _save_manual_categories(manual)
+            _bump_catalog_version(context)
     
         await query.edit_message_text(
             f"✅ Перенесено позиций: {moved_cnt}\n"
@@ -2019,7 +5025,8 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
             await query.edit_message_text(f"В {cat} / {brand} товаров нет.")
             return
 
-        # Нумерованный список
+        # Нумерованный список; запоминаем, что именно показали, — номера проверяются при записи
+        context.user_data["manualprice_shown"] = _shown_items(items)
         lines = ["<b>Текущие товары:</b>"]
         for i, it in enumerate(items, start=1):
             d = html.escape(it.get("desc", ""))
@@ -2075,52 +5082,60 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
 
         cat, brand = cb_map[data]
 
-        # 1) Удаляем ручную подкатегорию из manual_categories
-        manual_cats = context.application.bot_data.get("manual_categories")
-        if manual_cats is None:
-            manual_cats = _load_manual_categories()
-
-        removed_manual_count = 0
-        if cat in manual_cats and brand in manual_cats[cat]:
-            removed_manual_count = len(manual_cats[cat][brand])
-            del manual_cats[cat][brand]
-            if not manual_cats[cat]:
-                del manual_cats[cat]
-            context.application.bot_data["manual_categories"] = manual_cats
-            _save_manual_categories(manual_cats)
-
-        # 2) Если в этой же подкатегории лежали ПЕРЕНЕСЁННЫЕ товары (moved_overrides) — вернём их в исходные места
-        overrides = context.application.bot_data.get("moved_overrides")
-        if overrides is None:
-            overrides = _load_moved_overrides()
-
-        returned_count = 0
-        if overrides.get(cat, {}).get(brand):
-            moved_items = overrides[cat][brand]
-            catalog = context.application.bot_data.get("catalog") or {}
-
-            for it in moved_items:
-                desc = it.get("desc", "")
-                price = it.get("price", "")
-                o_cat = it.get("orig_cat")
-                o_sub = it.get("orig_sub")
-                if not o_cat or not o_sub:
-                    # на случай старых записей без orig_* — пробуем классифицировать по описанию
-                    o_cat, o_sub = extract_category(desc)
-
-                catalog.setdefault(o_cat, {}).setdefault(o_sub, []).append({"desc": desc, "price": price})
-                returned_count += 1
-
-            # Удаляем перенесённые из этой ручной подкатегории
-            del overrides[cat][brand]
-            if not overrides[cat]:
-                del overrides[cat]
-
-            # Сохраняем обе структуры
-            context.application.bot_data["catalog"] = catalog
-            _save_catalog_to_disk(catalog)
-            context.application.bot_data["moved_overrides"] = overrides
-            _save_moved_overrides(overrides)
+        async with catalog_writer(context):
+            # 1) Удаляем ручную подкатегорию из manual_categories
+            manual_cats = context.application.bot_data.get("manual_categories")
+            if manual_cats is None:
+                manual_cats = _load_manual_categories()
+
+            removed_manual_count = 0
+            if cat in manual_cats and brand in manual_cats[cat]:
+                removed_manual_count = len(manual_cats[cat][brand])
+                _get_item_index(context).remove_items(LAYER_MANUAL, manual_cats[cat][brand])
+                del manual_cats[cat][brand]
+                if not manual_cats[cat]:
+                    del manual_cats[cat]
+                context.application.bot_data["manual_categories"] = manual_cats
+                _save_manual_categories(manual_cats)
+                _bump_catalog_version(context)
+
+            # 2) Если в этой же подкатегории лежали ПЕРЕНЕСЁННЫЕ товары (moved_overrides) — вернём их в исходные места
+            overrides = context.application.bot_data.get("moved_overrides")
+            if overrides is None:
+                overrides = _load_moved_overrides()
+
+            returned_count = 0
+            if overrides.get(cat, {}).get(brand):
+                moved_items = overrides[cat][brand]
+                catalog = context.application.bot_data.get("catalog") or {}
+                index = _get_item_index(context)
+
+                for it in moved_items:
+                    desc = it.get("desc", "")
+                    price = it.get("price", "")
+                    o_cat = it.get("orig_cat")
+                    o_sub = it.get("orig_sub")
+                    if not o_cat or not o_sub:
+                        # на случай старых записей без orig_* — пробуем классифицировать по описанию
+                        o_cat, o_sub = extract_category(desc)
+
+                    returned = {"desc": desc, "price": price}
+                    catalog.setdefault(o_cat, {}).setdefault(o_sub, []).append(returned)
+                    index.remove(LAYER_MOVED, it)
+                    index.add(LAYER_AUTO, o_cat, o_sub, returned)
+                    returned_count += 1
+
+                # Удаляем перенесённые из этой ручной подкатегории
+                del overrides[cat][brand]
+                if not overrides[cat]:
+                    del overrides[cat]
+
+                # Сохраняем обе структуры
+                context.application.bot_data["catalog"] = catalog
+                _save_catalog_to_disk(catalog)
+                context.application.bot_data["moved_overrides"] = overrides
+                _save_moved_overrides(overrides)
+                _bump_catalog_version(context)
 
         # 3) Ответ и возврат в актуальную админ-панель
         await query.edit_message_text(
@@ -2172,10 +5187,11 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
             else:
                 await query.edit_message_text("Такого пользователя нет в списке админов.")
         return
-    await query.answer()
     parts = data.split("|")
-    if not parts:
+    # Лимит проверяем до answer(): отказ сам отвечает на нажатие, второй ответ Telegram отклонит
+    if parts[0] in ("cat", "sub", "back") and await _rate_limited(update, context, "browse"):
         return
+    await query.answer()
     
         # --- Обработка выбора вручную добавленной подкатегории для редактирования товаров ---
     if data.startswith("manualprod_select|"):
@@ -2235,7 +5251,8 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
             await query.edit_message_text("Товаров для удаления нет.")
             return
 
-        # Формируем нумерованный список
+        # Формируем нумерованный список; показанное запоминаем для проверки номеров при удалении
+        context.user_data["manualprod_shown"] = _shown_items(items)
         lines = []
         for idx, it in enumerate(items, start=1):
             desc = html.escape(it.get("desc", ""))
@@ -2257,25 +5274,35 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         if data not in cb_map:
             await query.edit_message_text("Товар не найден.")
             return
-        idx = cb_map[data]
+        pick = cb_map[data]  # (номер, описание, цена) — как в показанном списке
+        if not isinstance(pick, (list, tuple)):
+            await query.edit_message_text("Список устарел — откройте его заново.")
+            return
         cat = context.user_data.get("manualprod_cat")
         brand = context.user_data.get("manualprod_brand")
-        manual_cats = context.application.bot_data.get("manual_categories", {})
-        items = manual_cats.get(cat, {}).get(brand, [])
-        if 0 <= idx < len(items):
-            deleted = items.pop(idx)
-            # Сохраняем изменения
-            _save_manual_categories(manual_cats)
-            context.application.bot_data["manual_categories"] = manual_cats
-            await query.edit_message_text(f"Удалён товар: {deleted.get('desc')} — {deleted.get('price')}")
-            await show_admin_panel(update, context)
-        else:
-            await query.edit_message_text("Некорректный индекс.")
+        deleted = None
+        async with catalog_writer(context):
+            manual_cats = context.application.bot_data.get("manual_categories", {})
+            items = manual_cats.get(cat, {}).get(brand, [])
+            found = _resolve_picks(items, [tuple(pick)])
+            if found:
+                index = _get_item_index(context)
+                deleted = items.pop(found[0])
+                index.remove(LAYER_MANUAL, deleted)
+                # Сохраняем изменения
+                _save_manual_categories(manual_cats)
+                context.application.bot_data["manual_categories"] = manual_cats
+                _bump_catalog_version(context)
+        if deleted is None:
+            await query.edit_message_text("Товар не найден — возможно, его уже изменил другой администратор.")
+            return
+        await query.edit_message_text(f"Удалён товар: {deleted.get('desc')} — {deleted.get('price')}")
+        await show_admin_panel(update, context)
         return
 
 
-    full_catalog = get_full_catalog(context)
-    if not full_catalog:
+    store = _get_catalog_store(context)
+    if not store:
         await query.edit_message_text("Каталог не найден. Загрузите файл командой /add_catalog.")
         return
 
@@ -2287,17 +5314,8 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         if not nav_stack or nav_stack[-1] != ("cat", cat):
             nav_stack.append(("cat", cat))
         context.user_data["navigation_stack"] = nav_stack
-        subcats = full_catalog.get(cat, {})
-        # Кнопки подкатегорий с количеством товаров
-        buttons = []
-        for sub_name, items in subcats.items():
-            buttons.append([InlineKeyboardButton(text=f"{sub_name} ({len(items)})", callback_data=f"sub|{cat}|{sub_name}")])
-        # Кнопка назад: если стек не пуст, возвращаемся к предыдущему уровню
-        if len(nav_stack) > 1:
-            buttons.append([InlineKeyboardButton(text="← Назад", callback_data="back")])
-        else:
-            buttons.append([InlineKeyboardButton(text="← Назад", callback_data="back|root")])
-        markup = InlineKeyboardMarkup(buttons)
+        # Кнопки подкатегорий с количеством товаров; назад — к предыдущему уровню стека или в корень
+        markup = _subcategories_markup(store, cat, "back" if len(nav_stack) > 1 else "back|root")
         await query.edit_message_text(f"Категория: {cat}\nВыберите подкатегорию:", reply_markup=markup)
         return
 
@@ -2308,7 +5326,7 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         if not nav_stack or nav_stack[-1] != ("sub", cat, sub):
             nav_stack.append(("sub", cat, sub))
         context.user_data["navigation_stack"] = nav_stack
-        items = full_catalog.get(cat, {}).get(sub, [])
+        items = store.items(cat, sub)
 
         text_lines: list[str] = []
         for item in items:
@@ -2380,12 +5398,7 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         # Если стек пуст или явно back|root — показываем корень каталога
 
         if (len(parts) > 1 and parts[1] == "root") or not nav_stack:
-            buttons = []
-            for cat_name in _sort_categories(list(full_catalog.keys())):
-                subdict = full_catalog[cat_name]
-                count = sum(len(items) for items in subdict.values())
-                buttons.append([InlineKeyboardButton(text=f"{cat_name} ({count})", callback_data=f"cat|{cat_name}")])
-            markup = InlineKeyboardMarkup(buttons)
+            markup = _categories_markup(store)
             try:
                 await query.edit_message_text("Выберите категорию:", reply_markup=markup)
             except Exception as e:
@@ -2401,19 +5414,11 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         if prev:
             if prev[0] == "cat":
                 cat = prev[1]
-                subcats = full_catalog.get(cat, {})
-                buttons = []
-                for sub_name, items in subcats.items():
-                    buttons.append([InlineKeyboardButton(text=f"{sub_name} ({len(items)})", callback_data=f"sub|{cat}|{sub_name}")])
-                if len(nav_stack) > 1:
-                    buttons.append([InlineKeyboardButton(text="← Назад", callback_data="back")])
-                else:
-                    buttons.append([InlineKeyboardButton(text="← Назад", callback_data="back|root")])
-                markup = InlineKeyboardMarkup(buttons)
+                markup = _subcategories_markup(store, cat, "back" if len(nav_stack) > 1 else "back|root")
                 await query.edit_message_text(f"Категория: {cat}\nВыберите подкатегорию:", reply_markup=markup)
             elif prev[0] == "sub":
                 cat, sub = prev[1], prev[2]
-                items = full_catalog.get(cat, {}).get(sub, [])
+                items = store.items(cat, sub)
                 text_lines: list[str] = []
                 for item in items:
                     desc = html.escape(str(item['desc']))
@@ -2454,16 +5459,411 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
                 await query.edit_message_text(text_to_send, reply_markup=markup, parse_mode="HTML")
         return
 
-def main() -> None:
-    """Запуск бота."""
-    if TOKEN == "YOUR_BOT_TOKEN_HERE":
-        raise RuntimeError(
-            "Необходимо задать токен Telegram-бота. "
-            "Отредактируйте переменную TOKEN или задайте TG_BOT_TOKEN."
+# --- Inline-режим: @bot запрос в любом чате ---
+INLINE_PAGE_SIZE = 20          # Telegram допускает до 50 результатов на ответ
+INLINE_CACHE_TTL = 60          # секунд; столько же держит кэш на стороне Telegram
+INLINE_CACHE_MAX_ENTRIES = 256
+
+
+def _inline_search_cached(context, raw: str) -> list[tuple[str, str, dict]]:
+    """Результаты inline-поиска с коротким кэшем по (нормализованный запрос, версия каталога)."""
+    cache: OrderedDict = context.application.bot_data.setdefault("inline_cache", OrderedDict())
+    key = (_parse_search_query(raw).key, _catalog_version(context))
+    now = time.monotonic()
+    hit = cache.get(key)
+    if hit and now - hit[0] < INLINE_CACHE_TTL:
+        cache.move_to_end(key)
+        return hit[1]
+
+    results, _ = _search_catalog(context, raw)
+    cache[key] = (now, results)
+    cache.move_to_end(key)
+    while len(cache) > INLINE_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+    return results
+
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Inline-поиск: постраничная выдача InlineQueryResultArticle через next_offset."""
+    inline_query = update.inline_query
+    raw = (inline_query.query or "").strip()
+    if not raw:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TTL)
+        return
+
+    try:
+        offset = max(0, int(inline_query.offset or 0))
+    except ValueError:
+        offset = 0
+
+    results = _inline_search_cached(context, raw)
+    page = results[offset:offset + INLINE_PAGE_SIZE]
+    order_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("💬 Заказать у менеджера", url=MANAGER_TELEGRAM_LINK)]
+    ])
+
+    articles = []
+    for i, (cat, sub, item) in enumerate(page, start=offset):
+        desc = str(item.get("desc", ""))
+        price = str(item.get("price", "")).strip()
+        text = f"<b>{html.escape(desc)}</b>"
+        if price:
+            text += f" — <i>{html.escape(price)} ₽</i>"
+        text += f"\n<i>{html.escape(cat)} / {html.escape(sub)}</i>"
+        articles.append(InlineQueryResultArticle(
+            id=str(i),
+            title=desc[:256] or "—",
+            description=(f"{price} ₽ · " if price else "") + f"{cat} / {sub}",
+            input_message_content=InputTextMessageContent(text, parse_mode=ParseMode.HTML),
+            reply_markup=order_markup,
+        ))
+
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(results) else ""
+    await inline_query.answer(articles, cache_time=INLINE_CACHE_TTL, next_offset=next_offset)
+
+
+# -------------------------------------------------------------------
+# Персистентность user_data / bot_data (SQLite, пакетная запись)
+# -------------------------------------------------------------------
+# Навигация, шаги мастеров (manualcat_*, manualprod_*, change_*, ...) и
+# awaiting_search переживают перезапуск. PTB раз в update_interval отдаёт
+# изменённые записи; мы копим их и пишем одной транзакцией в потоке.
+BOT_STATE_FILE = os.getenv("BOT_STATE_FILE", "bot_state.sqlite3")
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("BOT_STATE_FLUSH_INTERVAL", "10"))
+PERSISTENCE_BATCH_MAX = 1000
+
+# Ключи bot_data, которые стоит сохранять. Каталог и производные кэши уже
+# лежат в своих файлах (или пересобираются), их копировать незачем.
+PERSISTENT_BOT_DATA_KEYS: tuple[str, ...] = ("subscribers", "subscriptions", "watches")
+
+
+# Апдейты разных пользователей — параллельно, одного пользователя — по порядку
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    До max_concurrent_updates апдейтов одновременно, но апдейты одного
+    пользователя — строго друг за другом: шаги мастеров в user_data не
+    перемешиваются, а медленная загрузка админа не задерживает покупателей.
+
+    Семафор PTB берётся до do_process_update, то есть до очереди пользователя:
+    ждущие своей очереди апдейты занимали бы общие слоты. Поэтому семафор
+    базового класса заменяется заведомо большим, а настоящий лимит — свой
+    семафор, который берётся уже после блокировки пользователя.
+    """
+
+    _OUTER_LIMIT = 2 ** 20
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._semaphore = asyncio.BoundedSemaphore(self._OUTER_LIMIT)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # user_id → [блокировка, сколько апдейтов её ждут или держат]
+        self._user_locks: dict[int, list] = {}
+
+    async def do_process_update(self, update, coroutine) -> None:
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._user_locks.pop(user.id, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class BotData(dict):
+    """bot_data бота: PTB делает deepcopy перед сохранением — копируем только нужные ключи."""
+
+    def __deepcopy__(self, memo):
+        import copy
+        return {k: copy.deepcopy(self[k], memo) for k in PERSISTENT_BOT_DATA_KEYS if k in self}
+
+
+BotDataRow = tuple[str, str, int, str]   # (вид, ключ, пользователь, описание)
+
+
+def _bot_data_rows(data: dict) -> set[BotDataRow]:
+    """
+    Сохраняемые ключи bot_data — плоским множеством строк «кто на что подписан».
+    Каждая подписка — своя строка таблицы: воркеры добавляют и удаляют строки,
+    а не переписывают общий снимок, поэтому их изменения складываются.
+    """
+    rows: set[BotDataRow] = {("all", "", uid, "") for uid in data.get("subscribers", ())}
+    subs = data.get("subscriptions") or {}
+    for cat, users in subs.get("cat", {}).items():
+        rows.update(("cat", cat, uid, "") for uid in users)
+    for cat, by_sub in subs.get("sub", {}).items():
+        for sub, users in by_sub.items():
+            key = json.dumps([cat, sub], ensure_ascii=False)
+            rows.update(("sub", key, uid, "") for uid in users)
+    watches = data.get("watches") or {}
+    for key, entry in watches.get("items", {}).items():
+        rows.update(("item", key, uid, entry["desc"]) for uid in entry["users"])
+    for query, users in watches.get("queries", {}).items():
+        rows.update(("query", query, uid, "") for uid in users)
+    return rows
+
+
+def _bot_data_from_rows(rows) -> dict:
+    """Обратно к структурам _get_subscriptions/_get_watches."""
+    data = {"subscribers": set(), "subscriptions": {"cat": {}, "sub": {}}, "watches": {"items": {}, "queries": {}}}
+    subs, watches = data["subscriptions"], data["watches"]
+    for kind, key, uid, extra in rows:
+        if kind == "all":
+            data["subscribers"].add(uid)
+        elif kind == "cat":
+            subs["cat"].setdefault(key, set()).add(uid)
+        elif kind == "sub":
+            cat, sub = json.loads(key)
+            subs["sub"].setdefault(cat, {}).setdefault(sub, set()).add(uid)
+        elif kind == "item":
+            watches["items"].setdefault(key, {"desc": extra, "users": set()})["users"].add(uid)
+        elif kind == "query":
+            watches["queries"].setdefault(key, set()).add(uid)
+    return data
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранилище состояния бота в одном SQLite-файле (WAL).
+
+    Записи update_* только попадают в буфер; буфер сбрасывается одной транзакцией
+    не чаще раза в flush_interval (или при переполнении) и при остановке бота.
+    Неизменившиеся данные (тот же pickle) повторно не пишутся.
+
+    bot_data хранится построчно (_bot_data_rows): пишется только разница с тем,
+    что уже в базе. С reload_users перед апдейтом строки перечитываются, если
+    базу менял другой воркер, — подписки разных воркеров не затирают друг друга.
+    """
+
+    def __init__(self, path: str, flush_interval: float = PERSISTENCE_FLUSH_INTERVAL, reload_users: bool = False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval,
         )
+        import sqlite3
+        import threading
+
+        self.path = path
+        self.flush_interval = flush_interval
+        # Несколько воркеров на одной базе: перечитываем user_data перед апдейтом
+        self.reload_users = reload_users
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS bot_rows (
+                kind TEXT NOT NULL, key TEXT NOT NULL, user_id INTEGER NOT NULL, extra TEXT NOT NULL,
+                PRIMARY KEY (kind, key, user_id, extra)
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key)
+            );
+            """
+        )
+        self._db_lock = threading.Lock()
+        self._pending_users: dict[int, bytes | None] = {}   # None — удалить
+        # Строка bot_data → True (добавить) / False (удалить); _writing — уже в сбросе
+        self._pending_bot: dict[BotDataRow, bool] = {}
+        self._writing_bot: dict[BotDataRow, bool] = {}
+        self._pending_conv: dict[tuple[str, str], bytes | None] = {}
+        self._digests: dict[int, int] = {}
+        self._bot_rows: set[BotDataRow] = set()   # строки bot_data, известные базе
+        self._data_version: int | None = None
+        self._flush_task: asyncio.Task | None = None
+
+    # --- чтение при старте ---
+    def _select(self, sql: str, args: tuple = ()) -> list:
+        with self._db_lock:
+            return self._db.execute(sql, args).fetchall()
+
+    async def get_user_data(self) -> dict[int, dict]:
+        import pickle
+        result = {}
+        for user_id, blob in self._select("SELECT user_id, data FROM user_data"):
+            result[user_id] = pickle.loads(blob)
+            self._digests[user_id] = hash(blob)
+        return result
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> BotData:
+        import pickle
+        self._bot_rows = self._read_bot_rows()
+        if self._bot_rows:
+            return BotData(_bot_data_from_rows(self._bot_rows))
+        # Старый формат — один pickle на весь bot_data; строки допишет первый сброс
+        legacy = self._select("SELECT data FROM bot_data WHERE id = 0")
+        return BotData(pickle.loads(legacy[0][0])) if legacy else BotData()
+
+    def _read_bot_rows(self) -> set[BotDataRow]:
+        with self._db_lock:
+            self._data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+            return set(self._db.execute("SELECT kind, key, user_id, extra FROM bot_rows").fetchall())
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        import pickle
+        rows = self._select("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    # --- запись: только в буфер ---
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        import pickle
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hash(blob)
+        if self._digests.get(user_id) == digest:
+            return
+        self._digests[user_id] = digest
+        self._pending_users[user_id] = blob
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._digests.pop(user_id, None)
+        self._pending_users[user_id] = None
+        self._schedule_flush()
+
+    async def update_bot_data(self, data: dict) -> None:
+        rows = _bot_data_rows(data)
+        if rows == self._bot_rows:
+            return
+        for row in rows - self._bot_rows:
+            self._pending_bot[row] = True
+        for row in self._bot_rows - rows:
+            self._pending_bot[row] = False
+        self._bot_rows = rows
+        self._schedule_flush()
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        import pickle
+        self._pending_conv[(name, json.dumps(list(key)))] = (
+            None if new_state is None else pickle.dumps(new_state, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if not self.reload_users or user_id in self._pending_users:
+            return
+        import pickle
+        rows = self._select("SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+        if rows and hash(rows[0][0]) != self._digests.get(user_id):
+            self._digests[user_id] = hash(rows[0][0])
+            user_data.clear()
+            user_data.update(pickle.loads(rows[0][0]))
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        if not self.reload_users:
+            return
+        with self._db_lock:
+            version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        # data_version меняется только от чужих транзакций — свои записи не перечитываем
+        if version == self._data_version:
+            return
+        rows = self._read_bot_rows()
+        # Ещё не записанные свои изменения — поверх прочитанного
+        for changes in (self._writing_bot, self._pending_bot):
+            for row, add in changes.items():
+                (rows.add if add else rows.discard)(row)
+        if rows == self._bot_rows:
+            return
+        self._bot_rows = rows
+        bot_data.update(_bot_data_from_rows(rows))
+        bot_data.pop("watch_query_index", None)
+
+    # --- сброс буфера ---
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            full = len(self._pending_users) + len(self._pending_conv) >= PERSISTENCE_BATCH_MAX
+            # PTB отдаёт все изменения одного прогона подряд — ждём, пока он закончится
+            delay = 0 if full else min(1.0, self.flush_interval)
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush(delay))
+
+    async def _delayed_flush(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.flush()
+
+    def _write_batch(self, users: dict, bot_rows: dict, conv: dict) -> None:
+        with self._db_lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                    [(uid, blob) for uid, blob in users.items() if blob is not None],
+                )
+                self._db.executemany(
+                    "DELETE FROM user_data WHERE user_id = ?",
+                    [(uid,) for uid, blob in users.items() if blob is None],
+                )
+                self._db.executemany(
+                    "DELETE FROM bot_rows WHERE kind = ? AND key = ? AND user_id = ? AND extra = ?",
+                    [row for row, add in bot_rows.items() if not add],
+                )
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO bot_rows (kind, key, user_id, extra) VALUES (?, ?, ?, ?)",
+                    [row for row, add in bot_rows.items() if add],
+                )
+                if bot_rows:
+                    # Старый снимок bot_data больше не нужен — иначе воскреснет, когда строк не останется
+                    self._db.execute("DELETE FROM bot_data")
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                    [(n, k, s) for (n, k), s in conv.items() if s is not None],
+                )
+                self._db.executemany(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?",
+                    [(n, k) for (n, k), s in conv.items() if s is None],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    async def flush(self) -> None:
+        users, self._pending_users = self._pending_users, {}
+        bot_rows, self._pending_bot = self._pending_bot, {}
+        conv, self._pending_conv = self._pending_conv, {}
+        if users or bot_rows or conv:
+            self._writing_bot = bot_rows
+            try:
+                await asyncio.to_thread(self._write_batch, users, bot_rows, conv)
+            finally:
+                self._writing_bot = {}
 
-    app = ApplicationBuilder().token(TOKEN).build()
 
+async def _post_init(app) -> None:
+    """После загрузки персистентности: каталог и слои с диска в bot_data."""
     # Загружаем каталог с диска при старте и сохраняем в bot_data
     initial_catalog = _load_catalog_from_disk()
     if initial_catalog:
@@ -2473,17 +5873,63 @@ def main() -> None:
     app.bot_data["manual_categories"] = _load_manual_categories()
     app.bot_data["moved_overrides"] = _load_moved_overrides()
 
+    # Несколько воркеров: читаем/публикуем общий снимок каталога
+    if SHARED_CATALOG_DIR:
+        _init_shared_catalog(app.bot_data)
+
+
+async def _post_stop(app) -> None:
+    """Остановка: дописываем историю версий, если фоновая запись ещё идёт."""
+    await _flush_history(app.bot_data)
+
+
+def main() -> None:
+    """Запуск бота."""
+    if TOKEN == "YOUR_BOT_TOKEN_HERE":
+        raise RuntimeError(
+            "Необходимо задать токен Telegram-бота. "
+            "Отредактируйте переменную TOKEN или задайте TG_BOT_TOKEN."
+        )
+
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .context_types(ContextTypes(bot_data=BotData))
+        .concurrent_updates(PerUserUpdateProcessor())
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+    )
+    # Состояние пользователей (навигация, шаги мастеров) переживает перезапуск
+    if BOT_STATE_FILE:
+        builder = builder.persistence(SQLitePersistence(BOT_STATE_FILE, reload_users=bool(SHARED_CATALOG_DIR)))
+    app = builder.build()
+
     # Регистрируем обработчики
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("add_catalog", add_catalog_command))
     app.add_handler(CommandHandler("edit_category", edit_category_command))
     app.add_handler(  CommandHandler("edit_products", edit_products_command) ) 
     app.add_handler(CommandHandler("edit_admins", edit_admins_command))
+    app.add_handler(CommandHandler("rules", rules_command))
+    app.add_handler(CommandHandler("rule_add", rule_add_command))
+    app.add_handler(CommandHandler("rule_del", rule_del_command))
+    app.add_handler(CommandHandler("reload_rules", reload_rules_command))
+    app.add_handler(CommandHandler("reclassify", reclassify_command))
+    app.add_handler(CommandHandler("export", export_command))
+    app.add_handler(CommandHandler("rollback", rollback_command))
+    app.add_handler(CommandHandler("price_history", price_history_command))
+    app.add_handler(CommandHandler("watch", watch_command))
+    app.add_handler(CommandHandler("watches", watches_command))
+    app.add_handler(CommandHandler("search_stats", search_stats_command))
+    app.add_handler(CommandHandler("classify_trace", classify_trace_command))
+    app.add_handler(CommandHandler("classify_profile", classify_profile_command))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("about", about_command))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND) & (~filters.Document.ALL), handle_text))
     app.add_handler(CallbackQueryHandler(callback_query_handler))
+    # Inline-режим (@bot запрос) — требует включения /setinline у @BotFather
+    app.add_handler(InlineQueryHandler(inline_query_handler))
 
     # Запускаем бесконечный поллинг
     print("Бот запущен. Нажмите Ctrl-C для остановки.")